@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2010 Tobias Rodäbel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmarks for the hot paths of the Datastore MySQL stub.
+
+Drives the stub through apiproxy_stub_map with synthetic models against a
+local MySQL server and writes ops/sec and latency percentiles per benchmark
+as JSON, so that runs can be compared:
+
+    python benchmark_datastore_mysql.py --output before.json
+    python benchmark_datastore_mysql.py --output after.json
+
+The database given with --db is cleared before and after the run.
+"""
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import db
+
+import optparse
+import os
+import platform
+import random
+import sys
+import time
+import typhoonae.mysql.datastore_mysql_stub
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+class Item(db.Expando):
+    """An entity with a configurable number of dynamic properties."""
+
+    number = db.IntegerProperty()
+    color = db.StringProperty()
+    size = db.IntegerProperty()
+
+
+class Child(db.Model):
+    """An entity in the entity group of an Item."""
+
+    position = db.IntegerProperty()
+
+
+COLORS = ['red', 'green', 'blue', 'yellow', 'black', 'white']
+
+
+def percentile(sorted_values, fraction):
+    """Returns a percentile of a sorted list by nearest rank."""
+
+    index = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def measure(function, iterations, ops_per_call=1):
+    """Calls a function repeatedly and summarizes its latency.
+
+    Args:
+        function: Called with the iteration number.
+        iterations: The number of calls.
+        ops_per_call: The number of operations one call performs.
+
+    Returns:
+        A dict with the throughput and latency percentiles in milliseconds.
+    """
+
+    latencies = []
+    start = time.time()
+    for i in xrange(iterations):
+        call_start = time.time()
+        function(i)
+        latencies.append((time.time() - call_start) * 1000)
+    elapsed = time.time() - start
+    latencies.sort()
+    return {
+        'iterations': iterations,
+        'ops': iterations * ops_per_call,
+        'ops_per_sec': iterations * ops_per_call / elapsed,
+        'mean_ms': sum(latencies) / len(latencies),
+        'min_ms': latencies[0],
+        'p50_ms': percentile(latencies, 0.5),
+        'p90_ms': percentile(latencies, 0.9),
+        'p99_ms': percentile(latencies, 0.99),
+        'max_ms': latencies[-1],
+    }
+
+
+def make_items(rng, count, width):
+    """Creates unsaved items with width extra properties each."""
+
+    items = []
+    for i in xrange(count):
+        item = Item(number=rng.randint(0, 999),
+                    color=rng.choice(COLORS),
+                    size=rng.randint(0, 9))
+        for p in xrange(width):
+            setattr(item, 'p%d' % p, rng.randint(0, 10 ** 6))
+        items.append(item)
+    return items
+
+
+def run_benchmarks(options):
+    """Runs all benchmarks and returns their results by name."""
+
+    rng = random.Random(options.seed)
+    iterations = options.iterations
+    results = {}
+
+    for width in (0, 10, 50):
+        batches = [make_items(rng, options.batch_size, width)
+                   for i in xrange(iterations)]
+        results['put_batch_width_%d' % width] = measure(
+            lambda i: db.put(batches[i]), iterations, options.batch_size)
+
+    keys = db.put(make_items(rng, options.dataset_size, 5))
+    parents = keys[:10]
+    children = []
+    for parent in parents:
+        children.extend(Child(parent=parent, position=p)
+                        for p in xrange(options.dataset_size / 10))
+    db.put(children)
+
+    def multi_get(i):
+        db.get(rng.sample(keys, options.batch_size))
+    results['get_multi'] = measure(multi_get, iterations, options.batch_size)
+
+    results['query_kind'] = measure(
+        lambda i: Item.all().fetch(options.page_size), iterations)
+
+    results['query_single_property'] = measure(
+        lambda i: Item.all().filter('color =', rng.choice(COLORS))
+                            .fetch(options.page_size),
+        iterations)
+
+    results['query_star_schema'] = measure(
+        lambda i: Item.all().filter('color =', rng.choice(COLORS))
+                            .filter('size =', rng.randint(0, 9))
+                            .fetch(options.page_size),
+        iterations)
+
+    results['query_ancestor'] = measure(
+        lambda i: Child.all().ancestor(rng.choice(parents))
+                             .fetch(options.page_size),
+        iterations)
+
+    def paginate(i):
+        query = Item.all().order('number')
+        for page in xrange(options.pages):
+            if not query.fetch(options.page_size):
+                break
+            query.with_cursor(query.cursor())
+    results['cursor_pagination'] = measure(
+        paginate, max(1, iterations / 10), options.pages)
+
+    results['count'] = measure(
+        lambda i: Item.all().filter('color =', rng.choice(COLORS)).count(),
+        iterations)
+
+    def increment(key):
+        item = db.get(key)
+        item.number += 1
+        item.put()
+    results['transaction'] = measure(
+        lambda i: db.run_in_transaction(increment, rng.choice(parents)),
+        iterations)
+
+    return results
+
+
+def main(argv):
+    parser = optparse.OptionParser()
+    parser.add_option('--host', default='127.0.0.1')
+    parser.add_option('--user', default='root')
+    parser.add_option('--passwd', default='')
+    parser.add_option('--db', default='benchdb',
+                      help='database to use; it is cleared')
+    parser.add_option('--iterations', type='int', default=100)
+    parser.add_option('--batch-size', type='int', default=100)
+    parser.add_option('--dataset-size', type='int', default=2000)
+    parser.add_option('--page-size', type='int', default=20)
+    parser.add_option('--pages', type='int', default=50,
+                      help='pages read per cursor pagination run')
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('--output', help='JSON file, default standard output')
+    options, unused_args = parser.parse_args(argv[1:])
+
+    os.environ['APPLICATION_ID'] = 'bench'
+    os.environ['AUTH_DOMAIN'] = 'mydomain.local'
+
+    database_info = {
+        'host': options.host,
+        'user': options.user,
+        'passwd': options.passwd,
+        'db': options.db,
+    }
+    apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+    stub = typhoonae.mysql.datastore_mysql_stub.DatastoreMySQLStub(
+        'bench', database_info, verbose=False)
+    apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', stub)
+
+    stub.Clear()
+    try:
+        started = time.time()
+        results = run_benchmarks(options)
+        report = {
+            'started': started,
+            'duration_sec': time.time() - started,
+            'python': platform.python_version(),
+            'options': options.__dict__,
+            'benchmarks': results,
+            'rpc_stats': dict(
+                (call, dict((name, value) for name, value in stats.items()
+                            if name != 'latency_buckets'))
+                for call, stats in stub.RpcStats().items()),
+            'sql_profile': stub.SqlProfile(limit=20),
+        }
+    finally:
+        stub.Clear()
+
+    if options.output:
+        output = open(options.output, 'w')
+    else:
+        output = sys.stdout
+    try:
+        json.dump(report, output, indent=2, sort_keys=True)
+        output.write('\n')
+    finally:
+        if options.output:
+            output.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
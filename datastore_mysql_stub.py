@@ -1,1689 +1,4469 @@
-#!/usr/bin/env python
-#
-# Copyright 2007 Google Inc.
-# Copyright 2010 Tobias Rodaebel, Jean-Marc Skopek (Top Hat Monocle)
-#
-# Licensed under the Apache License, Version 2.0 (the "License");
-# you may not use this file except in compliance with the License.
-# You may obtain a copy of the License at
-#
-#     http://www.apache.org/licenses/LICENSE-2.0
-#
-# Unless required by applicable law or agreed to in writing, software
-# distributed under the License is distributed on an "AS IS" BASIS,
-# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
-# See the License for the specific language governing permissions and
-# limitations under the License.
-#
-
-"""MySQL-based stub for the Python datastore API.
-
-Entities are stored in a MySQL database in a similar fashion to the production
-datastore.
-
-Substantial portions of this code are taken from Nick Johnson's SQLite
-Datastore stub.
-"""
-
-
-import array
-import itertools
-import logging
-import md5
-import sys
-import threading
-import time
-import types
-
-from google.appengine.datastore import entity_pb
-from google.appengine.api import api_base_pb
-from google.appengine.api import apiproxy_stub
-from google.appengine.api import apiproxy_stub_map
-from google.appengine.api import datastore_errors
-from google.appengine.datastore import datastore_index
-from google.appengine.datastore import datastore_pb
-from google.appengine.datastore import sortable_pb_encoder
-from google.appengine.runtime import apiproxy_errors
-
-import MySQLdb
-
-try:
-  __import__('google.appengine.api.labs.taskqueue.taskqueue_service_pb')
-  taskqueue_service_pb = sys.modules.get(
-      'google.appengine.api.labs.taskqueue.taskqueue_service_pb')
-except ImportError:
-  from google.appengine.api.taskqueue import taskqueue_service_pb
-
-
-import __builtin__
-buffer = __builtin__.buffer
-
-
-entity_pb.Reference.__hash__ = lambda self: hash(self.Encode())
-datastore_pb.Query.__hash__ = lambda self: hash(self.Encode())
-datastore_pb.Transaction.__hash__ = lambda self: hash(self.Encode())
-datastore_pb.Cursor.__hash__ = lambda self: hash(self.Encode())
-
-
-_MAXIMUM_RESULTS = 1000
-
-
-_MAX_QUERY_COMPONENTS = 63
-
-
-_BATCH_SIZE = 20
-
-
-_MAX_ACTIONS_PER_TXN = 5
-
-
-_MAX_TIMEOUT = 5.0
-
-
-_OPERATOR_MAP = {
-    datastore_pb.Query_Filter.LESS_THAN: '<',
-    datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL: '<=',
-    datastore_pb.Query_Filter.EQUAL: '=',
-    datastore_pb.Query_Filter.GREATER_THAN: '>',
-    datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL: '>=',
-}
-
-
-_ORDER_MAP = {
-    datastore_pb.Query_Order.ASCENDING: 'ASC',
-    datastore_pb.Query_Order.DESCENDING: 'DESC',
-}
-
-_CORE_SCHEMA = ["""
-CREATE TABLE IF NOT EXISTS Apps (
-  app_id VARCHAR(255) NOT NULL PRIMARY KEY,
-  indexes VARCHAR(255)
-) ENGINE=InnoDB;
-""","""
-CREATE TABLE IF NOT EXISTS Namespaces (
-  app_id VARCHAR(255) NOT NULL,
-  name_space VARCHAR(255) NOT NULL,
-  PRIMARY KEY (app_id, name_space)
-) ENGINE=InnoDB;
-""","""
-CREATE TABLE IF NOT EXISTS IdSeq (
-  prefix VARCHAR(255) NOT NULL PRIMARY KEY,
-  next_id INT(100) NOT NULL
-) ENGINE=InnoDB;
-"""]
-
-_NAMESPACE_SCHEMA = ["""
-CREATE TABLE `%(prefix)s_Entities` (
-  `__path__` varchar(255) NOT NULL,
-  `kind` varchar(255) NOT NULL,
-  `entity` longblob NOT NULL,
-  PRIMARY KEY (`__path__`),
-) ENGINE=InnoDB;
-""","""
-CREATE TABLE `%(prefix)s_EntitiesByProperty` (
-    `kind` varchar(255) NOT NULL,
-    `name` varchar(255) NOT NULL,
-    `value` MEDIUMBLOB DEFAULT NULL,
-    `__path__` varchar(255) NOT NULL,
-    `hashed_index` char(32) NOT NULL,
-    PRIMARY KEY (`hashed_index`),
-    INDEX(value(32)),
-    KEY `i1` (`kind`,`name`),
-    KEY `i2` (`__path__`),
-) ENGINE=InnoDB;
-""","""
-INSERT IGNORE INTO Apps (app_id) VALUES ('%(app_id)s');
-""","""
-INSERT INTO Namespaces (app_id, name_space)
-  VALUES ('%(app_id)s', '%(name_space)s');
-""","""
-INSERT IGNORE INTO IdSeq VALUES ('%(prefix)s', 1);
-"""]
-
-def formatTableName(tableName):
-    import re
-    return re.sub("[^\w\d_]","",tableName)
-
-def ReferencePropertyToReference(refprop):
-  ref = entity_pb.Reference()
-  ref.set_app(refprop.app())
-  if refprop.has_name_space():
-    ref.set_name_space(refprop.name_space())
-  for pathelem in refprop.pathelement_list():
-    ref.mutable_path().add_element().CopyFrom(pathelem)
-  return ref
-
-
-class QueryCursor(object):
-  """Encapsulates a database cursor and provides methods to fetch results."""
-
-  def __init__(self, query, db_cursor):
-    """Constructor.
-
-    Args:
-      query: A Query PB.
-      db_cursor: An MySQL cursor returning n+2 columns. The first 2 columns
-        must be the path of the entity and the entity itself, while the
-        remaining columns must be the sort columns for the query.
-    """
-    self.__query = query
-    self.app = query.app()
-    self.__cursor = db_cursor
-    self.__seen = set()
-
-    self.__position = ''
-
-    self.__next_result = (None, None)
-
-    if query.has_limit():
-      self.limit = query.limit() + query.offset()
-    else:
-      self.limit = None
-
-  def Count(self):
-    """Counts results, up to the query's limit.
-
-    Note this method does not deduplicate results, so the query it was generated
-    from should have the 'distinct' clause applied.
-
-    Returns:
-      int: Result count.
-    """
-    count = 0
-    while self.limit is None or count < self.limit:
-      row = self.__cursor.fetchone()
-      if not row:
-        break
-      count += 1
-    return count
-
-  def _EncodeCompiledCursor(self, cc):
-    """Encodes the current position in the query as a compiled cursor.
-
-    Args:
-      cc: The compiled cursor to fill out.
-    """
-    position = cc.add_position()
-    if self.__cursor:
-      offset = str(self.__cursor.rowcount)
-    else:
-      offset = str(0)
-    start_key = self.__position + '!' + offset.zfill(10)
-    position.set_start_key(start_key)
-
-  def _GetResult(self):
-    """Returns the next result from the result set, without deduplication.
-
-    Returns:
-      (path, value): The path and value of the next result.
-    """
-    if not self.__cursor:
-      return None, None
-    row = self.__cursor.fetchone()
-    if not row:
-      self.__cursor = None
-      return None, None
-    path, data, position_parts = str(row[0]), row[1], row[2:]
-    position = ''.join(str(x) for x in position_parts)
-
-    if self.__query.order_list():
-      direction = self.__query.order(0).direction()
-    else:
-      direction = datastore_pb.Query_Order.ASCENDING
-
-    if self.__query.has_end_compiled_cursor():
-      start_key = self.__query.end_compiled_cursor().position(0).start_key()
-      if direction == datastore_pb.Query_Order.ASCENDING:
-        if position > start_key:
-          self.__cursor = None
-          return None, None
-      elif direction == datastore_pb.Query_Order.DESCENDING:
-        if position < start_key:
-          self.__cursor = None
-          return None, None
-
-    self.__position = position
-    return path, data
-
-  def _Next(self):
-    """Fetches the next unique result from the result set.
-
-    Returns:
-      A datastore_pb.EntityProto instance.
-    """
-    entity = None
-    path, data = self.__next_result
-    self.__next_result = None, None
-    while self.__cursor and not entity:
-      if path and path not in self.__seen:
-        self.__seen.add(path)
-        entity = entity_pb.EntityProto(data)
-      else:
-        path, data = self._GetResult()
-    return entity
-
-  def Skip(self, count):
-    """Skips the specified number of unique results.
-
-    Args:
-      count: Number of results to skip.
-    """
-    for unused_i in xrange(count):
-      self._Next()
-
-  def ResumeFromCompiledCursor(self, cc):
-    """Resumes a query from a compiled cursor.
-
-    Args:
-      cc: The compiled cursor to resume from.
-    """
-    target_position = cc.position(0).start_key()
-
-    if self.__query.order_list():
-      direction = self.__query.order(0).direction()
-    else:
-      direction = datastore_pb.Query_Order.ASCENDING
-
-    if direction == datastore_pb.Query_Order.ASCENDING:
-      if (self.__query.has_end_compiled_cursor() and target_position >=
-          self.__query.end_compiled_cursor().position(0).start_key()):
-        self.__position = target_position
-        self.__cursor = None
-        return
-
-      while self.__position <= target_position and self.__cursor:
-        self.__next_result = self._GetResult()
-
-    elif direction == datastore_pb.Query_Order.DESCENDING:
-      if (self.__query.has_end_compiled_cursor() and target_position <=
-          self.__query.end_compiled_cursor().position(0).start_key()):
-        self.__position = target_position
-        self.__cursor = None
-        return
-
-      while self.__position >= target_position and self.__cursor:
-        self.__next_result = self._GetResult()
-
-  def PopulateQueryResult(self, count, result):
-    """Populates a QueryResult PB with results from the cursor.
-
-    Args:
-      count: The number of results to retrieve.
-      result: out: A query_result PB.
-    """
-    if count > _MAXIMUM_RESULTS:
-      count = _MAXIMUM_RESULTS
-
-    result.set_keys_only(self.__query.keys_only())
-
-    result_list = result.result_list()
-    while len(result_list) < count:
-      if self.limit is not None and len(self.__seen) >= self.limit:
-        break
-      entity = self._Next()
-      if entity is None:
-        break
-      result_list.append(entity)
-
-    result.set_more_results(len(result_list) == count)
-    self._EncodeCompiledCursor(result.mutable_compiled_cursor())
-
-
-class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
-  """Persistent stub for the Python datastore API.
-
-  Stores all entities in an MySQL database. A DatastoreMySQLStub instance
-  handles a single app's data.
-  """
-
-  WRITE_ONLY = entity_pb.CompositeIndex.WRITE_ONLY
-  READ_WRITE = entity_pb.CompositeIndex.READ_WRITE
-  DELETED = entity_pb.CompositeIndex.DELETED
-  ERROR = entity_pb.CompositeIndex.ERROR
-
-  _INDEX_STATE_TRANSITIONS = {
-      WRITE_ONLY: frozenset((READ_WRITE, DELETED, ERROR)),
-      READ_WRITE: frozenset((DELETED,)),
-      ERROR: frozenset((DELETED,)),
-      DELETED: frozenset((ERROR,)),
-  }
-
-  def __init__(self,
-               app_id,
-               database_info_dict,
-               require_indexes=False,
-               verbose=True,
-               service_name='datastore_v3',
-               trusted=False):
-    """Constructor.
-
-    Args:
-      app_id: string
-      database_info_dict: dictionary with connection information.
-      require_indexes: bool, default False. If True, composite indexes must
-          exist in index.yaml for queries that need them.
-      verbose: bool, default False. If True, logs all select statements.
-      service_name: Service name expected for all calls.
-      trusted: bool, default False. If True, this stub allows an app to access
-          the data of another app.
-    """
-    apiproxy_stub.APIProxyStub.__init__(self, service_name)
-
-    assert isinstance(app_id, basestring) and app_id
-    self.__app_id = app_id
-    self.__database_info_dict = database_info_dict
-    self.SetTrusted(trusted)
-
-    self.__tx_actions = []
-    self.__transactions = {}
-    self.__inside_tx = False
-    self.__tx_lock = threading.Lock()
-
-    self.__require_indexes = require_indexes
-    self.__verbose = verbose
-
-    self.__id_map = {}
-    self.__id_lock = threading.Lock()
-
-    self.__connection = MySQLdb.connect(
-        host=database_info_dict.get('host', '127.0.0.1'),
-        user=database_info_dict.get('user', 'root'),
-        passwd=database_info_dict.get('passwd', ''),
-        db='mysql')
-    self.__connection_lock = threading.RLock()
-    self.__current_transaction = None
-    self.__next_tx_handle = 1
-
-    self.__tx_writes = {}
-    self.__tx_deletes = set()
-
-    self.__next_cursor_id = 1
-    self.__cursor_lock = threading.Lock()
-    self.__cursors = {}
-
-    self.__namespaces = set()
-
-    self.__indexes = {}
-    self.__index_lock = threading.Lock()
-
-    self.__query_history = {}
-
-    try:
-      self.__Init()
-    except Exception, e:
-      raise datastore_errors.InternalError('%s' % e)
-
-  def __Init(self):
-    """Initializes MySQL database and creates required tables."""
-    cursor = self.__connection.cursor()
-    self._ExecuteSQL('CREATE DATABASE IF NOT EXISTS %s' % self.__database_info_dict['db'], None, cursor)
-    self.__connection.commit()
-
-    self.__connection = MySQLdb.connect(**self.__database_info_dict)
-    cursor = self.__connection.cursor()
-    for sql_command in _CORE_SCHEMA:
-      self._ExecuteSQL(sql_command,None,cursor)
-    self.__connection.commit()
-
-    self._ExecuteSQL('SELECT app_id, name_space FROM Namespaces', None, cursor)
-    self.__namespaces = set(cursor.fetchall())
-
-    self._ExecuteSQL('SELECT app_id, indexes FROM Apps', None, cursor)
-    for app_id, index_proto in cursor.fetchall():
-      index_map = self.__indexes.setdefault(app_id, {})
-      if not index_proto:
-        continue
-      indexes = datastore_pb.CompositeIndices(index_proto)
-      for index in indexes.index_list():
-        index_map.setdefault(index.definition().entity_type(), []).append(index)
-
-  def Clear(self):
-    """Clears the datastore."""
-    conn = self.__GetConnection(None)
-    cursor = conn.cursor()
-    try:
-      self._ExecuteSQL("SELECT TABLE_NAME FROM information_schema.Tables "
-          "WHERE TABLE_SCHEMA='%s';" % self.__database_info_dict['db'], None, cursor)
-      for row in [v[0] for v in cursor.fetchall()]:
-        self._ExecuteSQL('DROP TABLE %s' % row, None, cursor)
-      conn.commit()
-    finally:
-      self.__ReleaseConnection(conn, None)
-
-    self.__transactions = {}
-    self.__inside_tx = False
-    self.__namespaces = set()
-    self.__indexes = {}
-    self.__cursors = {}
-    self.__query_history = {}
-    self.__id_map = {}
-
-    self.__Init()
-
-  def Read(self):
-    """Reads the datastore from disk.
-
-    Noop for compatibility with file stub.
-    """
-    pass
-
-  def Write(self):
-    """Writes the datastore to disk.
-
-    Noop for compatibility with file stub.
-    """
-    pass
-
-  def SetTrusted(self, trusted):
-    """Set/clear the trusted bit in the stub.
-
-    This bit indicates that the app calling the stub is trusted. A
-    trusted app can write to datastores of other apps.
-
-    Args:
-      trusted: boolean.
-    """
-    self.__trusted = trusted
-
-  @staticmethod
-  def __MakeParamList(size):
-    """Returns a comma separated list of MySQL substitution parameters.
-
-    Args:
-      size: Number of parameters in returned list.
-    Returns:
-      A comma separated list of substitution parameters.
-    """
-    return ','.join(['%s'] * size)
-
-  @staticmethod
-  def __GetEntityKind(key):
-    if isinstance(key, entity_pb.EntityProto):
-      key = key.key()
-    return key.path().element_list()[-1].type()
-
-  @staticmethod
-  def __EncodeIndexPB(pb):
-    def _encode_path(pb):
-      path = []
-      for e in pb.element_list():
-        if e.has_name():
-          id = e.name()
-        elif e.has_id():
-          id = str(e.id()).zfill(10)
-        path.append('%s:%s' % (e.type(), id))
-      val = '!'.join(path)
-      return val
-
-    if isinstance(pb, entity_pb.PropertyValue) and pb.has_uservalue():
-      userval = entity_pb.PropertyValue()
-      userval.mutable_uservalue().set_email(pb.uservalue().email())
-      userval.mutable_uservalue().set_auth_domain(pb.uservalue().auth_domain())
-      userval.mutable_uservalue().set_gaiaid(0)
-      pb = userval
-
-    encoder = sortable_pb_encoder.Encoder()
-    pb.Output(encoder)
-
-    if isinstance(pb, entity_pb.PropertyValue):
-      return buffer(encoder.buffer().tostring())
-    elif isinstance(pb, entity_pb.Path):
-      return buffer(_encode_path(pb))
-
-  @staticmethod
-  def __AddQueryParam(params, param):
-    params.append(param)
-    return len(params)
-
-  @staticmethod
-  def __CreateFilterString(filter_list, params):
-    """Transforms a filter list into an SQL WHERE clause.
-
-    Args:
-      filter_list: The list of (property, operator, value) filters
-        to transform. A value_type of -1 indicates no value type comparison
-        should be done.
-      params: out: A list of parameters to pass to the query.
-    Returns:
-      An SQL 'where' clause.
-    """
-    clauses = []
-    for prop, operator, value in filter_list:
-      sql_op = _OPERATOR_MAP[operator]
-
-      value_index = DatastoreMySQLStub.__AddQueryParam(params, value)
-      clauses.append('%s %s %%s' % (prop, sql_op))
-
-    filters = ' AND '.join(clauses)
-    if filters:
-      filters = 'WHERE ' + filters
-    return filters
-
-  @staticmethod
-  def __CreateOrderString(order_list):
-    """Returns an 'ORDER BY' clause from the given list of orders.
-
-    Args:
-      order_list: A list of (field, order) tuples.
-    Returns:
-      An SQL ORDER BY clause.
-    """
-    orders = ', '.join('%s %s' % (x[0], _ORDER_MAP[x[1]]) for x in order_list)
-    if orders:
-      orders = 'ORDER BY ' + orders
-    return orders
-
-  def __ValidateAppId(self, app_id):
-    """Verify that this is the stub for app_id.
-
-    Args:
-      app_id: An application ID.
-
-    Raises:
-      datastore_errors.BadRequestError: if this is not the stub for app_id.
-    """
-    assert app_id
-    if not self.__trusted and app_id != self.__app_id:
-      raise datastore_errors.BadRequestError(
-          'app %s cannot access app %s\'s data' % (self.__app_id, app_id))
-
-  def __ValidateTransaction(self, tx):
-    """Verify that this transaction exists and is valid.
-
-    Args:
-      tx: datastore_pb.Transaction
-
-    Raises:
-      datastore_errors.BadRequestError: if the tx is valid or doesn't exist.
-    """
-    assert isinstance(tx, datastore_pb.Transaction)
-    self.__ValidateAppId(tx.app())
-    if tx.handle() != self.__current_transaction:
-      raise apiproxy_errors.ApplicationError(datastore_pb.Error.BAD_REQUEST,
-                                             'Transaction %s not found' % tx)
-
-  def __ValidateKey(self, key):
-    """Validate this key.
-
-    Args:
-      key: entity_pb.Reference
-
-    Raises:
-      datastore_errors.BadRequestError: if the key is invalid
-    """
-    assert isinstance(key, entity_pb.Reference)
-
-    self.__ValidateAppId(key.app())
-
-    for elem in key.path().element_list():
-      if elem.has_id() == elem.has_name():
-        raise datastore_errors.BadRequestError(
-            'each key path element should have id or name but not both: %r'
-            % key)
-
-  def __GetConnection(self, transaction):
-    """Retrieves a connection to the MySQL DB.
-
-    If a transaction is supplied, the transaction's connection is returned;
-    otherwise a fresh connection is returned.
-
-    Args:
-      transaction: A Transaction PB.
-    Returns:
-      An MySQL connection object.
-    """
-    self.__connection_lock.acquire()
-    request_tx = transaction and transaction.handle()
-    if request_tx == 0:
-      request_tx = None
-    if request_tx != self.__current_transaction:
-      raise apiproxy_errors.ApplicationError(
-          datastore_pb.Error.BAD_REQUEST,
-          'Only one concurrent transaction per thread is permitted.')
-    return self.__connection
-
-  def __ReleaseConnection(self, conn, transaction, rollback=False):
-    """Releases a connection for use by other operations.
-
-    If a transaction is supplied, no action is taken.
-
-    Args:
-      conn: An MySQL connection object.
-      transaction: A Transaction PB.
-      rollback: If True, roll back the database TX instead of committing it.
-    """
-    if not transaction or not transaction.has_handle():
-      if rollback:
-        conn.rollback()
-      else:
-        conn.commit()
-    self.__connection_lock.release()
-
-  def __ConfigureNamespace(self, conn, prefix, app_id, name_space):
-    """Ensures the relevant tables and indexes exist.
-
-    Args:
-      conn: An MySQL database connection.
-      prefix: The namespace prefix to configure.
-      app_id: The app ID.
-      name_space: The per-app namespace name.
-    """
-    format_args = {'app_id': app_id, 'name_space': name_space, 'prefix': prefix}
-    cursor = conn.cursor()
-    for sql_command in _NAMESPACE_SCHEMA:
-      try:
-        self._ExecuteSQL(sql_command % format_args, None, cursor)
-      except MySQLdb.IntegrityError, e:
-        logging.warn(str(e))
-    conn.commit()
-
-  def __WriteIndexData(self, conn, app):
-    """Writes index data to disk.
-
-    Args:
-      conn: An MySQL connection.
-      app: The app ID to write indexes for.
-    """
-    indices = datastore_pb.CompositeIndices()
-    for indexes in self.__indexes[app].values():
-      indices.index_list().extend(indexes)
-
-    cursor = conn.cursor()
-    self._ExecuteSQL('UPDATE Apps SET indexes = ? WHERE app_id = ?' % format_args, (app, indices.Encode()), cursor)
-
-  def __GetTablePrefix(self, data):
-    """Returns the namespace prefix for a query.
-
-    Args:
-      data: An Entity, Key or Query PB, or an (app_id, ns) tuple.
-    Returns:
-      A valid table prefix
-    """
-    if isinstance(data, entity_pb.EntityProto):
-      data = data.key()
-    if not isinstance(data, tuple):
-      data = (data.app(), data.name_space())
-    prefix = ('%s_%s' % data).replace('"', '""')
-    prefix = formatTableName(prefix)
-    if data not in self.__namespaces:
-      self.__namespaces.add(data)
-      self.__ConfigureNamespace(self.__connection, prefix, *data)
-    return prefix
-
-  def __DeleteRows(self, conn, paths, table):
-    """Deletes rows from a table.
-
-    Args:
-      conn: An MySQL connection.
-      paths: Paths to delete.
-      table: The table to delete from.
-    Returns:
-      The number of rows deleted.
-    """
-    cursor = conn.cursor()
-    sql_command = 'DELETE FROM %s WHERE __path__ IN (%s)'%(table, self.__MakeParamList(len(paths)))
-    self._ExecuteSQL(sql_command, paths, cursor)
-    return cursor.rowcount
-
-  def __DeleteEntityRows(self, conn, keys, table):
-    """Deletes rows from the specified table that index the keys provided.
-
-    Args:
-      conn: A database connection.
-      keys: A list of keys to delete index entries for.
-      table: The table to delete from.
-    Returns:
-      The number of rows deleted.
-    """
-    keys = sorted((x.app(), x.name_space(), x) for x in keys)
-    for (app_id, ns), group in itertools.groupby(keys, lambda x: x[:2]):
-      path_strings = [self.__EncodeIndexPB(x[2].path()) for x in group]
-      prefix = self.__GetTablePrefix((app_id, ns))
-      return self.__DeleteRows(conn, path_strings, '%s_%s' % (prefix, table))
-
-  def __DeleteIndexEntries(self, conn, keys):
-    """Deletes entities from the index.
-
-    Args:
-      conn: An MySQL connection.
-      keys: A list of keys to delete.
-    """
-    self.__DeleteEntityRows(conn, keys, 'EntitiesByProperty')
-
-  def __InsertEntities(self, conn, entities):
-    """Inserts or updates entities in the DB.
-
-    Args:
-      conn: A database connection.
-      entities: A list of entities to store.
-    """
-
-    def RowGenerator(entities):
-      for unused_prefix, e in entities:
-        yield (self.__EncodeIndexPB(e.key().path()),
-               self.__GetEntityKind(e),
-               buffer(e.Encode()))
-
-    entities = sorted((self.__GetTablePrefix(x), x) for x in entities)
-    for prefix, group in itertools.groupby(entities, lambda x: x[0]):
-      cursor = conn.cursor()
-      group_rows = RowGenerator(group)
-      self._ExecuteSQL('REPLACE INTO %s_Entities VALUES (%%s, %%s, %%s)' % prefix, group_rows, cursor)
-
-  def __InsertIndexEntries(self, conn, entities):
-    """Inserts index entries for the supplied entities.
-
-    Args:
-      conn: A database connection.
-      entities: A list of entities to create index entries for.
-    """
-
-    def RowGenerator(entities):
-      for unused_prefix, e in entities:
-        for p in e.property_list():
-          p_vals = [self.__GetEntityKind(e), p.name(), self.__EncodeIndexPB(p.value()), self.__EncodeIndexPB(e.key().path())]
-
-          hashed_index = md5.new(''.join(p_vals[:2]))
-          hashed_index.update(p_vals[2]) #buffer values cannot be joined into a string
-          hashed_index.update(p_vals[3])
-          p_vals.append( hashed_index.hexdigest() )
-
-          yield p_vals
-    entities = sorted((self.__GetTablePrefix(x), x) for x in entities)
-    for prefix, group in itertools.groupby(entities, lambda x: x[0]):
-      cursor = conn.cursor()
-      self._ExecuteSQL(
-        'INSERT IGNORE INTO %s_EntitiesByProperty '
-        '(kind, name, value, __path__, hashed_index)  '
-        'VALUES '
-        '(%%s, %%s, %%s, %%s, %%s)' % prefix,
-        RowGenerator(group), cursor)
-
-  def __AllocateIds(self, conn, prefix, size):
-    """Allocates IDs.
-
-    Args:
-      conn: A MySQL connection object.
-      prefix: A table namespace prefix.
-      size: Number of IDs to allocate.
-    Returns:
-      int: The beginning of a range of size IDs
-    """
-    self.__id_lock.acquire()
-    next_id, block_size = self.__id_map.get(prefix, (0, 0))
-    if size >= block_size:
-      block_size = max(1000, size)
-      cursor = conn.cursor()
-      self._ExecuteSQL('UPDATE IdSeq SET next_id = next_id + %s WHERE prefix = %s',(block_size, prefix), cursor)
-      assert int(cursor.rowcount) == 1
-      self._ExecuteSQL('SELECT next_id FROM IdSeq WHERE prefix = %s LIMIT 1',(prefix,),cursor)
-      next_id = cursor.fetchone()[0] - block_size
-
-    ret = next_id
-
-    next_id += size
-    block_size -= size
-    self.__id_map[prefix] = (next_id, block_size)
-    self.__id_lock.release()
-
-    return ret
-
-  def __AcquireLockForEntityGroup(self, conn, entity_group='', timeout=30):
-    """Acquire a lock for a specified entity group.
-
-    Args:
-      conn: A MySQL connection.
-      entity_group: An entity group.
-      timeout: Number of seconds till a lock expires.
-    """
-    cursor = conn.cursor()
-    lock_str = self.__app_id + '_' + entity_group
-    self._ExecuteSQL("SELECT GET_LOCK('%s', %i);" % (lock_str, timeout), None, cursor)
-    conn.commit()
-
-  def __ReleaseLockForEntityGroup(self, conn, entity_group=''):
-    """Release transaction lock if present.
-
-    Args:
-      conn: A MySQL connection.
-      entity_group: An entity group.
-    """
-    cursor = conn.cursor()
-    lock_str = self.__app_id + '_' + entity_group
-    self._ExecuteSQL("SELECT RELEASE_LOCK('%s');" % lock_str, None, cursor)
-    conn.commit()
-
-  @staticmethod
-  def __ExtractEntityGroupFromKeys(keys):
-    """Extracts entity group."""
-
-    types = set([k.path().element_list()[-1].type() for k in keys])
-    assert len(types) == 1
-
-    return types.pop()
-
-  def MakeSyncCall(self, service, call, request, response):
-    """The main RPC entry point. service must be 'datastore_v3'."""
-
-    self.AssertPbIsInitialized(request)
-
-    super(DatastoreMySQLStub, self).MakeSyncCall(
-      service, call, request, response)
-
-    self.AssertPbIsInitialized(response)
-
-  def AssertPbIsInitialized(self, pb):
-    """Raises an exception if the given PB is not initialized and valid."""
-    explanation = []
-    assert pb.IsInitialized(explanation), explanation
-    pb.Encode()
-
-  def QueryHistory(self):
-    """Returns a dict that maps Query PBs to times they've been run."""
-    return dict((pb, times) for pb, times in self.__query_history.items() if
-                pb.app() == self.__app_id)
-
-  def __PutEntities(self, conn, entities):
-    self.__DeleteIndexEntries(conn, [e.key() for e in entities])
-    self.__InsertEntities(conn, entities)
-    self.__InsertIndexEntries(conn, entities)
-
-  def __DeleteEntities(self, conn, keys):
-    self.__DeleteIndexEntries(conn, keys)
-    self.__DeleteEntityRows(conn, keys, 'Entities')
-
-  def _Dynamic_Put(self, put_request, put_response):
-    conn = self.__GetConnection(put_request.transaction())
-    try:
-      entities = put_request.entity_list()
-      keys = [e.key() for e in entities]
-      if put_request.has_transaction():
-        if (put_request.transaction() in self.__transactions
-            and not self.__inside_tx):
-          entity_group = self.__ExtractEntityGroupFromKeys(keys)
-          self.__inside_tx = True
-          self.__transactions[put_request.transaction()] = entity_group
-          self.__AcquireLockForEntityGroup(self.__connection, entity_group)
-      for entity in entities:
-        self.__ValidateKey(entity.key())
-
-        for prop in itertools.chain(entity.property_list(),
-                                    entity.raw_property_list()):
-          if prop.value().has_uservalue():
-            uid = md5.new(prop.value().uservalue().email().lower()).digest()
-            uid = '1' + ''.join(['%02d' % ord(x) for x in uid])[:20]
-            prop.mutable_value().mutable_uservalue().set_obfuscated_gaiaid(uid)
-
-        assert entity.has_key()
-        assert entity.key().path().element_size() > 0
-
-        last_path = entity.key().path().element_list()[-1]
-        if last_path.id() == 0 and not last_path.has_name():
-          id_ = self.__AllocateIds(conn, self.__GetTablePrefix(entity.key()), 1)
-          last_path.set_id(id_)
-
-          assert entity.entity_group().element_size() == 0
-          group = entity.mutable_entity_group()
-          root = entity.key().path().element(0)
-          group.add_element().CopyFrom(root)
-
-        else:
-          assert (entity.has_entity_group() and
-                  entity.entity_group().element_size() > 0)
-
-        if put_request.transaction().handle():
-          self.__tx_writes[entity.key()] = entity
-          self.__tx_deletes.discard(entity.key())
-
-      if not put_request.transaction().handle():
-        self.__PutEntities(conn, entities)
-      put_response.key_list().extend([e.key() for e in entities])
-    finally:
-      self.__ReleaseConnection(conn, put_request.transaction())
-
-  def _Dynamic_Get(self, get_request, get_response):
-    conn = self.__GetConnection(get_request.transaction())
-    try:
-      keys = get_request.key_list()
-      if get_request.has_transaction():
-        if (get_request.transaction() in self.__transactions
-            and not self.__inside_tx):
-          entity_group = self.__ExtractEntityGroupFromKeys(keys)
-          self.__inside_tx = True
-          self.__transactions[get_request.transaction()] = entity_group
-          self.__AcquireLockForEntityGroup(self.__connection, entity_group)
-      for key in keys:
-        self.__ValidateAppId(key.app())
-        prefix = self.__GetTablePrefix(key)
-        cursor = conn.cursor()
-        self._ExecuteSQL('SELECT entity FROM %s_Entities WHERE __path__ = %%s'%prefix, (self.__EncodeIndexPB(key.path()),), cursor)
-        group = get_response.add_entity()
-        row = cursor.fetchone()
-        if row:
-          group.mutable_entity().ParseFromString(row[0])
-    finally:
-      self.__ReleaseConnection(conn, get_request.transaction())
-
-  def _Dynamic_Delete(self, delete_request, delete_response):
-    conn = self.__GetConnection(delete_request.transaction())
-    try:
-      keys = delete_request.key_list()
-      if delete_request.has_transaction():
-        if (delete_request.transaction() in self.__transactions
-            and not self.__inside_tx):
-          entity_group = self.__ExtractEntityGroupFromKeys(keys)
-          self.__inside_tx = True
-          self.__transactions[request.transaction()] = entity_group
-          self.__AcquireLockForEntityGroup(self.__connection, entity_group)
-      for key in keys:
-        self.__ValidateAppId(key.app())
-        if delete_request.transaction().handle():
-          self.__tx_deletes.add(key)
-          self.__tx_writes.pop(key, None)
-
-      if not delete_request.transaction().handle():
-        self.__DeleteEntities(conn, delete_request.key_list())
-    finally:
-      self.__ReleaseConnection(conn, delete_request.transaction())
-
-  def __GenerateFilterInfo(self, filters, query):
-    """Transform a list of filters into a more usable form.
-
-    Args:
-      filters: A list of filter PBs.
-      query: The query to generate filter info for.
-    Returns:
-      A dict mapping property names to lists of (op, value) tuples.
-    """
-    filter_info = {}
-    for filt in filters:
-      assert filt.property_size() == 1
-      prop = filt.property(0)
-      value = prop.value()
-      if prop.name() == '__key__':
-        value = ReferencePropertyToReference(value.referencevalue())
-        assert value.app() == query.app()
-        assert value.name_space() == query.name_space()
-        value = value.path()
-      filter_info.setdefault(prop.name(), []).append(
-          (filt.op(), self.__EncodeIndexPB(value)))
-    return filter_info
-
-  def __GenerateOrderInfo(self, orders):
-    """Transform a list of orders into a more usable form.
-
-    Args:
-      orders: A list of order PBs.
-    Returns:
-      A list of (property, direction) tuples.
-    """
-    orders = [(order.property(), order.direction()) for order in orders]
-    if orders and orders[-1] == ('__key__', datastore_pb.Query_Order.ASCENDING):
-      orders.pop()
-    return orders
-
-  def __GetPrefixRange(self, prefix):
-    """Returns a (min, max) range that encompasses the given prefix.
-
-    Args:
-      prefix: A string prefix to filter for. Must be a PB encodable using
-        __EncodeIndexPB.
-    Returns:
-      (min, max): Start and end string values to filter on.
-    """
-    ancestor_min = self.__EncodeIndexPB(prefix)
-    ancestor_max = buffer(str(ancestor_min) + '\xfb\xff\xff\xff\x89')
-    return ancestor_min, ancestor_max
-
-  def  __KindQuery(self, query, filter_info, order_info):
-    """Performs kind only, kind and ancestor, and ancestor only queries."""
-    if not (set(filter_info.keys()) |
-            set(x[0] for x in order_info)).issubset(['__key__']):
-      return None
-    if len(order_info) > 1:
-      return None
-
-    filters = []
-    filters.extend(('__path__', op, value) for op, value
-                   in filter_info.get('__key__', []))
-    if query.has_kind():
-      filters.append(('kind', datastore_pb.Query_Filter.EQUAL, query.kind()))
-    if query.has_ancestor():
-      amin, amax = self.__GetPrefixRange(query.ancestor().path())
-      filters.append(('__path__',
-                      datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL, amin))
-      filters.append(('__path__', datastore_pb.Query_Filter.LESS_THAN, amax))
-
-    if order_info:
-      orders = [('__path__', order_info[0][1])]
-    else:
-      orders = [('__path__', datastore_pb.Query_Order.ASCENDING)]
-
-    params = []
-    query = ('SELECT Entities.__path__, Entities.entity, %s '
-             'FROM %s_Entities AS Entities %s %s' % (
-                 ','.join(x[0] for x in orders),
-                 self.__GetTablePrefix(query),
-                 self.__CreateFilterString(filters, params),
-                 self.__CreateOrderString(orders)))
-    return query, params
-
-  def __SinglePropertyQuery(self, query, filter_info, order_info):
-    """Performs queries satisfiable by the EntitiesByProperty table."""
-    property_names = set(filter_info.keys())
-    property_names.update(x[0] for x in order_info)
-    property_names.discard('__key__')
-    if len(property_names) != 1:
-      return None
-
-    property_name = property_names.pop()
-    filter_ops = filter_info.get(property_name, [])
-
-    if len([1 for o, _ in filter_ops
-            if o == datastore_pb.Query_Filter.EQUAL]) > 1:
-      return None
-
-    if len(order_info) > 1 or (order_info and order_info[0][0] == '__key__'):
-      return None
-
-    if query.has_ancestor():
-      return None
-
-    if not query.has_kind():
-      return None
-
-    prefix = self.__GetTablePrefix(query)
-    filters = []
-    filters.append(('EntitiesByProperty.kind',
-                    datastore_pb.Query_Filter.EQUAL, query.kind()))
-    filters.append(('name', datastore_pb.Query_Filter.EQUAL, property_name))
-    for op, value in filter_ops:
-      if property_name == '__key__':
-        filters.append(('EntitiesByProperty.__path__', op, value))
-      else:
-        filters.append(('value', op, value))
-
-    orders = [('EntitiesByProperty.kind', datastore_pb.Query_Order.ASCENDING),
-              ('name', datastore_pb.Query_Order.ASCENDING)]
-    if order_info:
-      orders.append(('value', order_info[0][1]))
-    else:
-      orders.append(('value', datastore_pb.Query_Order.ASCENDING))
-    orders.append(('EntitiesByProperty.__path__',
-                   datastore_pb.Query_Order.ASCENDING))
-
-    params = []
-    format_args = (
-        ','.join(x[0] for x in orders[2:]),
-        prefix,
-        prefix,
-        self.__CreateFilterString(filters, params),
-        self.__CreateOrderString(orders))
-    query = ('SELECT Entities.__path__, Entities.entity, %s '
-             'FROM %s_EntitiesByProperty AS EntitiesByProperty INNER JOIN '
-             "%s_Entities AS Entities USING (__path__) %s %s" % format_args)
-    return query, params
-
-  def __StarSchemaQueryPlan(self, query, filter_info, order_info):
-    """Executes a query using a 'star schema' based on EntitiesByProperty.
-
-    A 'star schema' is a join between an objects table (Entities) and multiple
-    instances of a facts table (EntitiesByProperty). Ideally, this will result
-    in a merge join if the only filters are inequalities and the sort orders
-    match those in the index for the facts table; otherwise, the DB will do its
-    best to satisfy the query efficiently.
-
-    Args:
-      query: The datastore_pb.Query PB.
-      filter_info: A dict mapping properties filtered on to (op, value) tuples.
-      order_info: A list of (property, direction) tuples.
-    Returns:
-      (query, params): An SQL query string and list of parameters for it.
-    """
-    filter_sets = []
-    for name, filter_ops in filter_info.items():
-      filter_sets.extend((name, [x]) for x in filter_ops
-                         if x[0] == datastore_pb.Query_Filter.EQUAL)
-      ineq_ops = [x for x in filter_ops
-                  if x[0] != datastore_pb.Query_Filter.EQUAL]
-      if ineq_ops:
-        filter_sets.append((name, ineq_ops))
-
-    for prop, _ in order_info:
-      if prop == '__key__':
-        continue
-      if prop not in filter_info:
-        filter_sets.append((prop, []))
-
-    prefix = self.__GetTablePrefix(query)
-
-    joins = []
-    filters = []
-    join_name_map = {}
-    for name, filter_ops in filter_sets:
-      join_name = 'ebp_%d' % (len(joins),)
-      join_name_map.setdefault(name, join_name)
-      joins.append(
-          'INNER JOIN %s_EntitiesByProperty AS %s '
-          'ON Entities.__path__ = %s.__path__'
-          % (prefix, join_name, join_name))
-      filters.append(('%s.kind' % join_name, datastore_pb.Query_Filter.EQUAL,
-                      query.kind()))
-      filters.append(('%s.name' % join_name, datastore_pb.Query_Filter.EQUAL,
-                      name))
-      for op, value in filter_ops:
-        filters.append(('%s.value' % join_name, op, buffer(value)))
-      if query.has_ancestor():
-        amin, amax = self.__GetPrefixRange(query.ancestor().path())
-        filters.append(('%s.__path__' % join_name,
-                        datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL, amin))
-        filters.append(('%s.__path__' % join_name,
-                        datastore_pb.Query_Filter.LESS_THAN, amax))
-
-    orders = []
-    for prop, order in order_info:
-      if prop == '__key__':
-        orders.append(('Entities.__path__', order))
-      else:
-        prop = '%s.value' % (join_name_map[prop],)
-        orders.append((prop, order))
-    if not order_info or order_info[-1][0] != '__key__':
-      orders.append(('Entities.__path__', datastore_pb.Query_Order.ASCENDING))
-
-    params = []
-    format_args = (
-        ','.join(x[0] for x in orders),
-        prefix,
-        ' '.join(joins),
-        self.__CreateFilterString(filters, params),
-        self.__CreateOrderString(orders))
-    query = ('SELECT Entities.__path__, Entities.entity, %s '
-             'FROM %s_Entities AS Entities %s %s %s' % format_args)
-    return query, params
-
-  def __MergeJoinQuery(self, query, filter_info, order_info):
-    if order_info:
-      return None
-    if query.has_ancestor():
-      return None
-    if not query.has_kind():
-      return None
-    for filter_ops in filter_info.values():
-      for op, _ in filter_ops:
-        if op != datastore_pb.Query_Filter.EQUAL:
-          return None
-
-    return self.__StarSchemaQueryPlan(query, filter_info, order_info)
-
-  def __LastResortQuery(self, query, filter_info, order_info):
-    """Last resort query plan that executes queries requring composite indexes.
-
-    Args:
-      query: The datastore_pb.Query PB.
-      filter_info: A dict mapping properties filtered on to (op, value) tuples.
-      order_info: A list of (property, direction) tuples.
-    Returns:
-      (query, params): An SQL query string and list of parameters for it.
-    """
-    if self.__require_indexes:
-      index = self.__FindIndexForQuery(query)
-      if not index:
-        raise apiproxy_errors.ApplicationError(
-            datastore_pb.Error.NEED_INDEX,
-            'This query requires a composite index that is not defined. '
-            'You must update the index.yaml file in your application root.')
-    return self.__StarSchemaQueryPlan(query, filter_info, order_info)
-
-  def __FindIndexForQuery(self, query):
-    """Finds an index that can be used to satisfy the provided query.
-
-    Args:
-      query: A datastore_pb.Query PB.
-    Returns:
-      An entity_pb.CompositeIndex PB, if a suitable index exists; otherwise None
-    """
-    unused_required, kind, ancestor, props, num_eq_filters = (
-        datastore_index.CompositeIndexForQuery(query))
-    required_key = (kind, ancestor, props)
-    indexes = self.__indexes.get(query.app(), {}).get(kind, [])
-
-    eq_filters_set = set(props[:num_eq_filters])
-    remaining_filters = props[num_eq_filters:]
-    for index in indexes:
-      definition = datastore_index.ProtoToIndexDefinition(index)
-      index_key = datastore_index.IndexToKey(definition)
-      if required_key == index_key:
-        return index
-      if num_eq_filters > 1 and (kind, ancestor) == index_key[:2]:
-        this_props = index_key[2]
-        this_eq_filters_set = set(this_props[:num_eq_filters])
-        this_remaining_filters = this_props[num_eq_filters:]
-        if (eq_filters_set == this_eq_filters_set and
-            remaining_filters == this_remaining_filters):
-          return index
-
-  _QUERY_STRATEGIES = [
-      __KindQuery,
-      __SinglePropertyQuery,
-      __MergeJoinQuery,
-      __LastResortQuery,
-  ]
-
-  def __GetQueryCursor(self, conn, query):
-    """Returns an MySQL query cursor for the provided query.
-
-    Args:
-      conn: The MySQL connection.
-      query: A datastore_pb.Query protocol buffer.
-    Returns:
-      A QueryCursor object.
-    """
-    if query.has_transaction() and not query.has_ancestor():
-      raise apiproxy_errors.ApplicationError(
-          datastore_pb.Error.BAD_REQUEST,
-          'Only ancestor queries are allowed inside transactions.')
-
-    num_components = len(query.filter_list()) + len(query.order_list())
-    if query.has_ancestor():
-      num_components += 1
-    if num_components > _MAX_QUERY_COMPONENTS:
-      raise apiproxy_errors.ApplicationError(
-          datastore_pb.Error.BAD_REQUEST,
-          ('query is too large. may not have more than %s filters'
-           ' + sort orders ancestor total' % _MAX_QUERY_COMPONENTS))
-
-    app_id = query.app()
-    self.__ValidateAppId(app_id)
-
-    filters, orders = datastore_index.Normalize(query.filter_list(),
-                                                query.order_list())
-
-    filter_info = self.__GenerateFilterInfo(filters, query)
-    order_info = self.__GenerateOrderInfo(orders)
-
-    for strategy in DatastoreMySQLStub._QUERY_STRATEGIES:
-      result = strategy(self, query, filter_info, order_info)
-      if result:
-        break
-    else:
-      raise apiproxy_errors.ApplicationError(
-          datastore_pb.Error.BAD_REQUEST,
-          'No strategy found to satisfy query.')
-
-    sql_stmt, params = result
-
-    if query.has_compiled_cursor() and query.compiled_cursor().position_size():
-      start_key, n = query.compiled_cursor().position(0).start_key().split('!')
-      new_offset = int(n)
-      query.set_offset(new_offset)
-      query.set_limit(query.limit() + new_offset)
-
-    if query.has_limit() and query.has_offset():
-      sql_stmt += ' LIMIT %i, %i' % (query.offset(), query.limit())
-      query.set_offset(0)
-    elif query.has_limit() and not query.has_offset():
-      sql_stmt += ' LIMIT %i' % query.limit()
-    
-    db_cursor = conn.cursor()
-    self._ExecuteSQL(sql_stmt, params, db_cursor)
-
-    cursor = QueryCursor(query, db_cursor)
-    if query.has_compiled_cursor() and query.compiled_cursor().position_size():
-      cursor.ResumeFromCompiledCursor(query.compiled_cursor())
-    if query.has_offset():
-      cursor.Skip(query.offset())
-
-    clone = datastore_pb.Query()
-    clone.CopyFrom(query)
-    clone.clear_hint()
-    clone.clear_limit()
-    clone.clear_count()
-    clone.clear_offset()
-    self.__query_history[clone] = self.__query_history.get(clone, 0) + 1
-
-    return cursor
-  
-  def _ExecuteSQL(self, sql_stmt, params=None, cursor=None):
-    if not cursor:
-      cursor = self.__connection.cursor()
-    
-    #start logging time
-    if self.__verbose:
-      start_time = time.time()
-    
-    #execute the statement
-    if isinstance(params,types.GeneratorType):
-      cursor.executemany(sql_stmt, params)
-    else:
-      cursor.execute(sql_stmt, params)
-    
-    #report the execution
-    if self.__verbose:
-      time_delta_ms = (time.time() - start_time) * 1000
-      if params:
-        if isinstance(params,types.GeneratorType):
-          params = [[str(x) for x in row_params] for row_params in params]
-        else:
-          params = [str(x) for x in params]
-      time_delta_health = "!" if time_delta_ms > 10 else "."
-      if time_delta_health == "!": #cheap way to filter by high latency db requests
-        logging.info("SQL (%s) (%s, %s exec, %d rows): %s w/ arguments %r"%(time_delta_health, time.time(), time_delta_ms, cursor.rowcount, sql_stmt, params))
-    
-    return cursor
-  
-  def _Dynamic_RunQuery(self, query, query_result):
-    conn = self.__GetConnection(query.transaction())
-    try:
-      cursor = self.__GetQueryCursor(conn, query)
-
-      self.__cursor_lock.acquire()
-      cursor_id = self.__next_cursor_id
-      self.__next_cursor_id += 1
-      self.__cursor_lock.release()
-
-      cursor_pb = query_result.mutable_cursor()
-      cursor_pb.set_app(query.app())
-      cursor_pb.set_cursor(cursor_id)
-
-      if query.has_count():
-        count = query.count()
-      elif query.has_limit():
-        count = query.limit()
-      else:
-        count = _BATCH_SIZE
-
-      cursor.PopulateQueryResult(count, query_result)
-      self.__cursors[cursor_pb] = cursor
-    finally:
-      self.__ReleaseConnection(conn, query.transaction())
-
-  def _Dynamic_Next(self, next_request, query_result):
-    self.__ValidateAppId(next_request.cursor().app())
-
-    try:
-      cursor = self.__cursors[next_request.cursor()]
-    except KeyError:
-      raise apiproxy_errors.ApplicationError(
-          datastore_pb.Error.BAD_REQUEST,
-          'Cursor %d not found' % next_request.cursor().cursor())
-
-    assert cursor.app == next_request.cursor().app()
-
-    count = _BATCH_SIZE
-    if next_request.has_count():
-      count = next_request.count()
-    cursor.PopulateQueryResult(count, query_result)
-
-  def _Dynamic_Count(self, query, integer64proto):
-    if query.has_limit():
-      query.set_limit(min(query.limit(), _MAXIMUM_RESULTS))
-    else:
-      query.set_limit(_MAXIMUM_RESULTS)
-
-    conn = self.__GetConnection(query.transaction())
-    try:
-      cursor = self.__GetQueryCursor(conn, query)
-      integer64proto.set_value(cursor.Count())
-    finally:
-      self.__ReleaseConnection(conn, query.transaction())
-
-  def _Dynamic_BeginTransaction(self, request, transaction):
-    self.__ValidateAppId(request.app())
-
-    self.__connection_lock.acquire()
-    assert self.__current_transaction is None
-    handle = self.__next_tx_handle
-    self.__next_tx_handle += 1
-
-    transaction.set_app(request.app())
-    transaction.set_handle(handle)
-    self.__current_transaction = handle
-    assert transaction not in self.__transactions
-    self.__transactions[transaction] = None
-    self.__tx_lock.acquire()
-
-  def _Dynamic_AddActions(self, request, _):
-
-    if ((len(self.__tx_actions) + request.add_request_size()) >
-        _MAX_ACTIONS_PER_TXN):
-      raise apiproxy_errors.ApplicationError(
-          datastore_pb.Error.BAD_REQUEST,
-          'Too many messages, maximum allowed %s' % _MAX_ACTIONS_PER_TXN)
-
-    new_actions = []
-    for add_request in request.add_request_list():
-      self.__ValidateTransaction(add_request.transaction())
-      clone = taskqueue_service_pb.TaskQueueAddRequest()
-      clone.CopyFrom(add_request)
-      clone.clear_transaction()
-      new_actions.append(clone)
-
-    self.__tx_actions.extend(new_actions)
-
-  def _Dynamic_Commit(self, transaction, _):
-    assert self.__current_transaction == transaction.handle()
-    conn = self.__connection
-
-    try:
-      self.__PutEntities(conn, self.__tx_writes.values())
-      self.__DeleteEntities(conn, self.__tx_deletes)
-
-      for action in self.__tx_actions:
-        try:
-          apiproxy_stub_map.MakeSyncCall(
-              'taskqueue', 'Add', action, api_base_pb.VoidProto())
-        except apiproxy_errors.ApplicationError, e:
-          logging.warning('Transactional task %s has been dropped, %s',
-                          action, e)
-    finally:
-      self.__current_transaction = None
-      self.__tx_actions = []
-      self.__tx_writes = {}
-      self.__tx_deletes = set()
-      self.__ReleaseConnection(conn, None)
-      self.__ReleaseLockForEntityGroup(self.__connection,
-                                       self.__transactions[transaction] or '')
-      del self.__transactions[transaction]
-      self.__inside_tx = False
-      self.__tx_lock.release()
-
-  def _Dynamic_Rollback(self, transaction, _):
-    conn = self.__GetConnection(transaction)
-    self.__current_transaction = None
-    self.__tx_actions = []
-    self.__tx_writes = {}
-    self.__tx_deletes = set()
-    self.__ReleaseConnection(conn, None, True)
-    self.__ReleaseLockForEntityGroup(self.__connection,
-                                     self.__transactions[transaction] or '')
-    del self.__transactions[transaction]
-    self.__inside_tx = False
-    self.__tx_lock.release()
-
-  def _Dynamic_GetSchema(self, req, schema):
-    conn = self.__GetConnection(None)
-    try:
-      prefix = self.__GetTablePrefix(req)
-
-      filters = []
-      if req.has_start_kind():
-        filters.append(('kind', datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL,
-                        req.start_kind()))
-      if req.has_end_kind():
-        filters.append(('kind', datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL,
-                        req.end_kind()))
-
-      params = []
-      if req.properties():
-        sql_stmt = ('SELECT kind, name, value FROM %s_EntitiesByProperty %s '
-                    'GROUP BY kind, name, substr(value, 1, 1) ORDER BY kind'
-                    % (prefix, self.__CreateFilterString(filters, params)))
-      else:
-        sql_stmt = ('SELECT kind FROM %s_Entities %s GROUP BY kind'
-                    % (prefix, self.__CreateFilterString(filters, params)))
-      cursor = conn.cursor()
-      self._ExecuteSQL(sql_stmt, params, cursor)
-
-      kind = None
-      current_name = None
-      kind_pb = None
-      for row in cursor.fetchall():
-        if row[0] != kind:
-          if kind_pb:
-            schema.kind_list().append(kind_pb)
-          kind = row[0].encode('utf-8')
-          kind_pb = entity_pb.EntityProto()
-          kind_pb.mutable_key().set_app(req.app())
-          kind_pb.mutable_key().mutable_path().add_element().set_type(kind)
-          kind_pb.mutable_entity_group()
-
-        if req.properties():
-          name, value_data = row[1:]
-          if current_name != name:
-            current_name = name
-            prop_pb = kind_pb.add_property()
-            prop_pb.set_name(name.encode('utf-8'))
-            prop_pb.set_multiple(False)
-          value_decoder = sortable_pb_encoder.Decoder(
-              array.array('B', str(value_data)))
-          value_pb = prop_pb.mutable_value()
-          value_pb.Merge(value_decoder)
-
-          if value_pb.has_int64value():
-            value_pb.set_int64value(0)
-          if value_pb.has_booleanvalue():
-            value_pb.set_booleanvalue(False)
-          if value_pb.has_stringvalue():
-            value_pb.set_stringvalue('none')
-          if value_pb.has_doublevalue():
-            value_pb.set_doublevalue(0.0)
-          if value_pb.has_pointvalue():
-            value_pb.mutable_pointvalue().set_x(0.0)
-            value_pb.mutable_pointvalue().set_y(0.0)
-          if value_pb.has_uservalue():
-            value_pb.mutable_uservalue().set_gaiaid(0)
-            value_pb.mutable_uservalue().set_email('none')
-            value_pb.mutable_uservalue().set_auth_domain('none')
-            value_pb.mutable_uservalue().clear_nickname()
-            value_pb.mutable_uservalue().clear_obfuscated_gaiaid()
-          if value_pb.has_referencevalue():
-            value_pb.clear_referencevalue()
-            value_pb.mutable_referencevalue().set_app('none')
-            pathelem = value_pb.mutable_referencevalue().add_pathelement()
-            pathelem.set_type('none')
-            pathelem.set_name('none')
-
-      if kind_pb:
-        schema.kind_list().append(kind_pb)
-    finally:
-      self.__ReleaseConnection(conn, None)
-
-  def _Dynamic_AllocateIds(self, allocate_ids_request, allocate_ids_response):
-    conn = self.__GetConnection(None)
-
-    model_key = allocate_ids_request.model_key()
-    size = allocate_ids_request.size()
-
-    self.__ValidateAppId(model_key.app())
-
-    first_id = self.__AllocateIds(conn, self.__GetTablePrefix(model_key), size)
-    allocate_ids_response.set_start(first_id)
-    allocate_ids_response.set_end(first_id + size - 1)
-
-    self.__ReleaseConnection(conn, None)
-
-  def __FindIndex(self, index):
-    """Finds an existing index by definition.
-
-    Args:
-      index: entity_pb.CompositeIndex
-
-    Returns:
-      entity_pb.CompositeIndex, if it exists; otherwise None
-    """
-    app_indexes = self.__indexes.get(index.app_id(), {})
-    for stored_index in app_indexes.get(index.definition().entity_type(), []):
-      if index.definition() == stored_index.definition():
-        return stored_index
-
-    return None
-
-  def _Dynamic_CreateIndex(self, index, id_response):
-    app_id = index.app_id()
-    kind = index.definition().entity_type()
-
-    self.__ValidateAppId(app_id)
-    if index.id() != 0:
-      raise apiproxy_errors.ApplicationError(datastore_pb.Error.BAD_REQUEST,
-                                             'New index id must be 0.')
-
-    self.__index_lock.acquire()
-    try:
-      if self.__FindIndex(index):
-        raise apiproxy_errors.ApplicationError(datastore_pb.Error.BAD_REQUEST,
-                                               'Index already exists.')
-
-      next_id = max([idx.id() for x in self.__indexes.get(app_id, {}).values()
-                     for idx in x] + [0]) + 1
-      index.set_id(next_id)
-      id_response.set_value(next_id)
-
-      clone = entity_pb.CompositeIndex()
-      clone.CopyFrom(index)
-      self.__indexes.setdefault(app_id, {}).setdefault(kind, []).append(clone)
-
-      conn = self.__GetConnection(None)
-      try:
-        self.__WriteIndexData(conn, app_id)
-      finally:
-        self.__ReleaseConnection(conn, None)
-    finally:
-      self.__index_lock.release()
-
-  def _Dynamic_GetIndices(self, app_str, composite_indices):
-    self.__ValidateAppId(app_str.value())
-
-    index_list = composite_indices.index_list()
-    for indexes in self.__indexes.get(app_str.value(), {}).values():
-      index_list.extend(indexes)
-
-  def _Dynamic_UpdateIndex(self, index, _):
-    self.__ValidateAppId(index.app_id())
-    my_index = self.__FindIndex(index)
-    if not my_index:
-      raise apiproxy_errors.ApplicationError(datastore_pb.Error.BAD_REQUEST,
-                                             "Index doesn't exist.")
-    elif (index.state() != my_index.state() and
-          index.state() not in self._INDEX_STATE_TRANSITIONS[my_index.state()]):
-      raise apiproxy_errors.ApplicationError(
-          datastore_pb.Error.BAD_REQUEST,
-          'Cannot move index state from %s to %s' %
-          (entity_pb.CompositeIndex.State_Name(my_index.state()),
-           (entity_pb.CompositeIndex.State_Name(index.state()))))
-
-    self.__index_lock.acquire()
-    try:
-      my_index.set_state(index.state())
-    finally:
-      self.__index_lock.release()
-
-  def _Dynamic_DeleteIndex(self, index, _):
-    app_id = index.app_id()
-    kind = index.definition().entity_type()
-    self.__ValidateAppId(app_id)
-
-    my_index = self.__FindIndex(index)
-    if not my_index:
-      raise apiproxy_errors.ApplicationError(datastore_pb.Error.BAD_REQUEST,
-                                             "Index doesn't exist.")
-
-    conn = self.__GetConnection(None)
-    try:
-      self.__WriteIndexData(conn, app_id)
-    finally:
-      self.__ReleaseConnection(conn, None)
-    self.__index_lock.acquire()
-    try:
-      self.__indexes[app_id][kind].remove(my_index)
-    finally:
-      self.__index_lock.release()
+#!/usr/bin/env python
+#
+# Copyright 2007 Google Inc.
+# Copyright 2010 Tobias Rodaebel, Jean-Marc Skopek (Top Hat Monocle)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""MySQL-based stub for the Python datastore API.
+
+Entities are stored in a MySQL database in a similar fashion to the production
+datastore.
+
+Substantial portions of this code are taken from Nick Johnson's SQLite
+Datastore stub.
+"""
+
+
+import array
+import bisect
+import itertools
+import logging
+import md5
+import os
+import Queue
+import re
+import struct
+import sys
+import thread
+import threading
+import time
+import types
+
+from google.appengine.datastore import entity_pb
+from google.appengine.api import apiproxy_rpc
+from google.appengine.api import apiproxy_stub
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import datastore_errors
+from google.appengine.datastore import datastore_index
+from google.appengine.datastore import datastore_pb
+from google.appengine.datastore import sortable_pb_encoder
+from google.appengine.runtime import apiproxy_errors
+
+import MySQLdb
+import MySQLdb.cursors
+from MySQLdb.constants import CLIENT
+
+try:
+  __import__('google.appengine.api.labs.taskqueue.taskqueue_service_pb')
+  taskqueue_service_pb = sys.modules.get(
+      'google.appengine.api.labs.taskqueue.taskqueue_service_pb')
+except ImportError:
+  from google.appengine.api.taskqueue import taskqueue_service_pb
+
+
+import __builtin__
+buffer = __builtin__.buffer
+
+
+entity_pb.Reference.__hash__ = lambda self: hash(self.Encode())
+datastore_pb.Query.__hash__ = lambda self: hash(self.Encode())
+datastore_pb.Transaction.__hash__ = lambda self: hash(self.Encode())
+datastore_pb.Cursor.__hash__ = lambda self: hash(self.Encode())
+
+
+_MAXIMUM_RESULTS = 1000
+
+
+_MAX_QUERY_COMPONENTS = 63
+
+
+_BATCH_SIZE = 20
+
+
+_MAX_ACTIONS_PER_TXN = 5
+
+
+_MAX_TASKS_PER_BULK_ADD = 100
+
+
+_MAX_TIMEOUT = 5.0
+
+
+_MAX_IN_CLAUSE_SIZE = 500
+
+
+_DEFAULT_POOL_SIZE = 8
+
+
+_DEFAULT_ENTITY_CACHE_BYTES = 16 * 1024 * 1024
+
+
+_DEFAULT_POOL_TIMEOUT = 30.0
+
+
+_POOL_RECLAIM_INTERVAL = 1.0
+
+
+_DEFAULT_MAX_CURSORS = 1000
+
+
+_DEFAULT_CURSOR_BYTES = 64 * 1024 * 1024
+
+
+_DEFAULT_CURSOR_TTL = 600.0
+
+
+_SEEN_ENTRY_OVERHEAD = 64
+
+
+_DEFAULT_ASYNC_WORKERS = 4
+
+
+_LOCK_CONFLICT_ERRORS = frozenset((1205, 1213, 3058))
+
+
+_MAX_COMMIT_BATCH_BYTES = 1024 * 1024
+
+
+# Characters that MySQL string literals escape with a backslash.
+_ESCAPED_CHARS = ('\x00', '\n', '\r', '\\', "'", '"', '\x1a')
+
+
+# Values of enum_mysql_set_option in the MySQL client library.
+_MYSQL_OPTION_MULTI_STATEMENTS_ON = 0
+_MYSQL_OPTION_MULTI_STATEMENTS_OFF = 1
+
+
+_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                    1.0, 2.5, 5.0, 10.0)
+
+
+_DEFAULT_SLOW_SQL_THRESHOLD = 0.01
+
+
+_MAX_SQL_FINGERPRINTS = 10000
+
+
+_SQL_NORMALIZATIONS = [
+    (re.compile(r'\b\w+?_(Entities|EntitiesByProperty|CompositeIndex)'
+                r'(?:_\d+)?\b'), r'?_\1'),
+    (re.compile(r"'(?:[^'\\]|\\.|'')*'"), '?'),
+    (re.compile(r'%s|\b\d+\b'), '?'),
+    (re.compile(r'\s+'), ' '),
+    (re.compile(r'\( ?\?(?: ?, ?\?)* ?\)'), '(?+)'),
+    (re.compile(r'\(\?\+\)(?: ?, ?\(\?\+\))+'), '(?+), ...'),
+]
+
+
+_RPC_LOG_MAGIC = 'DSRPCLOG1\n'
+
+
+_RPC_LOG_RECORD = struct.Struct('>ddQ?HII')
+
+
+_RECORDED_RESPONSES = frozenset(('BeginTransaction', 'RunQuery'))
+
+
+_ENTITY_COUNTERS = {
+    'Put': lambda request, response: response.key_size(),
+    'Get': lambda request, response: sum(
+        1 for group in response.entity_list() if group.has_entity()),
+    'Delete': lambda request, response: request.key_size(),
+    'RunQuery': lambda request, response: response.result_size(),
+    'Next': lambda request, response: response.result_size(),
+}
+
+
+_OPERATOR_MAP = {
+    datastore_pb.Query_Filter.LESS_THAN: '<',
+    datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL: '<=',
+    datastore_pb.Query_Filter.EQUAL: '=',
+    datastore_pb.Query_Filter.GREATER_THAN: '>',
+    datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL: '>=',
+}
+
+
+_REVERSED_OPERATOR_MAP = {
+    datastore_pb.Query_Filter.LESS_THAN:
+        datastore_pb.Query_Filter.GREATER_THAN,
+    datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL:
+        datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL,
+    datastore_pb.Query_Filter.GREATER_THAN:
+        datastore_pb.Query_Filter.LESS_THAN,
+    datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL:
+        datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL,
+}
+
+
+_SEEK_OPERATOR_MAP = {
+    datastore_pb.Query_Order.ASCENDING: '>',
+    datastore_pb.Query_Order.DESCENDING: '<',
+}
+
+
+_ORDER_MAP = {
+    datastore_pb.Query_Order.ASCENDING: 'ASC',
+    datastore_pb.Query_Order.DESCENDING: 'DESC',
+}
+
+_CORE_SCHEMA = ["""
+CREATE TABLE IF NOT EXISTS Apps (
+  app_id VARCHAR(255) NOT NULL PRIMARY KEY,
+  indexes MEDIUMBLOB
+) ENGINE=InnoDB;
+""","""
+CREATE TABLE IF NOT EXISTS Namespaces (
+  app_id VARCHAR(255) NOT NULL,
+  name_space VARCHAR(255) NOT NULL,
+  PRIMARY KEY (app_id, name_space)
+) ENGINE=InnoDB;
+""","""
+CREATE TABLE IF NOT EXISTS IdSeq (
+  prefix VARCHAR(255) NOT NULL PRIMARY KEY,
+  next_id INT(100) NOT NULL
+) ENGINE=InnoDB;
+""","""
+CREATE TABLE IF NOT EXISTS EntityGroupVersions (
+  entity_group CHAR(36) NOT NULL PRIMARY KEY,
+  version BIGINT NOT NULL
+) ENGINE=InnoDB;
+"""]
+
+_NAMESPACE_SCHEMA = ["""
+CREATE TABLE `%(prefix)s_Entities` (
+  `__path__` varchar(255) NOT NULL,
+  `kind` varchar(255) NOT NULL,
+  `entity` longblob NOT NULL,
+  PRIMARY KEY (`__path__`)
+) ENGINE=InnoDB;
+""","""
+CREATE TABLE `%(prefix)s_EntitiesByProperty` (
+    `kind` varchar(255) NOT NULL,
+    `name` varchar(255) NOT NULL,
+    `value` MEDIUMBLOB DEFAULT NULL,
+    `__path__` varchar(255) NOT NULL,
+    `hashed_index` char(32) NOT NULL,
+    PRIMARY KEY (`hashed_index`),
+    INDEX(value(32)),
+    KEY `i1` (`kind`,`name`),
+    KEY `i2` (`__path__`)
+) ENGINE=InnoDB;
+""","""
+INSERT IGNORE INTO Apps (app_id) VALUES ('%(app_id)s');
+""","""
+INSERT INTO Namespaces (app_id, name_space)
+  VALUES ('%(app_id)s', '%(name_space)s');
+""","""
+INSERT IGNORE INTO IdSeq VALUES ('%(prefix)s', 1);
+"""]
+
+_COMPOSITE_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS `%(table)s` (
+    `sort_key` MEDIUMBLOB NOT NULL,
+    `__path__` varchar(255) NOT NULL,
+    `hashed_index` char(32) NOT NULL,
+    PRIMARY KEY (`hashed_index`),
+    INDEX(sort_key(255)),
+    KEY `i1` (`__path__`)
+) ENGINE=InnoDB;
+"""
+
+_INVERTED_BYTES = ''.join(chr(255 - i) for i in xrange(256))
+
+_PATH_SPECIAL_CHARS = re.compile(r'[~!:]')
+
+_PATH_ESCAPE_SEQUENCES = re.compile(r'~([0-9a-f]{2})')
+
+def formatTableName(tableName):
+    import re
+    return re.sub("[^\w\d_]","",tableName)
+
+def EncodeSortKeyComponent(value, direction):
+  """Encodes one component of a sort key.
+
+  Components are escaped and terminated, so that concatenated components
+  sort like the tuple of their values. Descending components have all of
+  their bytes inverted.
+
+  Args:
+    value: An encoded index value, as returned by __EncodeIndexPB.
+    direction: An entity_pb.Index_Property or datastore_pb.Query_Order
+      direction; both enums use the same values.
+  Returns:
+    The encoded component.
+  """
+  component = str(value).replace('\x00', '\x00\xff') + '\x00\x01'
+  if direction == entity_pb.Index_Property.DESCENDING:
+    component = component.translate(_INVERTED_BYTES)
+  return component
+
+def DecodeSortKey(sort_key, directions):
+  """Splits a sort key built by EncodeSortKeyComponent into its values.
+
+  Args:
+    sort_key: The concatenated components.
+    directions: The direction of each component.
+  Returns:
+    A list of values, one per direction.
+  Raises:
+    ValueError: if the sort key does not have exactly one component per
+      direction.
+  """
+  values = []
+  start = 0
+  for direction in directions:
+    if direction == entity_pb.Index_Property.DESCENDING:
+      end = sort_key.find('\xff\xfe', start)
+      component = sort_key[start:end].translate(_INVERTED_BYTES)
+    else:
+      end = sort_key.find('\x00\x01', start)
+      component = sort_key[start:end]
+    if end < 0:
+      raise ValueError('Truncated sort key')
+    values.append(component.replace('\x00\xff', '\x00'))
+    start = end + 2
+  if start != len(sort_key):
+    raise ValueError('Trailing data in sort key')
+  return values
+
+def ReferencePropertyToReference(refprop):
+  ref = entity_pb.Reference()
+  ref.set_app(refprop.app())
+  if refprop.has_name_space():
+    ref.set_name_space(refprop.name_space())
+  for pathelem in refprop.pathelement_list():
+    ref.mutable_path().add_element().CopyFrom(pathelem)
+  return ref
+
+def _EscapePathPart(value, is_name):
+  """Escapes a kind or key name for use in an encoded path.
+
+  Values that contain a separator or start with ~, and names that start with
+  a digit, are prefixed with ~ and have the characters ~, ! and : hex-escaped.
+  All other values are used as they are.
+  """
+  if ('!' in value or ':' in value or value[:1] == '~' or
+      (is_name and value[:1].isdigit())):
+    return '~' + _PATH_SPECIAL_CHARS.sub(
+        lambda match: '~%02x' % ord(match.group()), value)
+  return value
+
+def _UnescapePathPart(value):
+  """Reverses _EscapePathPart."""
+  if value[:1] != '~':
+    return value
+  return _PATH_ESCAPE_SEQUENCES.sub(
+      lambda match: chr(int(match.group(1), 16)), value[1:])
+
+def EncodePath(path):
+  """Encodes an entity_pb.Path as the __path__ of an entity.
+
+  Elements are joined by ! and consist of the kind and the id or name,
+  separated by :. Ids are zero-padded, so that they sort numerically, and
+  escaped names never start with a digit, so that DecodePath can tell them
+  apart.
+
+  Args:
+    path: An entity_pb.Path.
+  Returns:
+    The encoded path.
+  """
+  elements = []
+  for e in path.element_list():
+    if e.has_name():
+      id_or_name = _EscapePathPart(e.name(), True)
+    else:
+      id_or_name = str(e.id()).zfill(10)
+    elements.append('%s:%s' % (_EscapePathPart(e.type(), False), id_or_name))
+  return '!'.join(elements)
+
+def DecodePath(encoded, path):
+  """Decodes a path encoded by EncodePath.
+
+  Args:
+    encoded: The encoded path.
+    path: The entity_pb.Path to add the elements to.
+  """
+  for element in encoded.split('!'):
+    kind, id_or_name = element.split(':', 1)
+    e = path.add_element()
+    e.set_type(_UnescapePathPart(kind))
+    if id_or_name[:1].isdigit():
+      e.set_id(int(id_or_name))
+    else:
+      e.set_name(_UnescapePathPart(id_or_name))
+
+def EncodeSortable(pb):
+  """Encodes a protocol buffer with the generic sortable_pb_encoder.
+
+  Args:
+    pb: A protocol buffer message.
+  Returns:
+    The sortable encoding as a string.
+  """
+  encoder = sortable_pb_encoder.Encoder()
+  pb.Output(encoder)
+  return encoder.buffer().tostring()
+
+def _SortableTag(tag):
+  encoder = sortable_pb_encoder.Encoder()
+  encoder.putVarInt32(tag)
+  return encoder.buffer().tostring()
+
+# The sortable_pb_encoder writes small integers as one byte; larger ones as
+# a head byte carrying sign and length, followed by big endian bytes which
+# are inverted for negative numbers.
+_SORTABLE_MAX_INLINE = 119
+_SORTABLE_INLINE_INTS = tuple(
+    chr(9 + i) for i in xrange(2 * _SORTABLE_MAX_INLINE + 1))
+_SORTABLE_INT64_RANGE = (-(1 << 63), (1 << 63) - 1)
+
+# Field tags of entity_pb.PropertyValue, encoded once.
+_SORTABLE_TAG_INT64 = _SortableTag(8)
+_SORTABLE_TAG_BOOLEAN = _SortableTag(16)
+_SORTABLE_TAG_STRING = _SortableTag(26)
+_SORTABLE_TAG_DOUBLE = _SortableTag(33)
+_SORTABLE_TAG_REFERENCE = _SortableTag(99)
+_SORTABLE_TAG_REFERENCE_END = _SortableTag(100)
+_SORTABLE_TAG_APP = _SortableTag(106)
+_SORTABLE_TAG_ELEMENT = _SortableTag(115)
+_SORTABLE_TAG_ELEMENT_END = _SortableTag(116)
+_SORTABLE_TAG_TYPE = _SortableTag(122)
+_SORTABLE_TAG_ID = _SortableTag(128)
+_SORTABLE_TAG_NAME = _SortableTag(138)
+
+_SORTABLE_BOOLEANS = {True: _SORTABLE_TAG_BOOLEAN + '\x01',
+                      False: _SORTABLE_TAG_BOOLEAN + '\x00'}
+
+_DOUBLE_STRUCT = struct.Struct('>d')
+_UINT64_STRUCT = struct.Struct('>Q')
+
+def _SortableVarInt(value):
+  if -_SORTABLE_MAX_INLINE <= value <= _SORTABLE_MAX_INLINE:
+    return _SORTABLE_INLINE_INTS[value + _SORTABLE_MAX_INLINE]
+  if value < 0:
+    value = -_SORTABLE_MAX_INLINE - value
+    length = (value.bit_length() + 7) >> 3
+    value = (1 << (length << 3)) - 1 - value
+    head = chr(9 - length)
+  else:
+    value -= _SORTABLE_MAX_INLINE
+    length = (value.bit_length() + 7) >> 3
+    head = chr(9 + 2 * _SORTABLE_MAX_INLINE + length)
+  return head + _UINT64_STRUCT.pack(value)[8 - length:]
+
+def _SortableString(value):
+  return value.replace('\x01', '\x01\x02').replace('\x00', '\x01\x01') + '\x00'
+
+def _EncodeSortableInt64(value):
+  value = value.int64value()
+  if not _SORTABLE_INT64_RANGE[0] < value < _SORTABLE_INT64_RANGE[1]:
+    return None
+  return _SORTABLE_TAG_INT64 + _SortableVarInt(value)
+
+def _EncodeSortableBoolean(value):
+  return _SORTABLE_BOOLEANS[bool(value.booleanvalue())]
+
+def _EncodeSortableString(value):
+  return _SORTABLE_TAG_STRING + _SortableString(value.stringvalue())
+
+def _EncodeSortableDouble(value):
+  value = value.doublevalue()
+  bits = _UINT64_STRUCT.unpack(_DOUBLE_STRUCT.pack(value))[0]
+  if value < 0:
+    bits ^= 0xffffffffffffffff
+  else:
+    bits |= 0x8000000000000000
+  return _SORTABLE_TAG_DOUBLE + _UINT64_STRUCT.pack(bits)
+
+def _EncodeSortableReference(value):
+  ref = value.referencevalue()
+  if ref.has_name_space():
+    return None
+  parts = [_SORTABLE_TAG_REFERENCE, _SORTABLE_TAG_APP,
+           _SortableString(ref.app())]
+  for element in ref.pathelement_list():
+    parts.append(_SORTABLE_TAG_ELEMENT)
+    parts.append(_SORTABLE_TAG_TYPE)
+    parts.append(_SortableString(element.type()))
+    if element.has_id():
+      element_id = element.id()
+      if not _SORTABLE_INT64_RANGE[0] < element_id < _SORTABLE_INT64_RANGE[1]:
+        return None
+      parts.append(_SORTABLE_TAG_ID)
+      parts.append(_SortableVarInt(element_id))
+    if element.has_name():
+      parts.append(_SORTABLE_TAG_NAME)
+      parts.append(_SortableString(element.name()))
+    parts.append(_SORTABLE_TAG_ELEMENT_END)
+  parts.append(_SORTABLE_TAG_REFERENCE_END)
+  return ''.join(parts)
+
+_FAST_SORTABLE_ENCODERS = {
+    'int64': _EncodeSortableInt64,
+    'boolean': _EncodeSortableBoolean,
+    'string': _EncodeSortableString,
+    'double': _EncodeSortableDouble,
+    'reference': _EncodeSortableReference,
+}
+
+def _SortableValueType(value):
+  """Returns the fast encoder type of an entity_pb.PropertyValue or None.
+
+  PropertyValues built by the datastore API set at most one value field;
+  values setting several are left to the generic encoder.
+  """
+  value_type = None
+  for has_field, field_type in ((value.has_stringvalue, 'string'),
+                                (value.has_int64value, 'int64'),
+                                (value.has_booleanvalue, 'boolean'),
+                                (value.has_doublevalue, 'double'),
+                                (value.has_referencevalue, 'reference'),
+                                (value.has_pointvalue, None),
+                                (value.has_uservalue, None)):
+    if has_field():
+      if value_type is not None:
+        return None
+      value_type = field_type or ''
+  return value_type or None
+
+def FastEncodeSortable(value):
+  """Encodes common property values without the generic encoder.
+
+  Produces the same bytes as EncodeSortable for int64, boolean, string,
+  double and reference values, which SortableEncodingTestCase verifies
+  against the SDK's encoder.
+
+  Args:
+    value: An entity_pb.PropertyValue.
+  Returns:
+    The sortable encoding as a string, or None if the value has no fast path.
+  """
+  value_type = _SortableValueType(value)
+  if value_type is None:
+    return None
+  return _FAST_SORTABLE_ENCODERS[value_type](value)
+
+
+class QueryCursor(object):
+  """Encapsulates a database cursor and provides methods to fetch results."""
+
+  def __init__(self, query, db_cursor, directions, start_key='',
+               release=None):
+    """Constructor.
+
+    Args:
+      query: A Query PB.
+      db_cursor: An MySQL cursor returning n+2 columns. The first 2 columns
+        must be the path of the entity and the entity itself, or NULL for keys
+        only queries, whose keys are decoded from the path. The remaining
+        columns must be the sort columns for the query.
+      directions: The direction of each sort column.
+      start_key: The position the query resumes from, if any.
+      release: A function to call once the cursor is closed, with True if
+        the result set was not read to the end. Used by streaming cursors to
+        give back their connection.
+    """
+    self.__query = query
+    self.app = query.app()
+    self.__cursor = db_cursor
+    self.__directions = directions
+    self.__release = release
+    self.__rows = []
+    self.__batch_size = _BATCH_SIZE
+    self.__exhausted = False
+    self.__seen = set()
+    self.__seen_bytes = 0
+    self.__rows_fetched = 0
+    self.__rows_read = 0
+    self.__bytes_read = 0
+
+    self.__position = start_key
+
+    if query.has_end_compiled_cursor():
+      self.__end_key = query.end_compiled_cursor().position(0).start_key()
+    else:
+      self.__end_key = None
+
+    if query.has_limit():
+      self.limit = query.limit() + query.offset()
+    else:
+      self.limit = None
+
+  def _EncodeCompiledCursor(self, cc):
+    """Encodes the current position in the query as a compiled cursor.
+
+    The position is the sort columns of the last row returned, encoded so that
+    positions compare in result order.
+
+    Args:
+      cc: The compiled cursor to fill out.
+    """
+    position = cc.add_position()
+    position.set_start_key(self.__position)
+
+  def _GetResult(self):
+    """Returns the next result from the result set, without deduplication.
+
+    Returns:
+      (path, value): The path and value of the next result.
+    """
+    if not self.__cursor:
+      return None, None
+    if not self.__rows:
+      self.__rows = list(self.__cursor.fetchmany(self.__batch_size))
+      self.__rows.reverse()
+      self.__rows_fetched += len(self.__rows)
+    if not self.__rows:
+      self.__exhausted = True
+      self.Close()
+      return None, None
+    row = self.__rows.pop()
+    path, data, position_parts = str(row[0]), row[1], row[2:]
+    self.__rows_read += 1
+    self.__bytes_read += len(path) + len(data or '')
+    position = ''.join(EncodeSortKeyComponent(value, direction)
+                       for value, direction
+                       in zip(position_parts, self.__directions))
+
+    if self.__end_key and position > self.__end_key:
+      self.Close()
+      return None, None
+
+    self.__position = position
+    return path, data
+
+  def EstimateSize(self):
+    """Estimates the memory held by the cursor.
+
+    Accounts for the paths of the results returned so far, which are kept
+    for deduplication, and for the rows buffered on the client, sized like
+    the average row read so far.
+
+    Returns:
+      int: The estimated size in bytes.
+    """
+    buffered = len(self.__rows)
+    if self.__cursor and not self.__release:
+      buffered += max(self.__cursor.rowcount - self.__rows_fetched, 0)
+    average = self.__bytes_read / max(self.__rows_read, 1)
+    return self.__seen_bytes + buffered * average
+
+  def Close(self, drain=False):
+    """Closes the cursor and releases the resources held for it.
+
+    Args:
+      drain: If True, the remaining rows are read, which lets a streaming
+        cursor give its connection back for reuse. Only worth it when the
+        query's LIMIT bounds the number of remaining rows.
+    """
+    if drain and self.__cursor and not self.__exhausted:
+      try:
+        while self.__cursor.fetchmany(self.__batch_size):
+          pass
+        self.__exhausted = True
+      except MySQLdb.Error:
+        pass
+    self.__cursor = None
+    self.__rows = []
+    self.__seen = set()
+    self.__seen_bytes = 0
+    if self.__release:
+      release, self.__release = self.__release, None
+      release(not self.__exhausted)
+
+  def _Next(self):
+    """Fetches the next unique result from the result set.
+
+    Returns:
+      A datastore_pb.EntityProto instance.
+    """
+    entity = None
+    while self.__cursor and not entity:
+      path, data = self._GetResult()
+      if path and path not in self.__seen:
+        self.__seen.add(path)
+        self.__seen_bytes += len(path) + _SEEN_ENTRY_OVERHEAD
+        if data is None:
+          entity = self.__EntityFromPath(path)
+        else:
+          entity = entity_pb.EntityProto(data)
+    return entity
+
+  def __EntityFromPath(self, path):
+    """Builds the result of a keys only query from an entity's path.
+
+    Args:
+      path: The path of the entity, as encoded by EncodePath.
+    Returns:
+      A datastore_pb.EntityProto instance with only its key and entity group
+      set.
+    """
+    entity = entity_pb.EntityProto()
+    key = entity.mutable_key()
+    key.set_app(self.app)
+    if self.__query.has_name_space():
+      key.set_name_space(self.__query.name_space())
+    DecodePath(path, key.mutable_path())
+    entity.mutable_entity_group().add_element().CopyFrom(
+        key.path().element(0))
+    return entity
+
+  def Skip(self, count):
+    """Skips the specified number of unique results.
+
+    Args:
+      count: Number of results to skip.
+    """
+    for unused_i in xrange(count):
+      self._Next()
+
+  def PopulateQueryResult(self, count, result):
+    """Populates a QueryResult PB with results from the cursor.
+
+    Args:
+      count: The number of results to retrieve.
+      result: out: A query_result PB.
+    """
+    if count > _MAXIMUM_RESULTS:
+      count = _MAXIMUM_RESULTS
+    self.__batch_size = max(count, 1)
+
+    result.set_keys_only(self.__query.keys_only())
+
+    result_list = result.result_list()
+    try:
+      while len(result_list) < count:
+        if self.limit is not None and len(self.__seen) >= self.limit:
+          break
+        entity = self._Next()
+        if entity is None:
+          break
+        result_list.append(entity)
+    except:
+      self.Close()
+      raise
+    if self.limit is not None and len(self.__seen) >= self.limit:
+      self.Close(drain=True)
+
+    result.set_more_results(len(result_list) == count)
+    self._EncodeCompiledCursor(result.mutable_compiled_cursor())
+
+
+class ConnectionPool(object):
+  """A bounded pool of MySQL connections.
+
+  Connections handed out by Acquire are bound to the calling thread: nested
+  Acquire calls from the same thread return the same connection until the
+  outermost Release. Connections handed out by Checkout are not bound to any
+  thread, which makes them suitable for pinning to a transaction.
+  """
+
+  def __init__(self, connect_args, size, timeout, reclaim=None,
+               on_connect=None):
+    """Constructor.
+
+    Args:
+      connect_args: A dict of keyword arguments for MySQLdb.connect.
+      size: The maximum number of open connections.
+      timeout: Number of seconds to wait for a free connection.
+      reclaim: A function called without arguments while a checkout waits
+        for a free connection, at least every _POOL_RECLAIM_INTERVAL
+        seconds. It may give back connections held by idle users.
+      on_connect: A function called with each newly opened connection.
+    """
+    self.__connect_args = connect_args
+    self.__size = size
+    self.__timeout = timeout
+    self.__reclaim = reclaim
+    self.__on_connect = on_connect
+    self.__idle = []
+    self.__num_open = 0
+    self.__condition = threading.Condition(threading.Lock())
+    self.__local = threading.local()
+
+  def Checkout(self):
+    """Checks out a connection that is not bound to the calling thread.
+
+    Returns:
+      A MySQL connection object.
+
+    Raises:
+      apiproxy_errors.ApplicationError: if no connection became available
+        within the pool timeout.
+    """
+    deadline = time.time() + self.__timeout
+    self.__condition.acquire()
+    try:
+      while not self.__idle and self.__num_open >= self.__size:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          raise apiproxy_errors.ApplicationError(
+              datastore_pb.Error.TIMEOUT,
+              'Timed out waiting for a MySQL connection.')
+        if self.__reclaim:
+          # Connections are checked in under the condition's lock.
+          self.__condition.release()
+          try:
+            self.__reclaim()
+          finally:
+            self.__condition.acquire()
+          if self.__idle or self.__num_open < self.__size:
+            break
+          remaining = min(deadline - time.time(), _POOL_RECLAIM_INTERVAL)
+          if remaining <= 0:
+            continue
+        self.__condition.wait(remaining)
+      if self.__idle:
+        return self.__idle.pop()
+      self.__num_open += 1
+    finally:
+      self.__condition.release()
+
+    try:
+      conn = MySQLdb.connect(**self.__connect_args)
+    except:
+      self.__Discarded()
+      raise
+    if self.__on_connect:
+      try:
+        self.__on_connect(conn)
+      except:
+        self.Checkin(conn, discard=True)
+        raise
+    return conn
+
+  def Checkin(self, conn, discard=False):
+    """Returns a connection obtained from Checkout to the pool.
+
+    Args:
+      conn: A MySQL connection object.
+      discard: If True, the connection is closed instead of being reused.
+    """
+    if discard:
+      try:
+        conn.close()
+      finally:
+        self.__Discarded()
+      return
+
+    self.__condition.acquire()
+    try:
+      self.__idle.append(conn)
+      self.__condition.notify()
+    finally:
+      self.__condition.release()
+
+  def __Discarded(self):
+    """Accounts for a connection that was closed or failed to open."""
+    self.__condition.acquire()
+    try:
+      self.__num_open -= 1
+      self.__condition.notify()
+    finally:
+      self.__condition.release()
+
+  def Acquire(self):
+    """Returns the calling thread's connection, checking one out if needed.
+
+    Returns:
+      A MySQL connection object.
+    """
+    depth = getattr(self.__local, 'depth', 0)
+    if not depth:
+      self.__local.conn = self.Checkout()
+    self.__local.depth = depth + 1
+    return self.__local.conn
+
+  def Release(self, conn, discard=False):
+    """Releases a connection obtained from Acquire.
+
+    The connection goes back to the pool once the outermost Acquire of the
+    calling thread has been released.
+
+    Args:
+      conn: A MySQL connection object.
+      discard: If True, the connection is closed instead of being reused.
+    """
+    assert conn is self.__local.conn
+    self.__local.depth -= 1
+    if not self.__local.depth:
+      self.__local.conn = None
+      self.Checkin(conn, discard)
+
+
+class LRUCache(object):
+  """A thread-safe least recently used cache.
+
+  The cache is bounded by the number of entries and, optionally, by the total
+  size of the cached values and by the time an entry may stay unused.
+  Invalidate bumps a generation counter, so a value read from the database
+  before an invalidation can be kept out of the cache by passing the
+  generation observed before the read to Put.
+  """
+
+  def __init__(self, max_entries, max_bytes=None, ttl=None, on_evict=None):
+    """Constructor.
+
+    Args:
+      max_entries: The maximum number of cached entries.
+      max_bytes: The maximum total size of the cached values, or None.
+      ttl: The number of seconds an entry may stay unused, or None.
+      on_evict: A function called with each value that is evicted, expires
+        or is cleared. It is called without holding the cache's lock.
+    """
+    self.__max_entries = max_entries
+    self.__max_bytes = max_bytes
+    self.__ttl = ttl
+    self.__on_evict = on_evict
+    self.__lock = threading.Lock()
+    self.__entries = {}
+    self.__root = []
+    self.__root[:] = [self.__root, self.__root, None, None, 0, None]
+    self.__bytes = 0
+    self.__generation = 0
+    self.__hits = 0
+    self.__misses = 0
+    self.__evictions = 0
+    self.__expirations = 0
+
+  def __Unlink(self, link):
+    """Removes a link from the recency list and the entry map."""
+    prev_link, next_link = link[0], link[1]
+    prev_link[1] = next_link
+    next_link[0] = prev_link
+    del self.__entries[link[2]]
+    self.__bytes -= link[4]
+
+  def __LinkFront(self, link):
+    """Inserts a link as the most recently used entry."""
+    root = self.__root
+    link[0], link[1] = root, root[1]
+    root[1][0] = link
+    root[1] = link
+    self.__entries[link[2]] = link
+    self.__bytes += link[4]
+
+  def __Expire(self, now, removed):
+    """Removes the entries that have not been used for longer than the TTL.
+
+    The recency list is ordered by last use, so expired entries are found at
+    its tail.
+
+    Args:
+      now: The current time.
+      removed: out: A list the values of expired entries are appended to.
+    """
+    if self.__ttl is None:
+      return
+    link = self.__root[0]
+    while link is not self.__root and link[5] < now - self.__ttl:
+      self.__Unlink(link)
+      self.__expirations += 1
+      removed.append(link[3])
+      link = self.__root[0]
+
+  def __Evicted(self, removed):
+    """Hands removed values to the eviction callback."""
+    if self.__on_evict:
+      for value in removed:
+        self.__on_evict(value)
+
+  def Expire(self):
+    """Removes the entries that have not been used for longer than the TTL."""
+    removed = []
+    self.__lock.acquire()
+    try:
+      self.__Expire(time.time(), removed)
+    finally:
+      self.__lock.release()
+      self.__Evicted(removed)
+
+  def Get(self, key):
+    """Returns the cached value for key, or None.
+
+    Args:
+      key: The cache key.
+    Returns:
+      The cached value, or None if the key is not cached.
+    """
+    removed = []
+    self.__lock.acquire()
+    try:
+      self.__Expire(time.time(), removed)
+      link = self.__entries.get(key)
+      if link is None:
+        self.__misses += 1
+        return None
+      self.__hits += 1
+      self.__Unlink(link)
+      link[5] = time.time()
+      self.__LinkFront(link)
+      return link[3]
+    finally:
+      self.__lock.release()
+      self.__Evicted(removed)
+
+  def Put(self, key, value, size, generation=None):
+    """Caches a value, evicting least recently used entries as needed.
+
+    A value larger than the cache's byte limit is evicted right away.
+
+    Args:
+      key: The cache key.
+      value: The value to cache.
+      size: The size of the value in bytes.
+      generation: If given, the value is only cached if no invalidation
+        happened since Generation() returned this number.
+    """
+    removed = []
+    self.__lock.acquire()
+    try:
+      if generation is not None and generation != self.__generation:
+        return
+      now = time.time()
+      self.__Expire(now, removed)
+      link = self.__entries.get(key)
+      if link is not None:
+        self.__Unlink(link)
+        if link[3] is not value:
+          removed.append(link[3])
+      if self.__max_bytes is not None and size > self.__max_bytes:
+        self.__evictions += 1
+        removed.append(value)
+        return
+      self.__LinkFront([None, None, key, value, size, now])
+      while (len(self.__entries) > self.__max_entries or
+             (self.__max_bytes is not None and
+              self.__bytes > self.__max_bytes)):
+        link = self.__root[0]
+        self.__Unlink(link)
+        self.__evictions += 1
+        removed.append(link[3])
+    finally:
+      self.__lock.release()
+      self.__Evicted(removed)
+
+  def Pop(self, key):
+    """Removes a key from the cache without calling the eviction callback.
+
+    Args:
+      key: The cache key.
+    Returns:
+      The value that was cached for key, or None.
+    """
+    self.__lock.acquire()
+    try:
+      link = self.__entries.get(key)
+      if link is None:
+        self.__misses += 1
+        return None
+      self.__hits += 1
+      self.__Unlink(link)
+      return link[3]
+    finally:
+      self.__lock.release()
+
+  def Generation(self):
+    """Returns the current invalidation generation."""
+    return self.__generation
+
+  def Invalidate(self, keys):
+    """Removes keys from the cache and starts a new generation.
+
+    Args:
+      keys: An iterable of cache keys.
+    """
+    removed = []
+    self.__lock.acquire()
+    try:
+      self.__generation += 1
+      for key in keys:
+        link = self.__entries.get(key)
+        if link is not None:
+          self.__Unlink(link)
+          removed.append(link[3])
+    finally:
+      self.__lock.release()
+      self.__Evicted(removed)
+
+  def Clear(self):
+    """Removes all entries from the cache."""
+    self.__lock.acquire()
+    try:
+      self.__generation += 1
+      removed = [link[3] for link in self.__entries.itervalues()]
+      self.__entries = {}
+      self.__root[:] = [self.__root, self.__root, None, None, 0, None]
+      self.__bytes = 0
+    finally:
+      self.__lock.release()
+    self.__Evicted(removed)
+
+  def Stats(self):
+    """Returns a dict with the cache's counters and current size."""
+    self.__lock.acquire()
+    try:
+      return {'hits': self.__hits,
+              'misses': self.__misses,
+              'evictions': self.__evictions,
+              'expirations': self.__expirations,
+              'entries': len(self.__entries),
+              'bytes': self.__bytes}
+    finally:
+      self.__lock.release()
+
+
+class WorkerPool(object):
+  """A fixed number of daemon threads running submitted functions.
+
+  The threads are started by the first call to Submit.
+  """
+
+  def __init__(self, size):
+    """Constructor.
+
+    Args:
+      size: The number of worker threads.
+    """
+    self.__size = size
+    self.__queue = Queue.Queue()
+    self.__threads = []
+    self.__lock = threading.Lock()
+
+  def Submit(self, function):
+    """Queues a function to be called by one of the worker threads.
+
+    Args:
+      function: A function taking no arguments.
+    """
+    if len(self.__threads) < self.__size:
+      self.__lock.acquire()
+      try:
+        while len(self.__threads) < self.__size:
+          thread = threading.Thread(target=self.__Work)
+          thread.setDaemon(True)
+          thread.start()
+          self.__threads.append(thread)
+      finally:
+        self.__lock.release()
+    self.__queue.put(function)
+
+  def __Work(self):
+    """Runs queued functions until the process exits."""
+    while True:
+      function = self.__queue.get()
+      try:
+        function()
+      except:
+        logging.exception('Unhandled exception in datastore worker thread')
+
+
+class RpcMetrics(object):
+  """Thread-safe latency histograms and counters per RPC call name."""
+
+  def __init__(self, buckets=_LATENCY_BUCKETS):
+    """Constructor.
+
+    Args:
+      buckets: The ascending upper bounds of the latency buckets, in seconds.
+    """
+    self.__buckets = tuple(buckets)
+    self.__calls = {}
+    self.__lock = threading.Lock()
+
+  def Record(self, call, seconds, request_bytes, response_bytes, entities,
+             error):
+    """Accounts for a finished call.
+
+    Args:
+      call: The name of the call.
+      seconds: The latency of the call.
+      request_bytes: The size of the request PB.
+      response_bytes: The size of the response PB.
+      entities: The number of entities the call stored, returned or deleted.
+      error: True if the call raised an exception.
+    """
+    bucket = bisect.bisect_left(self.__buckets, seconds)
+    self.__lock.acquire()
+    try:
+      stats = self.__calls.get(call)
+      if stats is None:
+        stats = self.__calls[call] = [0, 0, 0.0, 0, 0, 0,
+                                      [0] * (len(self.__buckets) + 1)]
+      stats[0] += 1
+      stats[1] += int(error)
+      stats[2] += seconds
+      stats[3] += request_bytes
+      stats[4] += response_bytes
+      stats[5] += entities
+      stats[6][bucket] += 1
+    finally:
+      self.__lock.release()
+
+  def Snapshot(self):
+    """Returns the current metrics.
+
+    Returns:
+      A dict mapping call names to dicts with the keys 'count', 'errors',
+      'latency_seconds', 'request_bytes', 'response_bytes', 'entities' and
+      'latency_buckets', a list of (upper bound, cumulative count) tuples
+      ending with an infinite bound.
+    """
+    self.__lock.acquire()
+    try:
+      calls = [(call, stats[:6] + [list(stats[6])])
+               for call, stats in self.__calls.items()]
+    finally:
+      self.__lock.release()
+
+    snapshot = {}
+    for call, stats in calls:
+      cumulative = 0
+      buckets = []
+      for bound, count in zip(self.__buckets + (float('inf'),), stats[6]):
+        cumulative += count
+        buckets.append((bound, cumulative))
+      snapshot[call] = {'count': stats[0],
+                        'errors': stats[1],
+                        'latency_seconds': stats[2],
+                        'request_bytes': stats[3],
+                        'response_bytes': stats[4],
+                        'entities': stats[5],
+                        'latency_buckets': buckets}
+    return snapshot
+
+  def PrometheusText(self, namespace='datastore_mysql'):
+    """Returns the metrics in the Prometheus text exposition format.
+
+    Args:
+      namespace: The prefix of the metric names.
+    Returns:
+      A string.
+    """
+    snapshot = sorted(self.Snapshot().items())
+    lines = ['# HELP %s_rpc_latency_seconds Latency of datastore RPCs.'
+             % namespace,
+             '# TYPE %s_rpc_latency_seconds histogram' % namespace]
+    for call, stats in snapshot:
+      for bound, count in stats['latency_buckets']:
+        if bound == float('inf'):
+          le = '+Inf'
+        else:
+          le = '%g' % bound
+        lines.append('%s_rpc_latency_seconds_bucket{call="%s",le="%s"} %d'
+                     % (namespace, call, le, count))
+      lines.append('%s_rpc_latency_seconds_sum{call="%s"} %r'
+                   % (namespace, call, stats['latency_seconds']))
+      lines.append('%s_rpc_latency_seconds_count{call="%s"} %d'
+                   % (namespace, call, stats['count']))
+    for name, key, help_text in (
+        ('rpc_errors_total', 'errors', 'Datastore RPCs that failed.'),
+        ('rpc_request_bytes_total', 'request_bytes',
+         'Size of datastore RPC requests.'),
+        ('rpc_response_bytes_total', 'response_bytes',
+         'Size of datastore RPC responses.'),
+        ('rpc_entities_total', 'entities',
+         'Entities stored, returned or deleted by datastore RPCs.')):
+      lines.append('# HELP %s_%s %s' % (namespace, name, help_text))
+      lines.append('# TYPE %s_%s counter' % (namespace, name))
+      for call, stats in snapshot:
+        lines.append('%s_%s{call="%s"} %d'
+                     % (namespace, name, call, stats[key]))
+    return '\n'.join(lines) + '\n'
+
+
+class RpcRecorder(object):
+  """Appends RPCs to a compact binary log, see ReadRpcLog."""
+
+  def __init__(self, path):
+    """Constructor.
+
+    Args:
+      path: The log file. Records are appended if it exists.
+    """
+    self.__file = open(path, 'ab')
+    self.__lock = threading.Lock()
+    self.__closed = False
+    if not self.__file.tell():
+      self.__file.write(_RPC_LOG_MAGIC)
+
+  def Record(self, service, call, start_time, seconds, thread_id, error,
+             request, response):
+    """Appends an RPC to the log, unless the log has been closed.
+
+    Args:
+      service: The service name.
+      call: The call name.
+      start_time: The time the call started.
+      seconds: The latency of the call.
+      thread_id: The id of the calling thread.
+      error: True if the call raised an exception.
+      request: The serialized request PB.
+      response: The serialized response PB, or '' if it is not recorded.
+    """
+    name = '%s.%s' % (service, call)
+    record = _RPC_LOG_RECORD.pack(start_time, seconds, thread_id, error,
+                                  len(name), len(request), len(response))
+    self.__lock.acquire()
+    try:
+      if not self.__closed:
+        self.__file.write(''.join((record, name, request, response)))
+    finally:
+      self.__lock.release()
+
+  def Close(self):
+    """Flushes and closes the log."""
+    self.__lock.acquire()
+    try:
+      self.__closed = True
+      self.__file.close()
+    finally:
+      self.__lock.release()
+
+
+def ReadRpcLog(path):
+  """Reads a log written by RpcRecorder.
+
+  Args:
+    path: The log file.
+  Yields:
+    (service, call, start_time, seconds, thread_id, error, request, response)
+    tuples, where request and response are serialized PBs.
+  Raises:
+    ValueError: if the file is not an RPC log.
+  """
+  log = open(path, 'rb')
+  try:
+    if log.read(len(_RPC_LOG_MAGIC)) != _RPC_LOG_MAGIC:
+      raise ValueError('%s is not an RPC log' % path)
+    while True:
+      header = log.read(_RPC_LOG_RECORD.size)
+      if len(header) < _RPC_LOG_RECORD.size:
+        return
+      (start_time, seconds, thread_id, error, name_size, request_size,
+       response_size) = _RPC_LOG_RECORD.unpack(header)
+      service, call = log.read(name_size).split('.', 1)
+      request = log.read(request_size)
+      response = log.read(response_size)
+      if len(response) < response_size:
+        return
+      yield (service, call, start_time, seconds, thread_id, error, request,
+             response)
+  finally:
+    log.close()
+
+
+def FingerprintSQL(sql):
+  """Normalizes a statement so that its variants aggregate together.
+
+  Table prefixes, composite index ids, literals and parameters are replaced
+  with ?, and lists of parameters or rows are collapsed.
+
+  Args:
+    sql: A SQL statement, possibly with %s placeholders.
+  Returns:
+    The fingerprint of the statement.
+  """
+  for pattern, replacement in _SQL_NORMALIZATIONS:
+    sql = pattern.sub(replacement, sql)
+  return sql.strip()
+
+
+class SqlProfiler(object):
+  """Thread-safe statement statistics per SQL fingerprint."""
+
+  def __init__(self, max_fingerprints=_MAX_SQL_FINGERPRINTS):
+    """Constructor.
+
+    Args:
+      max_fingerprints: The number of statements whose fingerprint is
+        memoized.
+    """
+    self.__max_fingerprints = max_fingerprints
+    self.__fingerprints = {}
+    self.__stats = {}
+    self.__lock = threading.Lock()
+
+  def Fingerprint(self, sql):
+    """Returns the memoized fingerprint of a statement, see FingerprintSQL."""
+    fingerprint = self.__fingerprints.get(sql)
+    if fingerprint is None:
+      fingerprint = FingerprintSQL(sql)
+      if len(self.__fingerprints) >= self.__max_fingerprints:
+        self.__fingerprints.clear()
+      self.__fingerprints[sql] = fingerprint
+    return fingerprint
+
+  def Record(self, fingerprint, seconds, rows_returned, rows_affected):
+    """Accounts for an executed statement.
+
+    Args:
+      fingerprint: The fingerprint of the statement.
+      seconds: The execution time of the statement.
+      rows_returned: The number of rows in the result set.
+      rows_affected: The number of rows inserted, updated or deleted.
+    """
+    self.__lock.acquire()
+    try:
+      stats = self.__stats.get(fingerprint)
+      if stats is None:
+        stats = self.__stats[fingerprint] = [0, 0.0, 0.0, 0, 0]
+      stats[0] += 1
+      stats[1] += seconds
+      if seconds > stats[2]:
+        stats[2] = seconds
+      stats[3] += rows_returned
+      stats[4] += rows_affected
+    finally:
+      self.__lock.release()
+
+  def Top(self, limit):
+    """Returns the statistics of the fingerprints with the most total time.
+
+    Args:
+      limit: The maximum number of fingerprints to return.
+    Returns:
+      A list of dicts with the keys 'fingerprint', 'count', 'total_seconds',
+      'max_seconds', 'rows_returned' and 'rows_affected', ordered by
+      descending total time.
+    """
+    self.__lock.acquire()
+    try:
+      stats = [(fingerprint, list(values))
+               for fingerprint, values in self.__stats.items()]
+    finally:
+      self.__lock.release()
+    stats.sort(key=lambda item: item[1][1], reverse=True)
+    return [{'fingerprint': fingerprint,
+             'count': values[0],
+             'total_seconds': values[1],
+             'max_seconds': values[2],
+             'rows_returned': values[3],
+             'rows_affected': values[4]}
+            for fingerprint, values in stats[:limit]]
+
+  def Reset(self):
+    """Discards all statistics."""
+    self.__lock.acquire()
+    try:
+      self.__stats = {}
+    finally:
+      self.__lock.release()
+
+
+class _FinishedCall(object):
+  """Replays the outcome of a call that already ran, see AsyncRPC."""
+
+  def __init__(self, exc_info):
+    self.__exc_info = exc_info
+
+  def MakeSyncCall(self, service, call, request, response):
+    if self.__exc_info:
+      raise self.__exc_info[0], self.__exc_info[1], self.__exc_info[2]
+
+
+class AsyncRPC(apiproxy_rpc.RPC):
+  """An RPC whose call runs on a worker thread of the stub.
+
+  MakeCall hands the call to DatastoreMySQLStub.MakeAsyncCall and returns at
+  once. Wait blocks until the call finished or its deadline passed; as with
+  the base class, the state, exception and callback are handled by the
+  waiting thread.
+  """
+
+  def __init__(self, *args, **kwargs):
+    apiproxy_rpc.RPC.__init__(self, *args, **kwargs)
+    self.__finished = threading.Event()
+    self.__exc_info = None
+
+  def _MakeCallImpl(self):
+    apiproxy_rpc.RPC._MakeCallImpl(self)
+    self.stub.MakeAsyncCall(self.package, self.call, self.request,
+                            self.response, self.__Finished)
+
+  def __Finished(self, exc_info):
+    """Records the outcome of the call; called by the worker thread."""
+    self.__exc_info = exc_info
+    self.__finished.set()
+
+  def _WaitImpl(self):
+    self.__finished.wait(self.deadline)
+    if self.__finished.isSet():
+      exc_info = self.__exc_info
+    else:
+      error = apiproxy_errors.DeadlineExceededError(
+          'The API call %s.%s() took too long to respond and was cancelled.'
+          % (self.package, self.call))
+      exc_info = (apiproxy_errors.DeadlineExceededError, error, None)
+    stub, self.stub = self.stub, _FinishedCall(exc_info)
+    try:
+      return apiproxy_rpc.RPC._WaitImpl(self)
+    finally:
+      self.stub = stub
+
+
+class TransactionState(object):
+  """The state of an open transaction.
+
+  Each transaction owns a connection checked out of the pool, on which its
+  entity group lock is held and its writes are applied at commit time. The
+  lock serializes the RPCs of the transaction, since they share the
+  connection. Optimistic transactions hold no entity group locks but record
+  the versions of their entity groups instead; entity_groups maps the lock
+  names of the groups a transaction uses to their versions, or to None if
+  they are locked.
+
+  Puts and deletes are buffered in writes and deletes, keyed by the entity
+  cache lookup of their key, and applied at commit time. Queries of the
+  transaction flush them to its connection first; the keys of flushed
+  mutations are kept in flushed.
+  """
+
+  def __init__(self, handle, conn):
+    """Constructor.
+
+    Args:
+      handle: The transaction handle.
+      conn: The MySQL connection pinned to the transaction.
+    """
+    self.handle = handle
+    self.conn = conn
+    self.lock = threading.Lock()
+    self.entity_groups = {}
+    self.writes = {}
+    self.deletes = {}
+    self.flushed = []
+    self.actions = []
+
+
+class EncodingMemo(object):
+  """Memoizes the encodings of keys and property values within one batch.
+
+  Keys are remembered by identity and kept referenced, so that their ids are
+  not reused while the memo lives; a memo must not outlive its batch.
+  Property values are remembered by type and value, which pays off for
+  values that repeat across the entities of a batch.
+  """
+
+  def __init__(self, encode, table_prefix):
+    """Constructor.
+
+    Args:
+      encode: The function encoding paths and property values.
+      table_prefix: The function returning the table prefix of a key.
+    """
+    self.__encode = encode
+    self.__table_prefix = table_prefix
+    self.__keys = {}
+    self.__values = {}
+
+  def __Entry(self, key):
+    entry = self.__keys.get(id(key))
+    if entry is None:
+      entry = self.__keys[id(key)] = [key, None, None, None]
+    return entry
+
+  def Path(self, key):
+    """Returns the encoded path of an entity_pb.Reference as a string."""
+    entry = self.__Entry(key)
+    if entry[1] is None:
+      entry[1] = str(self.__encode(key.path()))
+    return entry[1]
+
+  def Kind(self, key):
+    """Returns the kind of an entity_pb.Reference."""
+    entry = self.__Entry(key)
+    if entry[2] is None:
+      entry[2] = key.path().element_list()[-1].type()
+    return entry[2]
+
+  def Prefix(self, key):
+    """Returns the table prefix of an entity_pb.Reference."""
+    entry = self.__Entry(key)
+    if entry[3] is None:
+      entry[3] = self.__table_prefix(key)
+    return entry[3]
+
+  def Value(self, value):
+    """Returns the encoded entity_pb.PropertyValue as a string."""
+    if value.has_stringvalue():
+      memo_key = (1, value.stringvalue())
+    elif value.has_int64value():
+      memo_key = (2, value.int64value())
+    elif value.has_booleanvalue():
+      memo_key = (3, value.booleanvalue())
+    elif value.has_doublevalue():
+      # repr tells 0.0 and -0.0 apart, which encode differently.
+      memo_key = (4, repr(value.doublevalue()))
+    else:
+      return str(self.__encode(value))
+    encoded = self.__values.get(memo_key)
+    if encoded is None:
+      encoded = self.__values[memo_key] = str(self.__encode(value))
+    return encoded
+
+
+class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
+  """Persistent stub for the Python datastore API.
+
+  Stores all entities in an MySQL database. A DatastoreMySQLStub instance
+  handles a single app's data.
+  """
+
+  WRITE_ONLY = entity_pb.CompositeIndex.WRITE_ONLY
+  READ_WRITE = entity_pb.CompositeIndex.READ_WRITE
+  DELETED = entity_pb.CompositeIndex.DELETED
+  ERROR = entity_pb.CompositeIndex.ERROR
+
+  _INDEX_STATE_TRANSITIONS = {
+      WRITE_ONLY: frozenset((READ_WRITE, DELETED, ERROR)),
+      READ_WRITE: frozenset((DELETED,)),
+      ERROR: frozenset((DELETED,)),
+      DELETED: frozenset((ERROR,)),
+  }
+
+  def __init__(self,
+               app_id,
+               database_info_dict,
+               require_indexes=False,
+               verbose=True,
+               service_name='datastore_v3',
+               trusted=False,
+               pool_size=_DEFAULT_POOL_SIZE,
+               pool_timeout=_DEFAULT_POOL_TIMEOUT,
+               entity_cache_size=0,
+               entity_cache_bytes=_DEFAULT_ENTITY_CACHE_BYTES,
+               trusted_count_limit=_MAXIMUM_RESULTS,
+               stream_queries=False,
+               max_cursors=_DEFAULT_MAX_CURSORS,
+               cursor_bytes=_DEFAULT_CURSOR_BYTES,
+               cursor_ttl=_DEFAULT_CURSOR_TTL,
+               async_workers=_DEFAULT_ASYNC_WORKERS,
+               optimistic_transactions=False,
+               max_entity_groups=1,
+               max_actions_per_transaction=_MAX_ACTIONS_PER_TXN,
+               profile_sql=True,
+               slow_sql_threshold=_DEFAULT_SLOW_SQL_THRESHOLD):
+    """Constructor.
+
+    Args:
+      app_id: string
+      database_info_dict: dictionary with connection information.
+      require_indexes: bool, default False. If True, composite indexes must
+          exist in index.yaml for queries that need them.
+      verbose: bool, default False. If True, logs all select statements.
+      service_name: Service name expected for all calls.
+      trusted: bool, default False. If True, this stub allows an app to access
+          the data of another app.
+      pool_size: int, default 8. Maximum number of MySQL connections held by
+          the stub. Each open transaction pins one of them.
+      pool_timeout: float, default 30.0. Number of seconds an RPC waits for a
+          free connection before failing with a timeout. While it waits,
+          query cursors unused for longer than cursor_ttl are closed.
+      entity_cache_size: int, default 0. Maximum number of serialized
+          entities kept in memory for non-transactional Gets. 0 disables the
+          cache.
+      entity_cache_bytes: int, default 16 MB. Maximum total size of the
+          entities kept in the cache.
+      trusted_count_limit: int, default 1000. Maximum result of a Count RPC
+          when the stub is trusted. None removes the limit.
+      stream_queries: bool, default False. If True, non-transactional
+          queries read their results through an unbuffered cursor in batches
+          of the requested size. Each open query then holds a connection of
+          the pool until its results are exhausted. A query whose results
+          are abandoned keeps its connection until its cursor is closed after
+          cursor_ttl, so with the default pool_size and cursor_ttl a few
+          abandoned queries can starve the pool for ten minutes; lower
+          cursor_ttl when streaming.
+      max_cursors: int, default 1000. Maximum number of open query cursors.
+          The least recently used cursor is closed to make room for a new
+          one.
+      cursor_bytes: int, default 64 MB. Maximum estimated memory held by
+          open query cursors.
+      cursor_ttl: float, default 600.0. Number of seconds after which an
+          unused query cursor is closed. None keeps cursors open until they
+          are evicted. Also bounds how long an abandoned streaming query holds
+          its connection, see stream_queries.
+      async_workers: int, default 4. Number of threads running asynchronous
+          RPCs, each on a pooled connection of its own. 0 makes asynchronous
+          RPCs run when they are waited for.
+      optimistic_transactions: bool, default False. If True, transactions
+          take no entity group lock. They record the version of their entity
+          group at first access instead, and fail at commit time with a
+          concurrent transaction error if another write to the group
+          committed in the meantime.
+      max_entity_groups: int, default 1. The number of entity groups a
+          transaction may use. Values above 1 enable cross-group
+          transactions, which hold several named locks per connection and
+          need MySQL 5.7 or later; older servers release the previous lock
+          when GET_LOCK is called again.
+      max_actions_per_transaction: int, default 5. The number of tasks a
+          transaction may enqueue.
+      profile_sql: bool, default True. If True, statement statistics are
+          aggregated per SQL fingerprint, see SqlProfile.
+      slow_sql_threshold: float, default 0.01. With verbose, statements that
+          take longer than this many seconds are logged.
+    """
+    apiproxy_stub.APIProxyStub.__init__(self, service_name)
+
+    assert isinstance(app_id, basestring) and app_id
+    self.__app_id = app_id
+    self.__database_info_dict = database_info_dict
+    self.SetTrusted(trusted)
+
+    self.__transactions = {}
+    self.__next_tx_handle = 1
+    self.__tx_lock = threading.Lock()
+
+    self.__require_indexes = require_indexes
+    self.__verbose = verbose
+    self.__trusted_count_limit = trusted_count_limit
+    self.__stream_queries = stream_queries
+    self.__optimistic_transactions = optimistic_transactions
+    self.__max_entity_groups = max_entity_groups
+    self.__max_actions_per_transaction = max_actions_per_transaction
+    self.__metrics = RpcMetrics()
+    self.__sql_profiler = SqlProfiler()
+    self.__profile_sql = profile_sql
+    self.__rpc_hooks = ()
+    self.__sql_hooks = ()
+    self.__rpc_state = threading.local()
+    self.__recorder = None
+    self.__slow_sql_threshold = slow_sql_threshold
+
+    self.__id_map = {}
+    self.__id_lock = threading.Lock()
+
+    connect_args = dict(database_info_dict)
+    connect_args['client_flag'] = (connect_args.get('client_flag', 0) |
+                                   CLIENT.MULTI_RESULTS)
+    self.__pool = ConnectionPool(connect_args, pool_size, pool_timeout,
+                                 self.__ExpireCursors,
+                                 self.__DisableMultiStatements)
+
+    if async_workers:
+      self.__workers = WorkerPool(async_workers)
+    else:
+      self.__workers = None
+
+    if entity_cache_size:
+      self.__entity_cache = LRUCache(entity_cache_size, entity_cache_bytes)
+    else:
+      self.__entity_cache = None
+
+    self.__next_cursor_id = 1
+    self.__cursor_lock = threading.Lock()
+    self.__cursors = LRUCache(max_cursors, cursor_bytes, cursor_ttl,
+                              lambda cursor: cursor.Close())
+
+    self.__namespaces = set()
+    self.__namespace_lock = threading.Lock()
+
+    self.__indexes = {}
+    self.__index_lock = threading.Lock()
+    self.__building_indexes = set()
+    self.__index_generation = 0
+    self.__index_writes = {}
+    self.__index_writes_done = threading.Condition()
+
+    self.__query_history = {}
+
+    try:
+      self.__Init()
+    except Exception, e:
+      raise datastore_errors.InternalError('%s' % e)
+
+  def __Init(self):
+    """Initializes MySQL database and creates required tables."""
+    conn = MySQLdb.connect(
+        host=self.__database_info_dict.get('host', '127.0.0.1'),
+        user=self.__database_info_dict.get('user', 'root'),
+        passwd=self.__database_info_dict.get('passwd', ''),
+        db='mysql')
+    try:
+      cursor = conn.cursor()
+      self._ExecuteSQL('CREATE DATABASE IF NOT EXISTS %s' % self.__database_info_dict['db'], None, cursor)
+      conn.commit()
+    finally:
+      conn.close()
+
+    conn = self.__pool.Acquire()
+    try:
+      cursor = conn.cursor()
+      for sql_command in _CORE_SCHEMA:
+        self._ExecuteSQL(sql_command,None,cursor)
+      conn.commit()
+
+      self._ExecuteSQL('SELECT app_id, name_space FROM Namespaces', None, cursor)
+      self.__namespaces = set(cursor.fetchall())
+
+      self._ExecuteSQL('SELECT app_id, indexes FROM Apps', None, cursor)
+      for app_id, index_proto in cursor.fetchall():
+        index_map = self.__indexes.setdefault(app_id, {})
+        if not index_proto:
+          continue
+        indexes = datastore_pb.CompositeIndices(index_proto)
+        for index in indexes.index_list():
+          index_map.setdefault(index.definition().entity_type(), []).append(index)
+
+      self._ExecuteSQL('SELECT TABLE_NAME FROM information_schema.Tables '
+                       'WHERE TABLE_SCHEMA = %s',
+                       (self.__database_info_dict['db'],), cursor)
+      tables = set(row[0] for row in cursor.fetchall())
+      for app_id, name_space in self.__namespaces:
+        prefix = self.__GetTablePrefix((app_id, name_space))
+        for indexes in self.__indexes.get(app_id, {}).values():
+          for index in indexes:
+            if self.__CompositeIndexTable(prefix, index) not in tables:
+              self.__MaterializeCompositeIndex(conn, prefix, index)
+      conn.commit()
+    finally:
+      self.__pool.Release(conn)
+
+  def Clear(self):
+    """Clears the datastore."""
+    self.__tx_lock.acquire()
+    try:
+      transactions = self.__transactions.values()
+      self.__transactions = {}
+    finally:
+      self.__tx_lock.release()
+    for tx in transactions:
+      self.__pool.Checkin(tx.conn, discard=True)
+    self.__cursors.Clear()
+
+    conn = self.__GetConnection(None)
+    cursor = conn.cursor()
+    try:
+      self._ExecuteSQL("SELECT TABLE_NAME FROM information_schema.Tables "
+          "WHERE TABLE_SCHEMA='%s';" % self.__database_info_dict['db'], None, cursor)
+      for row in [v[0] for v in cursor.fetchall()]:
+        self._ExecuteSQL('DROP TABLE %s' % row, None, cursor)
+      conn.commit()
+    finally:
+      self.__ReleaseConnection(conn, None)
+
+    self.__namespaces = set()
+    self.__indexes = {}
+    self.__query_history = {}
+    self.__id_map = {}
+    if self.__entity_cache:
+      self.__entity_cache.Clear()
+
+    self.__Init()
+
+  def Read(self):
+    """Reads the datastore from disk.
+
+    Noop for compatibility with file stub.
+    """
+    pass
+
+  def Write(self):
+    """Writes the datastore to disk.
+
+    Noop for compatibility with file stub.
+    """
+    pass
+
+  def SetTrusted(self, trusted):
+    """Set/clear the trusted bit in the stub.
+
+    This bit indicates that the app calling the stub is trusted. A
+    trusted app can write to datastores of other apps.
+
+    Args:
+      trusted: boolean.
+    """
+    self.__trusted = trusted
+
+  @staticmethod
+  def __MakeParamList(size):
+    """Returns a comma separated list of MySQL substitution parameters.
+
+    Args:
+      size: Number of parameters in returned list.
+    Returns:
+      A comma separated list of substitution parameters.
+    """
+    return ','.join(['%s'] * size)
+
+  @staticmethod
+  def __GetEntityKind(key):
+    if isinstance(key, entity_pb.EntityProto):
+      key = key.key()
+    return key.path().element_list()[-1].type()
+
+  @staticmethod
+  def __EncodeIndexPB(pb):
+    if isinstance(pb, entity_pb.PropertyValue):
+      if pb.has_uservalue():
+        userval = entity_pb.PropertyValue()
+        userval.mutable_uservalue().set_email(pb.uservalue().email())
+        userval.mutable_uservalue().set_auth_domain(
+            pb.uservalue().auth_domain())
+        userval.mutable_uservalue().set_gaiaid(0)
+        return buffer(EncodeSortable(userval))
+      encoded = FastEncodeSortable(pb)
+      if encoded is None:
+        encoded = EncodeSortable(pb)
+      return buffer(encoded)
+    elif isinstance(pb, entity_pb.Path):
+      return buffer(EncodePath(pb))
+
+  @staticmethod
+  def __AddQueryParam(params, param):
+    params.append(param)
+    return len(params)
+
+  @staticmethod
+  def __CreateFilterString(filter_list, params):
+    """Transforms a filter list into an SQL WHERE clause.
+
+    Args:
+      filter_list: The list of (property, operator, value) filters
+        to transform. A value_type of -1 indicates no value type comparison
+        should be done.
+      params: out: A list of parameters to pass to the query.
+    Returns:
+      An SQL 'where' clause.
+    """
+    clauses = []
+    for prop, operator, value in filter_list:
+      sql_op = _OPERATOR_MAP[operator]
+
+      value_index = DatastoreMySQLStub.__AddQueryParam(params, value)
+      clauses.append('%s %s %%s' % (prop, sql_op))
+
+    filters = ' AND '.join(clauses)
+    if filters:
+      filters = 'WHERE ' + filters
+    return filters
+
+  @staticmethod
+  def __CreateSeekString(order_list, position, params):
+    """Returns a condition selecting the rows after a position.
+
+    The condition is the row comparison (c1, c2, ...) > (v1, v2, ...) with
+    each comparison flipped for descending columns, so a resumed query seeks
+    straight to its position instead of skipping the rows before it. The
+    leading column is also bounded on its own so that it can use an index.
+
+    Args:
+      order_list: A list of (field, order) tuples that ends with a unique
+        column.
+      position: A list of values, one per order.
+      params: out: A list of parameters to pass to the query.
+    Returns:
+      An SQL condition.
+    """
+    clause = None
+    seek_params = []
+    for (field, order), value in reversed(zip(order_list, position)):
+      sql_op = _SEEK_OPERATOR_MAP[order]
+      if clause is None:
+        clause = '%s %s %%s' % (field, sql_op)
+        seek_params = [value]
+      else:
+        clause = '(%s %s %%s OR (%s = %%s AND %s))' % (field, sql_op, field,
+                                                      clause)
+        seek_params = [value, value] + seek_params
+    params.append(position[0])
+    params.extend(seek_params)
+    return '%s %s= %%s AND %s' % (order_list[0][0], sql_op, clause)
+
+  @staticmethod
+  def __CreateOrderString(order_list):
+    """Returns an 'ORDER BY' clause from the given list of orders.
+
+    Args:
+      order_list: A list of (field, order) tuples.
+    Returns:
+      An SQL ORDER BY clause.
+    """
+    orders = ', '.join('%s %s' % (x[0], _ORDER_MAP[x[1]]) for x in order_list)
+    if orders:
+      orders = 'ORDER BY ' + orders
+    return orders
+
+  def __ValidateAppId(self, app_id):
+    """Verify that this is the stub for app_id.
+
+    Args:
+      app_id: An application ID.
+
+    Raises:
+      datastore_errors.BadRequestError: if this is not the stub for app_id.
+    """
+    assert app_id
+    if not self.__trusted and app_id != self.__app_id:
+      raise datastore_errors.BadRequestError(
+          'app %s cannot access app %s\'s data' % (self.__app_id, app_id))
+
+  def __GetTransactionState(self, tx):
+    """Returns the state of an open transaction.
+
+    Args:
+      tx: datastore_pb.Transaction
+
+    Returns:
+      A TransactionState.
+
+    Raises:
+      apiproxy_errors.ApplicationError: if the tx doesn't exist.
+    """
+    assert isinstance(tx, datastore_pb.Transaction)
+    self.__ValidateAppId(tx.app())
+    self.__tx_lock.acquire()
+    try:
+      state = self.__transactions.get(tx.handle())
+    finally:
+      self.__tx_lock.release()
+    if state is None:
+      raise apiproxy_errors.ApplicationError(datastore_pb.Error.BAD_REQUEST,
+                                             'Transaction %s not found' % tx)
+    return state
+
+  def __LockTransaction(self, tx):
+    """Locks an open transaction for the calling RPC.
+
+    Args:
+      tx: datastore_pb.Transaction
+
+    Returns:
+      The locked TransactionState.
+
+    Raises:
+      apiproxy_errors.ApplicationError: if the tx doesn't exist or ended
+        while waiting for the lock.
+    """
+    state = self.__GetTransactionState(tx)
+    state.lock.acquire()
+    if state.conn is None:
+      state.lock.release()
+      raise apiproxy_errors.ApplicationError(datastore_pb.Error.BAD_REQUEST,
+                                             'Transaction %s not found' % tx)
+    return state
+
+  def __ValidateKey(self, key):
+    """Validate this key.
+
+    Args:
+      key: entity_pb.Reference
+
+    Raises:
+      datastore_errors.BadRequestError: if the key is invalid
+    """
+    assert isinstance(key, entity_pb.Reference)
+
+    self.__ValidateAppId(key.app())
+
+    for elem in key.path().element_list():
+      if elem.has_id() == elem.has_name():
+        raise datastore_errors.BadRequestError(
+            'each key path element should have id or name but not both: %r'
+            % key)
+
+  def __GetConnection(self, transaction):
+    """Retrieves a connection to the MySQL DB.
+
+    If a transaction is supplied, the connection pinned to the transaction is
+    returned and the transaction is locked until __ReleaseConnection;
+    otherwise the calling thread's pooled connection is returned.
+
+    Args:
+      transaction: A Transaction PB.
+    Returns:
+      An MySQL connection object.
+    """
+    if not (transaction and transaction.handle()):
+      return self.__pool.Acquire()
+    return self.__LockTransaction(transaction).conn
+
+  def __ReleaseConnection(self, conn, transaction, rollback=False):
+    """Releases a connection for use by other operations.
+
+    If a transaction is supplied, only the transaction is unlocked; the
+    connection stays pinned to it until it is committed or rolled back.
+
+    Args:
+      conn: An MySQL connection object.
+      transaction: A Transaction PB.
+      rollback: If True, roll back the database TX instead of committing it.
+    """
+    if transaction and transaction.handle():
+      self.__GetTransactionState(transaction).lock.release()
+      return
+    discard = False
+    try:
+      try:
+        if rollback:
+          conn.rollback()
+        else:
+          conn.commit()
+      except MySQLdb.OperationalError:
+        discard = True
+        raise
+    finally:
+      self.__pool.Release(conn, discard)
+
+  def __ConfigureNamespace(self, conn, prefix, app_id, name_space):
+    """Ensures the relevant tables and indexes exist.
+
+    Args:
+      conn: An MySQL database connection.
+      prefix: The namespace prefix to configure.
+      app_id: The app ID.
+      name_space: The per-app namespace name.
+    """
+    format_args = {'app_id': app_id, 'name_space': name_space, 'prefix': prefix}
+    cursor = conn.cursor()
+    for sql_command in _NAMESPACE_SCHEMA:
+      try:
+        self._ExecuteSQL(sql_command % format_args, None, cursor)
+      except MySQLdb.IntegrityError, e:
+        logging.warn(str(e))
+    for indexes in self.__indexes.get(app_id, {}).values():
+      for index in indexes:
+        self.__MaterializeCompositeIndex(conn, prefix, index)
+    conn.commit()
+
+  def __WriteIndexData(self, conn, app):
+    """Writes index data to disk.
+
+    Args:
+      conn: An MySQL connection.
+      app: The app ID to write indexes for.
+    """
+    indices = datastore_pb.CompositeIndices()
+    for indexes in self.__indexes[app].values():
+      indices.index_list().extend(indexes)
+
+    cursor = conn.cursor()
+    self._ExecuteSQL('INSERT INTO Apps (app_id, indexes) VALUES (%s, %s) '
+                     'ON DUPLICATE KEY UPDATE indexes = VALUES(indexes)',
+                     (app, indices.Encode()), cursor)
+
+  @staticmethod
+  def __CompositeIndexTable(prefix, index):
+    """Returns the name of the table materializing a composite index.
+
+    Args:
+      prefix: A table namespace prefix.
+      index: An entity_pb.CompositeIndex.
+    Returns:
+      The table name.
+    """
+    return '%s_CompositeIndex_%d' % (prefix, index.id())
+
+  def __CreateCompositeIndexTable(self, conn, prefix, index):
+    """Creates the table of a composite index if it does not exist.
+
+    Args:
+      conn: An MySQL connection.
+      prefix: The namespace prefix to create the table in.
+      index: An entity_pb.CompositeIndex.
+    """
+    self._ExecuteSQL(
+        _COMPOSITE_INDEX_SCHEMA
+        % {'table': self.__CompositeIndexTable(prefix, index)},
+        None, conn.cursor())
+
+  def __MaterializeCompositeIndex(self, conn, prefix, index):
+    """Creates the table of a composite index and fills it from the entities.
+
+    Each batch of entities is read with shared locks and committed together
+    with its index rows. A concurrent write of one of the entities therefore
+    either commits before the batch reads it, or waits for the batch and
+    then replaces its rows.
+
+    Args:
+      conn: An MySQL connection.
+      prefix: The namespace prefix to create the table in.
+      index: An entity_pb.CompositeIndex.
+    """
+    self.__CreateCompositeIndexTable(conn, prefix, index)
+    table = self.__CompositeIndexTable(prefix, index)
+    cursor = conn.cursor()
+
+    last_path = ''
+    while True:
+      self._ExecuteSQL(
+          'SELECT __path__, entity FROM %s_Entities '
+          'WHERE kind = %%s AND __path__ > %%s ORDER BY __path__ LIMIT %d '
+          'LOCK IN SHARE MODE' % (prefix, _MAX_IN_CLAUSE_SIZE),
+          (index.definition().entity_type(), last_path), cursor)
+      batch = cursor.fetchall()
+      if not batch:
+        conn.commit()
+        break
+      rows = {}
+      memo = self.__EncodingMemo()
+      for path, data in batch:
+        rows.update(self.__GetCompositeIndexRows(
+            index, entity_pb.EntityProto(data), memo))
+      if rows:
+        self._ExecuteSQL(
+            'INSERT IGNORE INTO %s (sort_key, __path__, hashed_index) '
+            'VALUES (%%s, %%s, %%s)' % table,
+            (row for row in rows.values()), cursor)
+      conn.commit()
+      last_path = batch[-1][0]
+
+  def __EnterIndexWrite(self):
+    """Marks the start of a write that maintains index rows.
+
+    Returns:
+      The index generation the write sees, to be passed to __ExitIndexWrite.
+    """
+    self.__index_writes_done.acquire()
+    try:
+      generation = self.__index_generation
+      self.__index_writes[generation] = (
+          self.__index_writes.get(generation, 0) + 1)
+      return generation
+    finally:
+      self.__index_writes_done.release()
+
+  def __ExitIndexWrite(self, generation):
+    """Marks the end of a write started with __EnterIndexWrite."""
+    self.__index_writes_done.acquire()
+    try:
+      self.__index_writes[generation] -= 1
+      if not self.__index_writes[generation]:
+        del self.__index_writes[generation]
+        self.__index_writes_done.notifyAll()
+    finally:
+      self.__index_writes_done.release()
+
+  def __WaitForIndexWrites(self):
+    """Starts a new index generation and waits for the writes of older ones.
+
+    Writes entering afterwards maintain the rows of every index registered
+    so far, so only writes which may have missed a new index are waited for.
+    """
+    self.__index_writes_done.acquire()
+    try:
+      self.__index_generation += 1
+      while [generation for generation in self.__index_writes
+             if generation < self.__index_generation]:
+        self.__index_writes_done.wait()
+    finally:
+      self.__index_writes_done.release()
+
+  def __DropCompositeIndex(self, conn, index):
+    """Drops the tables of a composite index in all of its app's namespaces.
+
+    Args:
+      conn: An MySQL connection.
+      index: An entity_pb.CompositeIndex.
+    """
+    cursor = conn.cursor()
+    for app_id, name_space in list(self.__namespaces):
+      if app_id == index.app_id():
+        prefix = self.__GetTablePrefix((app_id, name_space))
+        self._ExecuteSQL('DROP TABLE IF EXISTS %s'
+                         % self.__CompositeIndexTable(prefix, index),
+                         None, cursor)
+
+  @staticmethod
+  def __SortKeySuccessor(sort_key):
+    """Returns the smallest string greater than all strings starting with key.
+
+    Args:
+      sort_key: A sort key ending with an encoded component.
+    Returns:
+      The sort key with its last byte incremented.
+    """
+    return sort_key[:-1] + chr(ord(sort_key[-1]) + 1)
+
+  def __GetCompositeIndexRows(self, index, entity, memo):
+    """Returns the rows of a composite index table for an entity.
+
+    Args:
+      index: An entity_pb.CompositeIndex.
+      entity: An entity_pb.EntityProto of the index's kind.
+      memo: The EncodingMemo of the batch.
+    Returns:
+      A dict mapping hashed_index values to (sort_key, __path__, hashed_index)
+      rows. The dict is empty if the entity lacks an indexed property.
+    """
+    path = memo.Path(entity.key())
+    values = {'__key__': [path]}
+    for prop in entity.property_list():
+      values.setdefault(prop.name(), []).append(memo.Value(prop.value()))
+
+    definition = index.definition()
+    sort_keys = ['']
+    if definition.ancestor():
+      ancestor = entity_pb.Path()
+      components = []
+      for element in entity.key().path().element_list():
+        ancestor.add_element().CopyFrom(element)
+        components.append(EncodeSortKeyComponent(
+            self.__EncodeIndexPB(ancestor),
+            entity_pb.Index_Property.ASCENDING))
+      sort_keys = components
+
+    for prop in definition.property_list():
+      components = [EncodeSortKeyComponent(value, prop.direction())
+                    for value in values.get(prop.name(), [])]
+      sort_keys = [key + component for key in sort_keys
+                   for component in components]
+
+    rows = {}
+    for sort_key in sort_keys:
+      hashed_index = md5.new(sort_key + path).hexdigest()
+      rows[hashed_index] = (buffer(sort_key), path, hashed_index)
+    return rows
+
+  def __GetTablePrefix(self, data):
+    """Returns the namespace prefix for a query.
+
+    Args:
+      data: An Entity, Key or Query PB, or an (app_id, ns) tuple.
+    Returns:
+      A valid table prefix
+    """
+    if isinstance(data, entity_pb.EntityProto):
+      data = data.key()
+    if not isinstance(data, tuple):
+      data = (data.app(), data.name_space())
+    prefix = ('%s_%s' % data).replace('"', '""')
+    prefix = formatTableName(prefix)
+    if data not in self.__namespaces:
+      self.__namespace_lock.acquire()
+      try:
+        if data not in self.__namespaces:
+          conn = self.__pool.Acquire()
+          try:
+            self.__ConfigureNamespace(conn, prefix, *data)
+          finally:
+            self.__pool.Release(conn)
+          self.__namespaces.add(data)
+      finally:
+        self.__namespace_lock.release()
+    return prefix
+
+  def __DeleteRows(self, conn, paths, table):
+    """Deletes rows from a table.
+
+    Args:
+      conn: An MySQL connection.
+      paths: Paths to delete.
+      table: The table to delete from.
+    Returns:
+      The number of rows deleted.
+    """
+    cursor = conn.cursor()
+    sql_command = 'DELETE FROM %s WHERE __path__ IN (%s)'%(table, self.__MakeParamList(len(paths)))
+    self._ExecuteSQL(sql_command, paths, cursor)
+    return cursor.rowcount
+
+  def __DeleteEntityRows(self, conn, keys, table):
+    """Deletes rows from the specified table that index the keys provided.
+
+    Args:
+      conn: A database connection.
+      keys: A list of keys to delete index entries for.
+      table: The table to delete from.
+    Returns:
+      The number of rows deleted.
+    """
+    rowcount = 0
+    keys = sorted((x.app(), x.name_space(), x) for x in keys)
+    for (app_id, ns), group in itertools.groupby(keys, lambda x: x[:2]):
+      path_strings = [self.__EncodeIndexPB(x[2].path()) for x in group]
+      prefix = self.__GetTablePrefix((app_id, ns))
+      rowcount += self.__DeleteRows(conn, path_strings,
+                                    '%s_%s' % (prefix, table))
+    return rowcount
+
+  def __DeleteIndexEntries(self, conn, keys):
+    """Deletes entities from the index.
+
+    Args:
+      conn: An MySQL connection.
+      keys: A list of keys to delete.
+    """
+    self.__DeleteEntityRows(conn, keys, 'EntitiesByProperty')
+
+  def __FetchEntities(self, conn, keys, use_cache=False):
+    """Fetches the stored entities for a list of keys.
+
+    Keys are grouped by namespace and looked up with one query per chunk of
+    up to _MAX_IN_CLAUSE_SIZE paths.
+
+    Args:
+      conn: A database connection.
+      keys: A list of keys to fetch.
+      use_cache: If True, entities are served from and added to the entity
+        cache, if it is enabled.
+    Returns:
+      A list with the serialized entity for each key, in the order of keys,
+      or None for keys that do not exist.
+    """
+    lookups = [self.__KeyLookup(key) for key in keys]
+    cache = use_cache and self.__entity_cache
+
+    found = {}
+    if cache:
+      generation = cache.Generation()
+      for lookup in lookups:
+        data = cache.Get(lookup)
+        if data is not None:
+          found[lookup] = data
+
+    paths_by_prefix = {}
+    for prefix, path in lookups:
+      if (prefix, path) not in found:
+        paths_by_prefix.setdefault(prefix, set()).add(path)
+
+    for prefix, paths in paths_by_prefix.items():
+      paths = sorted(paths)
+      for i in xrange(0, len(paths), _MAX_IN_CLAUSE_SIZE):
+        chunk = paths[i:i + _MAX_IN_CLAUSE_SIZE]
+        cursor = conn.cursor()
+        self._ExecuteSQL(
+            'SELECT __path__, entity FROM %s_Entities WHERE __path__ IN (%s)'
+            % (prefix, self.__MakeParamList(len(chunk))), chunk, cursor)
+        for path, data in cursor.fetchall():
+          found[(prefix, str(path))] = data
+          if cache:
+            cache.Put((prefix, str(path)), data, len(data), generation)
+    return [found.get(lookup) for lookup in lookups]
+
+  def __InvalidateCachedEntities(self, keys):
+    """Removes entities from the entity cache once their change is committed.
+
+    Args:
+      keys: A list of keys that were written or deleted.
+    """
+    if self.__entity_cache and keys:
+      self.__entity_cache.Invalidate([self.__KeyLookup(key) for key in keys])
+
+  def __KeyLookup(self, key):
+    """Returns a hashable lookup for a key.
+
+    Args:
+      key: An entity_pb.Reference.
+    Returns:
+      (prefix, path): The table prefix and the encoded path of the key.
+    """
+    return (self.__GetTablePrefix(key), str(self.__EncodeIndexPB(key.path())))
+
+  def __EncodingMemo(self):
+    """Returns a new EncodingMemo for a batch of entities."""
+    return EncodingMemo(self.__EncodeIndexPB, self.__GetTablePrefix)
+
+  def __InsertEntities(self, conn, entities, memo):
+    """Inserts or updates entities in the DB.
+
+    Args:
+      conn: A database connection.
+      entities: A list of entities to store.
+      memo: The EncodingMemo of the batch.
+    """
+
+    def RowGenerator(entities):
+      for unused_prefix, e in entities:
+        yield (memo.Path(e.key()), memo.Kind(e.key()), buffer(e.Encode()))
+
+    entities = sorted((memo.Prefix(x.key()), x) for x in entities)
+    for prefix, group in itertools.groupby(entities, lambda x: x[0]):
+      cursor = conn.cursor()
+      group_rows = RowGenerator(group)
+      self._ExecuteSQL('REPLACE INTO %s_Entities VALUES (%%s, %%s, %%s)' % prefix, group_rows, cursor)
+
+  def __GetIndexRows(self, entity, memo):
+    """Returns the EntitiesByProperty rows for an entity.
+
+    Args:
+      entity: An entity_pb.EntityProto.
+      memo: The EncodingMemo of the batch.
+    Returns:
+      A list of (kind, name, value, __path__, hashed_index) rows.
+    """
+    rows = []
+    kind = memo.Kind(entity.key())
+    path = memo.Path(entity.key())
+    for p in entity.property_list():
+      p_vals = [kind, p.name(), memo.Value(p.value()), path]
+
+      hashed_index = md5.new(''.join(p_vals[:2]))
+      hashed_index.update(p_vals[2]) #buffer values cannot be joined into a string
+      hashed_index.update(p_vals[3])
+      p_vals.append( hashed_index.hexdigest() )
+
+      rows.append(p_vals)
+    return rows
+
+  def __SyncIndexRows(self, cursor, table, columns, paths, rows):
+    """Replaces the rows an index table holds for some paths.
+
+    The hashes of the existing rows are read first, so that only rows which
+    are no longer needed get deleted and only missing rows get inserted. The
+    read locks the rows, so that a concurrent put of the same entities waits
+    for this one to commit instead of diffing against rows it is replacing.
+
+    Args:
+      cursor: A database cursor.
+      table: The index table, which must have __path__ and hashed_index
+        columns.
+      columns: The column names of the rows, ending with hashed_index.
+      paths: The encoded paths whose rows are replaced.
+      rows: A dict mapping hashed_index values to the new rows.
+    """
+    existing = set()
+    paths = sorted(paths)
+    for i in xrange(0, len(paths), _MAX_IN_CLAUSE_SIZE):
+      chunk = paths[i:i + _MAX_IN_CLAUSE_SIZE]
+      self._ExecuteSQL(
+          'SELECT hashed_index FROM %s WHERE __path__ IN (%s) FOR UPDATE'
+          % (table, self.__MakeParamList(len(chunk))), chunk, cursor)
+      existing.update(row[0] for row in cursor.fetchall())
+
+    stale = sorted(existing.difference(rows))
+    for i in xrange(0, len(stale), _MAX_IN_CLAUSE_SIZE):
+      chunk = stale[i:i + _MAX_IN_CLAUSE_SIZE]
+      self._ExecuteSQL(
+          'DELETE FROM %s WHERE hashed_index IN (%s)'
+          % (table, self.__MakeParamList(len(chunk))), chunk, cursor)
+
+    missing = [row for hashed_index, row in rows.items()
+               if hashed_index not in existing]
+    if missing:
+      self._ExecuteSQL(
+        'INSERT IGNORE INTO %s (%s) VALUES (%s)'
+        % (table, ', '.join(columns), self.__MakeParamList(len(columns))),
+        (row for row in missing), cursor)
+
+  def __UpdateIndexEntries(self, conn, entities, memo):
+    """Brings the index entries of the supplied entities up to date.
+
+    Updates both the EntitiesByProperty table and the tables of the composite
+    indexes defined for the entities' kinds.
+
+    Args:
+      conn: A database connection.
+      entities: A list of entities to update index entries for.
+      memo: The EncodingMemo of the batch.
+    """
+    cursor = conn.cursor()
+    entities = sorted((memo.Prefix(x.key()), x) for x in entities)
+    for prefix, group in itertools.groupby(entities, lambda x: x[0]):
+      group = [e for unused_prefix, e in group]
+      rows = {}
+      paths = set()
+      for e in group:
+        paths.add(memo.Path(e.key()))
+        for row in self.__GetIndexRows(e, memo):
+          rows[row[4]] = row
+      self.__SyncIndexRows(
+          cursor, '%s_EntitiesByProperty' % prefix,
+          ('kind', 'name', 'value', '__path__', 'hashed_index'), paths, rows)
+
+      app_indexes = self.__indexes.get(group[0].key().app(), {})
+      by_kind = {}
+      for e in group:
+        by_kind.setdefault(memo.Kind(e.key()), []).append(e)
+      for kind, kind_entities in by_kind.items():
+        for index in app_indexes.get(kind, []):
+          rows = {}
+          paths = set()
+          for e in kind_entities:
+            paths.add(memo.Path(e.key()))
+            rows.update(self.__GetCompositeIndexRows(index, e, memo))
+          self.__SyncIndexRows(
+              cursor, self.__CompositeIndexTable(prefix, index),
+              ('sort_key', '__path__', 'hashed_index'), paths, rows)
+
+  def __DeleteCompositeIndexEntries(self, conn, keys):
+    """Deletes the composite index rows of the supplied keys.
+
+    Args:
+      conn: A database connection.
+      keys: A list of keys to delete composite index entries for.
+    """
+    by_table = {}
+    for key in keys:
+      app_indexes = self.__indexes.get(key.app(), {})
+      indexes = app_indexes.get(self.__GetEntityKind(key), [])
+      if not indexes:
+        continue
+      prefix = self.__GetTablePrefix(key)
+      path = self.__EncodeIndexPB(key.path())
+      for index in indexes:
+        by_table.setdefault(
+            self.__CompositeIndexTable(prefix, index), []).append(path)
+    for table, paths in by_table.items():
+      self.__DeleteRows(conn, paths, table)
+
+  def __AllocateIds(self, conn, prefix, size):
+    """Allocates IDs.
+
+    Args:
+      conn: A MySQL connection object, or None to allocate on a pooled
+        connection that is committed right away. Transactions pass None, so
+        that the IdSeq row is neither locked until they commit nor rolled
+        back with them.
+      prefix: A table namespace prefix.
+      size: Number of IDs to allocate.
+    Returns:
+      int: The beginning of a range of size IDs
+    """
+    self.__id_lock.acquire()
+    try:
+      next_id, block_size = self.__id_map.get(prefix, (0, 0))
+      if size >= block_size:
+        block_size = max(1000, size)
+        if conn is None:
+          id_conn = self.__pool.Acquire()
+        else:
+          id_conn = conn
+        try:
+          cursor = id_conn.cursor()
+          self._ExecuteSQL('UPDATE IdSeq SET next_id = next_id + %s WHERE prefix = %s',(block_size, prefix), cursor)
+          assert int(cursor.rowcount) == 1
+          self._ExecuteSQL('SELECT next_id FROM IdSeq WHERE prefix = %s LIMIT 1',(prefix,),cursor)
+          next_id = cursor.fetchone()[0] - block_size
+        finally:
+          if conn is None:
+            self.__ReleaseConnection(id_conn, None)
+
+      ret = next_id
+
+      next_id += size
+      block_size -= size
+      self.__id_map[prefix] = (next_id, block_size)
+    finally:
+      self.__id_lock.release()
+
+    return ret
+
+  def __AcquireLockForEntityGroup(self, conn, entity_group,
+                                  timeout=_MAX_TIMEOUT):
+    """Acquire a lock for a specified entity group.
+
+    Args:
+      conn: A MySQL connection.
+      entity_group: The lock name of an entity group.
+      timeout: Number of seconds to wait for the lock.
+
+    Raises:
+      apiproxy_errors.ApplicationError: CONCURRENT_TRANSACTION if the lock
+        could not be acquired in time, or MySQL detected a deadlock.
+    """
+    cursor = conn.cursor()
+    try:
+      self._ExecuteSQL('SELECT GET_LOCK(%s, %s)',
+                       (entity_group, int(timeout)), cursor)
+    except MySQLdb.OperationalError, e:
+      if e.args and e.args[0] in _LOCK_CONFLICT_ERRORS:
+        acquired = 0
+      else:
+        raise
+    else:
+      acquired = cursor.fetchone()[0]
+    conn.commit()
+    if acquired != 1:
+      raise apiproxy_errors.ApplicationError(
+          datastore_pb.Error.CONCURRENT_TRANSACTION,
+          'too much contention on these datastore entities. please try again.')
+
+  def __GetEntityGroupVersion(self, conn, entity_group):
+    """Returns the committed version of an entity group.
+
+    Args:
+      conn: A MySQL connection.
+      entity_group: The lock name of an entity group.
+    Returns:
+      int: The number of committed writes to the entity group, as counted
+      since optimistic transactions were enabled.
+    """
+    cursor = conn.cursor()
+    self._ExecuteSQL(
+        'SELECT version FROM EntityGroupVersions WHERE entity_group = %s',
+        (entity_group,), cursor)
+    row = cursor.fetchone()
+    if row:
+      return int(row[0])
+    return 0
+
+  def __CheckEntityGroupVersions(self, conn, tx):
+    """Validates the versions of a transaction's entity groups.
+
+    The version rows are locked in sorted order until the MySQL transaction
+    ends, so the check and the transaction's writes are atomic with respect
+    to other commits. All groups are checked in one round trip.
+
+    Args:
+      conn: The MySQL connection of the transaction.
+      tx: An optimistic TransactionState with pending mutations.
+    Returns:
+      A list of (sql, params) tuples incrementing the versions, to be executed
+      along with the transaction's writes.
+
+    Raises:
+      apiproxy_errors.ApplicationError: CONCURRENT_TRANSACTION if an entity
+        group was written to since the transaction read its version.
+    """
+    entity_groups = sorted(tx.entity_groups)
+    statements = []
+    for entity_group in entity_groups:
+      statements.append(('INSERT INTO EntityGroupVersions VALUES (%s, 0) '
+                         'ON DUPLICATE KEY UPDATE version = version',
+                         (entity_group,)))
+      statements.append(('SELECT version FROM EntityGroupVersions '
+                         'WHERE entity_group = %s FOR UPDATE',
+                         (entity_group,)))
+    results = self.__ExecuteBatch(conn, statements)
+    for entity_group, rows in zip(entity_groups, results[1::2]):
+      if int(rows[0][0]) != tx.entity_groups[entity_group]:
+        raise apiproxy_errors.ApplicationError(
+            datastore_pb.Error.CONCURRENT_TRANSACTION,
+            'too much contention on these datastore entities. '
+            'please try again.')
+    return [('UPDATE EntityGroupVersions SET version = version + 1 '
+             'WHERE entity_group = %s', (entity_group,))
+            for entity_group in entity_groups]
+
+  def __BumpEntityGroupVersions(self, conn, keys):
+    """Increments the versions of the entity groups of non-transactional writes.
+
+    This makes optimistic transactions that read the groups fail at commit.
+
+    Args:
+      conn: The MySQL connection of the write.
+      keys: The keys of the written or deleted entities.
+    """
+    groups = self.__ExtractEntityGroupsFromKeys(keys)
+    if not groups:
+      return
+    cursor = conn.cursor()
+    self._ExecuteSQL(
+        'INSERT INTO EntityGroupVersions VALUES (%s, 1) '
+        'ON DUPLICATE KEY UPDATE version = version + 1',
+        ((group,) for group in sorted(groups)), cursor)
+
+  def __ReleaseLockForEntityGroup(self, conn, entity_group):
+    """Release transaction lock if present.
+
+    Args:
+      conn: A MySQL connection.
+      entity_group: The lock name of an entity group.
+    """
+    cursor = conn.cursor()
+    self._ExecuteSQL('SELECT RELEASE_LOCK(%s)', (entity_group,), cursor)
+    conn.commit()
+
+  def __LockEntityGroup(self, transaction, keys):
+    """Locks the entity groups of a transaction on their first use.
+
+    New groups are locked in sorted order. A group that sorts before one the
+    transaction already holds is only tried without waiting, since waiting
+    for it could deadlock with a transaction that locks in sorted order.
+    Acquiring a lock ends the MySQL transaction, so that later reads see the
+    latest state of the new group; that is impossible once a query flushed
+    uncommitted writes.
+
+    Optimistic transactions read the versions of the entity groups instead.
+    The first one is the first read of their MySQL transaction, so the
+    versions and all later reads come from the same snapshot.
+
+    Args:
+      transaction: The Transaction PB of the request.
+      keys: The keys the request accesses.
+    Raises:
+      apiproxy_errors.ApplicationError: BAD_REQUEST if the transaction would
+        use more than max_entity_groups entity groups.
+    """
+    state = self.__GetTransactionState(transaction)
+    new_groups = sorted(self.__ExtractEntityGroupsFromKeys(keys) -
+                        set(state.entity_groups))
+    if not new_groups:
+      return
+    if len(state.entity_groups) + len(new_groups) > self.__max_entity_groups:
+      if self.__max_entity_groups == 1:
+        raise apiproxy_errors.ApplicationError(
+            datastore_pb.Error.BAD_REQUEST,
+            'Cannot operate on different entity groups in a transaction.')
+      raise apiproxy_errors.ApplicationError(
+          datastore_pb.Error.BAD_REQUEST,
+          'operating on too many entity groups in a single transaction.')
+
+    if self.__optimistic_transactions:
+      for entity_group in new_groups:
+        state.entity_groups[entity_group] = self.__GetEntityGroupVersion(
+            state.conn, entity_group)
+      return
+
+    if state.flushed:
+      raise apiproxy_errors.ApplicationError(
+          datastore_pb.Error.BAD_REQUEST,
+          'Cannot use a new entity group after a query in a transaction '
+          'that has written.')
+    highest = max([None] + state.entity_groups.keys())
+    for entity_group in new_groups:
+      if entity_group < highest:
+        timeout = 0
+      else:
+        timeout = _MAX_TIMEOUT
+      self.__AcquireLockForEntityGroup(state.conn, entity_group, timeout)
+      state.entity_groups[entity_group] = None
+
+  def __ExtractEntityGroupsFromKeys(self, keys):
+    """Returns the lock names of the entity groups of the given keys.
+
+    Entity groups are identified by the root element of their keys' paths,
+    together with the app and namespace. The names are hashed to fit the 64
+    character limit on MySQL lock names.
+
+    Args:
+      keys: A list of entity_pb.Reference objects.
+    Returns:
+      A set of lock names.
+    """
+    groups = set()
+    for key in keys:
+      root = key.path().element(0)
+      if root.has_name():
+        id_or_name = 'n' + root.name()
+      else:
+        id_or_name = 'i%d' % root.id()
+      groups.add('dsg_' + md5.new('\0'.join(
+          (self.__database_info_dict['db'], key.app(), key.name_space(),
+           root.type(), id_or_name))).hexdigest())
+    return groups
+
+  def MakeSyncCall(self, service, call, request, response):
+    """The main RPC entry point. service must be 'datastore_v3'."""
+
+    hooks = self.__rpc_hooks
+    if hooks:
+      self.__RunHooks([before for before, _ in hooks], call, request)
+
+    # The call the statements of this thread are made for, for the SQL hooks.
+    outer_call = getattr(self.__rpc_state, 'call', None)
+    self.__rpc_state.call = call
+    recorder = self.__recorder
+    request_data = ''
+    start_time = time.time()
+    error = True
+    exception = None
+    try:
+      try:
+        self.AssertPbIsInitialized(request)
+        if recorder:
+          # Handlers may modify the request, e.g. RunQuery resets its offset.
+          request_data = request.Encode()
+
+        super(DatastoreMySQLStub, self).MakeSyncCall(
+          service, call, request, response)
+
+        self.AssertPbIsInitialized(response)
+        error = False
+      except Exception, exception:
+        raise
+    finally:
+      elapsed = time.time() - start_time
+      if error:
+        response_bytes = entities = 0
+      else:
+        response_bytes = response.ByteSize()
+        counter = _ENTITY_COUNTERS.get(call)
+        entities = counter and counter(request, response) or 0
+      self.__metrics.Record(call, elapsed, request.ByteSize(), response_bytes,
+                            entities, error)
+      if hooks:
+        self.__RunHooks([after for _, after in hooks], call, request,
+                        response, elapsed, exception)
+      if recorder:
+        if call in _RECORDED_RESPONSES and not error:
+          response_data = response.Encode()
+        else:
+          response_data = ''
+        try:
+          recorder.Record(service, call, start_time, elapsed,
+                          thread.get_ident(), error, request_data,
+                          response_data)
+        except Exception:
+          logging.exception('Recording %s.%s failed', service, call)
+      self.__rpc_state.call = outer_call
+
+  def StartRecording(self, path):
+    """Starts appending every RPC to a log, for replay_datastore_mysql.py.
+
+    The responses of BeginTransaction and RunQuery are recorded as well, so
+    that transaction handles and cursors can be mapped on replay.
+
+    Args:
+      path: The log file.
+    """
+    self.StopRecording()
+    self.__recorder = RpcRecorder(path)
+
+  def StopRecording(self):
+    """Stops recording RPCs and closes the log."""
+    recorder, self.__recorder = self.__recorder, None
+    if recorder:
+      recorder.Close()
+
+  def AddRpcHook(self, before=None, after=None):
+    """Registers functions called around every RPC.
+
+    Args:
+      before: A function called with the call name and the request PB before
+        the call is made.
+      after: A function called with the call name, the request PB, the
+        response PB, the latency in seconds and the exception the call
+        raised, or None, after the call finished.
+    """
+    self.__rpc_hooks = self.__rpc_hooks + ((before, after),)
+
+  def AddSqlHook(self, before=None, after=None):
+    """Registers functions called around every SQL statement.
+
+    Both functions are first called with the name of the RPC the statement
+    is executed for, or None for statements the stub executes on its own.
+
+    Args:
+      before: A function called with the call name, the fingerprint and the
+        text of the statement before it is executed.
+      after: A function called with the call name, the fingerprint, the
+        latency in seconds, the number of rows returned and affected, and the
+        exception the statement raised, or None, after it was executed.
+    """
+    self.__sql_hooks = self.__sql_hooks + ((before, after),)
+
+  def ClearHooks(self):
+    """Removes all RPC and SQL hooks."""
+    self.__rpc_hooks = ()
+    self.__sql_hooks = ()
+
+  @staticmethod
+  def __RunHooks(functions, *args):
+    """Calls hook functions, logging the exceptions they raise.
+
+    Args:
+      functions: A list of functions, or None for hooks that were omitted.
+      args: The arguments of the functions.
+    """
+    for function in functions:
+      if function:
+        try:
+          function(*args)
+        except Exception:
+          logging.exception('Datastore hook %r failed', function)
+
+  def SqlProfile(self, limit=20, reset=False):
+    """Returns the SQL fingerprints that took the most total time.
+
+    Args:
+      limit: The maximum number of fingerprints to return.
+      reset: If True, the statistics are discarded afterwards.
+    Returns:
+      A list of dicts as returned by SqlProfiler.Top, or None if profiling
+      is disabled.
+    """
+    if not self.__profile_sql:
+      return None
+    profile = self.__sql_profiler.Top(limit)
+    if reset:
+      self.__sql_profiler.Reset()
+    return profile
+
+  def RpcStats(self):
+    """Returns latency histograms and counters per RPC call name.
+
+    Returns:
+      A dict as returned by RpcMetrics.Snapshot.
+    """
+    return self.__metrics.Snapshot()
+
+  def PrometheusMetrics(self):
+    """Returns the RPC metrics in the Prometheus text exposition format."""
+    return self.__metrics.PrometheusText()
+
+  def WritePrometheusMetrics(self, path):
+    """Writes the RPC metrics to a file, e.g. for a node exporter.
+
+    The file is replaced atomically, so readers never see a partial file.
+
+    Args:
+      path: The name of the file.
+    """
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    output = open(temp_path, 'w')
+    try:
+      output.write(self.__metrics.PrometheusText())
+    finally:
+      output.close()
+    os.rename(temp_path, path)
+
+  def CreateRPC(self):
+    """Creates an RPC object for the asynchronous API.
+
+    Returns:
+      An AsyncRPC if worker threads are enabled, otherwise an RPC that makes
+      its call when it is waited for.
+    """
+    if self.__workers:
+      return AsyncRPC(stub=self)
+    return apiproxy_stub.APIProxyStub.CreateRPC(self)
+
+  def MakeAsyncCall(self, service, call, request, response, callback):
+    """Makes a call on a worker thread.
+
+    Args:
+      service: Must be 'datastore_v3'.
+      call: The name of the call.
+      request: The request PB.
+      response: out: The response PB, filled in by the worker thread.
+      callback: A function called on the worker thread once the call
+        finished, with None or the sys.exc_info() of the call's exception.
+    """
+    def Call():
+      try:
+        self.MakeSyncCall(service, call, request, response)
+      except:
+        callback(sys.exc_info())
+      else:
+        callback(None)
+    self.__workers.Submit(Call)
+
+  def AssertPbIsInitialized(self, pb):
+    """Raises an exception if the given PB is not initialized and valid."""
+    explanation = []
+    assert pb.IsInitialized(explanation), explanation
+    pb.Encode()
+
+  def QueryHistory(self):
+    """Returns a dict that maps Query PBs to times they've been run."""
+    return dict((pb, times) for pb, times in self.__query_history.items() if
+                pb.app() == self.__app_id)
+
+  def OpenCursorStats(self):
+    """Returns gauges and counters for the open query cursors.
+
+    Returns:
+      A dict with the number of open cursors ('entries'), their estimated
+      size ('bytes'), and the number of cursors found ('hits'), not found
+      ('misses'), evicted ('evictions') and expired ('expirations').
+    """
+    return self.__cursors.Stats()
+
+  def __ExpireCursors(self):
+    """Closes idle query cursors, giving back their streaming connections."""
+    self.__cursors.Expire()
+
+  @staticmethod
+  def __DisableMultiStatements(conn):
+    """Turns multi statements off, which MySQLdb enables for new connections.
+
+    Only __ExecuteBatch turns them on, for the duration of one batch.
+    """
+    conn.set_server_option(_MYSQL_OPTION_MULTI_STATEMENTS_OFF)
+
+  def EntityCacheStats(self):
+    """Returns the entity cache's hit, miss and eviction counters.
+
+    Returns:
+      A dict with the keys 'hits', 'misses', 'evictions', 'entries' and
+      'bytes', or None if the entity cache is disabled.
+    """
+    if self.__entity_cache:
+      return self.__entity_cache.Stats()
+    return None
+
+  def __PutEntities(self, conn, entities):
+    generation = self.__EnterIndexWrite()
+    try:
+      memo = self.__EncodingMemo()
+      self.__InsertEntities(conn, entities, memo)
+      self.__UpdateIndexEntries(conn, entities, memo)
+    finally:
+      self.__ExitIndexWrite(generation)
+
+  def __DeleteEntities(self, conn, keys):
+    generation = self.__EnterIndexWrite()
+    try:
+      self.__DeleteIndexEntries(conn, keys)
+      self.__DeleteCompositeIndexEntries(conn, keys)
+      self.__DeleteEntityRows(conn, keys, 'Entities')
+    finally:
+      self.__ExitIndexWrite(generation)
+
+  def _Dynamic_Put(self, put_request, put_response):
+    conn = self.__GetConnection(put_request.transaction())
+    try:
+      entities = put_request.entity_list()
+      keys = [e.key() for e in entities]
+      if put_request.transaction().handle():
+        id_conn = None
+      else:
+        id_conn = conn
+      for entity in entities:
+        self.__ValidateKey(entity.key())
+
+        for prop in itertools.chain(entity.property_list(),
+                                    entity.raw_property_list()):
+          if prop.value().has_uservalue():
+            uid = md5.new(prop.value().uservalue().email().lower()).digest()
+            uid = '1' + ''.join(['%02d' % ord(x) for x in uid])[:20]
+            prop.mutable_value().mutable_uservalue().set_obfuscated_gaiaid(uid)
+
+        assert entity.has_key()
+        assert entity.key().path().element_size() > 0
+
+        last_path = entity.key().path().element_list()[-1]
+        if last_path.id() == 0 and not last_path.has_name():
+          id_ = self.__AllocateIds(id_conn,
+                                   self.__GetTablePrefix(entity.key()), 1)
+          last_path.set_id(id_)
+
+          assert entity.entity_group().element_size() == 0
+          group = entity.mutable_entity_group()
+          root = entity.key().path().element(0)
+          group.add_element().CopyFrom(root)
+
+        else:
+          assert (entity.has_entity_group() and
+                  entity.entity_group().element_size() > 0)
+
+      if put_request.transaction().handle():
+        self.__LockEntityGroup(put_request.transaction(), keys)
+        tx = self.__GetTransactionState(put_request.transaction())
+        for entity in entities:
+          lookup = self.__KeyLookup(entity.key())
+          tx.writes[lookup] = entity
+          tx.deletes.pop(lookup, None)
+      else:
+        self.__PutEntities(conn, entities)
+        if self.__optimistic_transactions:
+          self.__BumpEntityGroupVersions(conn, keys)
+      put_response.key_list().extend([e.key() for e in entities])
+    finally:
+      self.__ReleaseConnection(conn, put_request.transaction())
+    if not put_request.transaction().handle():
+      self.__InvalidateCachedEntities(keys)
+
+  def _Dynamic_Get(self, get_request, get_response):
+    conn = self.__GetConnection(get_request.transaction())
+    try:
+      keys = get_request.key_list()
+      for key in keys:
+        self.__ValidateAppId(key.app())
+      if get_request.transaction().handle():
+        self.__LockEntityGroup(get_request.transaction(), keys)
+        tx = self.__GetTransactionState(get_request.transaction())
+        lookups = [self.__KeyLookup(key) for key in keys]
+        remaining = [key for key, lookup in zip(keys, lookups)
+                     if lookup not in tx.writes and lookup not in tx.deletes]
+        fetched = iter(self.__FetchEntities(conn, remaining))
+        for lookup in lookups:
+          group = get_response.add_entity()
+          if lookup in tx.writes:
+            group.mutable_entity().CopyFrom(tx.writes[lookup])
+            continue
+          if lookup in tx.deletes:
+            continue
+          data = fetched.next()
+          if data is not None:
+            group.mutable_entity().ParseFromString(data)
+        return
+      for data in self.__FetchEntities(conn, keys, use_cache=True):
+        group = get_response.add_entity()
+        if data is not None:
+          group.mutable_entity().ParseFromString(data)
+    finally:
+      self.__ReleaseConnection(conn, get_request.transaction())
+
+  def _Dynamic_Delete(self, delete_request, delete_response):
+    conn = self.__GetConnection(delete_request.transaction())
+    try:
+      keys = delete_request.key_list()
+      if delete_request.transaction().handle():
+        tx = self.__GetTransactionState(delete_request.transaction())
+        self.__LockEntityGroup(delete_request.transaction(), keys)
+      for key in keys:
+        self.__ValidateAppId(key.app())
+        if delete_request.transaction().handle():
+          lookup = self.__KeyLookup(key)
+          tx.deletes[lookup] = key
+          tx.writes.pop(lookup, None)
+
+      if not delete_request.transaction().handle():
+        self.__DeleteEntities(conn, delete_request.key_list())
+        if self.__optimistic_transactions:
+          self.__BumpEntityGroupVersions(conn, keys)
+    finally:
+      self.__ReleaseConnection(conn, delete_request.transaction())
+    if not delete_request.transaction().handle():
+      self.__InvalidateCachedEntities(keys)
+
+  def __GenerateFilterInfo(self, filters, query):
+    """Transform a list of filters into a more usable form.
+
+    Args:
+      filters: A list of filter PBs.
+      query: The query to generate filter info for.
+    Returns:
+      A dict mapping property names to lists of (op, value) tuples.
+    """
+    filter_info = {}
+    for filt in filters:
+      assert filt.property_size() == 1
+      prop = filt.property(0)
+      value = prop.value()
+      if prop.name() == '__key__':
+        value = ReferencePropertyToReference(value.referencevalue())
+        assert value.app() == query.app()
+        assert value.name_space() == query.name_space()
+        value = value.path()
+      filter_info.setdefault(prop.name(), []).append(
+          (filt.op(), self.__EncodeIndexPB(value)))
+    return filter_info
+
+  def __GenerateOrderInfo(self, orders):
+    """Transform a list of orders into a more usable form.
+
+    Args:
+      orders: A list of order PBs.
+    Returns:
+      A list of (property, direction) tuples.
+    """
+    orders = [(order.property(), order.direction()) for order in orders]
+    if orders and orders[-1] == ('__key__', datastore_pb.Query_Order.ASCENDING):
+      orders.pop()
+    return orders
+
+  def __GetPrefixRange(self, prefix):
+    """Returns a (min, max) range that encompasses the given prefix.
+
+    Args:
+      prefix: A string prefix to filter for. Must be a PB encodable using
+        __EncodeIndexPB.
+    Returns:
+      (min, max): Start and end string values to filter on.
+    """
+    ancestor_min = self.__EncodeIndexPB(prefix)
+    ancestor_max = buffer(str(ancestor_min) + '\xfb\xff\xff\xff\x89')
+    return ancestor_min, ancestor_max
+
+  def  __KindQuery(self, query, filter_info, order_info, keys_only):
+    """Performs kind only, kind and ancestor, and ancestor only queries."""
+    if not (set(filter_info.keys()) |
+            set(x[0] for x in order_info)).issubset(['__key__']):
+      return None
+    if len(order_info) > 1:
+      return None
+
+    filters = []
+    filters.extend(('__path__', op, value) for op, value
+                   in filter_info.get('__key__', []))
+    if query.has_kind():
+      filters.append(('kind', datastore_pb.Query_Filter.EQUAL, query.kind()))
+    if query.has_ancestor():
+      amin, amax = self.__GetPrefixRange(query.ancestor().path())
+      filters.append(('__path__',
+                      datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL, amin))
+      filters.append(('__path__', datastore_pb.Query_Filter.LESS_THAN, amax))
+
+    if order_info:
+      orders = [('__path__', order_info[0][1])]
+    else:
+      orders = [('__path__', datastore_pb.Query_Order.ASCENDING)]
+
+    tables = '%s_Entities AS Entities' % self.__GetTablePrefix(query)
+    return 'Entities.__path__', tables, filters, orders
+
+  def __SinglePropertyQuery(self, query, filter_info, order_info, keys_only):
+    """Performs queries satisfiable by the EntitiesByProperty table."""
+    property_names = set(filter_info.keys())
+    property_names.update(x[0] for x in order_info)
+    property_names.discard('__key__')
+    if len(property_names) != 1:
+      return None
+
+    property_name = property_names.pop()
+    filter_ops = filter_info.get(property_name, [])
+
+    if len([1 for o, _ in filter_ops
+            if o == datastore_pb.Query_Filter.EQUAL]) > 1:
+      return None
+
+    if len(order_info) > 1 or (order_info and order_info[0][0] == '__key__'):
+      return None
+
+    if query.has_ancestor():
+      return None
+
+    if not query.has_kind():
+      return None
+
+    prefix = self.__GetTablePrefix(query)
+    filters = []
+    filters.append(('EntitiesByProperty.kind',
+                    datastore_pb.Query_Filter.EQUAL, query.kind()))
+    filters.append(('name', datastore_pb.Query_Filter.EQUAL, property_name))
+    for op, value in filter_ops:
+      if property_name == '__key__':
+        filters.append(('EntitiesByProperty.__path__', op, value))
+      else:
+        filters.append(('value', op, value))
+
+    orders = []
+    if order_info:
+      orders.append(('value', order_info[0][1]))
+    else:
+      orders.append(('value', datastore_pb.Query_Order.ASCENDING))
+    orders.append(('EntitiesByProperty.__path__',
+                   datastore_pb.Query_Order.ASCENDING))
+
+    tables = '%s_EntitiesByProperty AS EntitiesByProperty' % prefix
+    if not keys_only:
+      tables += ' INNER JOIN %s_Entities AS Entities USING (__path__)' % prefix
+    return 'EntitiesByProperty.__path__', tables, filters, orders
+
+  def __StarSchemaQueryPlan(self, query, filter_info, order_info, keys_only):
+    """Executes a query using a 'star schema' based on EntitiesByProperty.
+
+    A 'star schema' is a join between an objects table (Entities) and multiple
+    instances of a facts table (EntitiesByProperty). Ideally, this will result
+    in a merge join if the only filters are inequalities and the sort orders
+    match those in the index for the facts table; otherwise, the DB will do its
+    best to satisfy the query efficiently.
+
+    Args:
+      query: The datastore_pb.Query PB.
+      filter_info: A dict mapping properties filtered on to (op, value) tuples.
+      order_info: A list of (property, direction) tuples.
+      keys_only: If True, the Entities table is left out of the join.
+    Returns:
+      (path, tables, filters, orders): A query plan, see __PlanQuery.
+    """
+    filter_sets = []
+    for name, filter_ops in filter_info.items():
+      filter_sets.extend((name, [x]) for x in filter_ops
+                         if x[0] == datastore_pb.Query_Filter.EQUAL)
+      ineq_ops = [x for x in filter_ops
+                  if x[0] != datastore_pb.Query_Filter.EQUAL]
+      if ineq_ops:
+        filter_sets.append((name, ineq_ops))
+
+    for prop, _ in order_info:
+      if prop == '__key__':
+        continue
+      if prop not in filter_info:
+        filter_sets.append((prop, []))
+
+    prefix = self.__GetTablePrefix(query)
+
+    if keys_only and filter_sets:
+      path = 'ebp_0.__path__'
+      joins = ['%s_EntitiesByProperty AS ebp_0' % prefix]
+    else:
+      path = 'Entities.__path__'
+      joins = ['%s_Entities AS Entities' % prefix]
+
+    filters = []
+    join_name_map = {}
+    for i, (name, filter_ops) in enumerate(filter_sets):
+      join_name = 'ebp_%d' % (i,)
+      join_name_map.setdefault(name, join_name)
+      if i or not keys_only:
+        joins.append(
+            'INNER JOIN %s_EntitiesByProperty AS %s ON %s = %s.__path__'
+            % (prefix, join_name, path, join_name))
+      filters.append(('%s.kind' % join_name, datastore_pb.Query_Filter.EQUAL,
+                      query.kind()))
+      filters.append(('%s.name' % join_name, datastore_pb.Query_Filter.EQUAL,
+                      name))
+      for op, value in filter_ops:
+        filters.append(('%s.value' % join_name, op, buffer(value)))
+      if query.has_ancestor():
+        amin, amax = self.__GetPrefixRange(query.ancestor().path())
+        filters.append(('%s.__path__' % join_name,
+                        datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL, amin))
+        filters.append(('%s.__path__' % join_name,
+                        datastore_pb.Query_Filter.LESS_THAN, amax))
+
+    orders = []
+    for prop, order in order_info:
+      if prop == '__key__':
+        orders.append((path, order))
+      else:
+        prop = '%s.value' % (join_name_map[prop],)
+        orders.append((prop, order))
+    if not order_info or order_info[-1][0] != '__key__':
+      orders.append((path, datastore_pb.Query_Order.ASCENDING))
+
+    return path, ' '.join(joins), filters, orders
+
+  def __CompositeIndexQuery(self, query, filter_info, order_info, keys_only):
+    """Performs queries satisfiable by a materialized composite index.
+
+    The equality filters and the inequality filters on the first remaining
+    property of the index are turned into a single range of sort keys.
+    """
+    if not query.has_kind():
+      return None
+    index = self.__FindIndexForQuery(query)
+    if not index:
+      return None
+
+    definition = index.definition()
+    key_prefix = ''
+    if definition.ancestor():
+      if not query.has_ancestor():
+        return None
+      key_prefix = EncodeSortKeyComponent(
+          self.__EncodeIndexPB(query.ancestor().path()),
+          entity_pb.Index_Property.ASCENDING)
+    elif query.has_ancestor():
+      return None
+
+    remaining = dict(filter_info)
+    lower = key_prefix
+    upper = key_prefix and self.__SortKeySuccessor(key_prefix)
+    for prop in definition.property_list():
+      filter_ops = remaining.pop(prop.name(), [])
+      eq_values = set(str(value) for op, value in filter_ops
+                      if op == datastore_pb.Query_Filter.EQUAL)
+      if len(eq_values) == len(filter_ops) == 1:
+        key_prefix += EncodeSortKeyComponent(eq_values.pop(),
+                                             prop.direction())
+        lower = key_prefix
+        upper = self.__SortKeySuccessor(key_prefix)
+        continue
+      if eq_values:
+        return None
+
+      descending = prop.direction() == entity_pb.Index_Property.DESCENDING
+      for op, value in filter_ops:
+        bound = key_prefix + EncodeSortKeyComponent(value, prop.direction())
+        if descending:
+          op = _REVERSED_OPERATOR_MAP[op]
+        if op == datastore_pb.Query_Filter.GREATER_THAN:
+          lower = max(lower, self.__SortKeySuccessor(bound))
+        elif op == datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL:
+          lower = max(lower, bound)
+        elif op == datastore_pb.Query_Filter.LESS_THAN:
+          upper = upper and min(upper, bound) or bound
+        elif op == datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL:
+          bound = self.__SortKeySuccessor(bound)
+          upper = upper and min(upper, bound) or bound
+      break
+
+    filters = []
+    for op, value in remaining.pop('__key__', []):
+      filters.append(('CompositeIndex.__path__', op, value))
+    if remaining:
+      return None
+    if lower:
+      filters.append(('CompositeIndex.sort_key',
+                      datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL,
+                      buffer(lower)))
+    if upper:
+      filters.append(('CompositeIndex.sort_key',
+                      datastore_pb.Query_Filter.LESS_THAN, buffer(upper)))
+
+    orders = [('CompositeIndex.sort_key', datastore_pb.Query_Order.ASCENDING),
+              ('CompositeIndex.__path__', datastore_pb.Query_Order.ASCENDING)]
+
+    prefix = self.__GetTablePrefix(query)
+    tables = '%s AS CompositeIndex' % self.__CompositeIndexTable(prefix, index)
+    if not keys_only:
+      tables += ' INNER JOIN %s_Entities AS Entities USING (__path__)' % prefix
+    return 'CompositeIndex.__path__', tables, filters, orders
+
+  def __MergeJoinQuery(self, query, filter_info, order_info, keys_only):
+    if order_info:
+      return None
+    if query.has_ancestor():
+      return None
+    if not query.has_kind():
+      return None
+    for filter_ops in filter_info.values():
+      for op, _ in filter_ops:
+        if op != datastore_pb.Query_Filter.EQUAL:
+          return None
+
+    return self.__StarSchemaQueryPlan(query, filter_info, order_info,
+                                      keys_only)
+
+  def __LastResortQuery(self, query, filter_info, order_info, keys_only):
+    """Last resort query plan that executes queries requring composite indexes.
+
+    Args:
+      query: The datastore_pb.Query PB.
+      filter_info: A dict mapping properties filtered on to (op, value) tuples.
+      order_info: A list of (property, direction) tuples.
+      keys_only: If True, the plan does not need to read entities.
+    Returns:
+      (path, tables, filters, orders): A query plan, see __PlanQuery.
+    """
+    if self.__require_indexes:
+      index = self.__FindIndexForQuery(query, building=True)
+      if not index:
+        raise apiproxy_errors.ApplicationError(
+            datastore_pb.Error.NEED_INDEX,
+            'This query requires a composite index that is not defined. '
+            'You must update the index.yaml file in your application root.')
+    return self.__StarSchemaQueryPlan(query, filter_info, order_info,
+                                      keys_only)
+
+  def __FindIndexForQuery(self, query, building=False):
+    """Finds an index that can be used to satisfy the provided query.
+
+    Args:
+      query: A datastore_pb.Query PB.
+      building: Whether to consider indexes which are still being backfilled.
+    Returns:
+      An entity_pb.CompositeIndex PB, if a suitable index exists; otherwise None
+    """
+    unused_required, kind, ancestor, props, num_eq_filters = (
+        datastore_index.CompositeIndexForQuery(query))
+    required_key = (kind, ancestor, props)
+    indexes = self.__indexes.get(query.app(), {}).get(kind, [])
+    if not building:
+      indexes = [index for index in indexes
+                 if (query.app(), index.id()) not in self.__building_indexes]
+
+    eq_filters_set = set(props[:num_eq_filters])
+    remaining_filters = props[num_eq_filters:]
+    for index in indexes:
+      definition = datastore_index.ProtoToIndexDefinition(index)
+      index_key = datastore_index.IndexToKey(definition)
+      if required_key == index_key:
+        return index
+      if num_eq_filters > 1 and (kind, ancestor) == index_key[:2]:
+        this_props = index_key[2]
+        this_eq_filters_set = set(this_props[:num_eq_filters])
+        this_remaining_filters = this_props[num_eq_filters:]
+        if (eq_filters_set == this_eq_filters_set and
+            remaining_filters == this_remaining_filters):
+          return index
+
+  _QUERY_STRATEGIES = [
+      __KindQuery,
+      __SinglePropertyQuery,
+      __CompositeIndexQuery,
+      __MergeJoinQuery,
+      __LastResortQuery,
+  ]
+
+  def __PlanQuery(self, query, keys_only):
+    """Chooses a query strategy and builds the FROM and WHERE clauses.
+
+    Each strategy returns None if it cannot satisfy the query, or a plan
+    (path, tables, filters, orders) made of the column holding the path of
+    the results, the FROM clause, a filter list for __CreateFilterString and
+    an order list for __CreateOrderString. The FROM clause of keys only plans
+    need not join the Entities table.
+
+    Args:
+      query: A datastore_pb.Query protocol buffer.
+      keys_only: If True, the plan only has to provide paths.
+    Returns:
+      (path, tables, where, params, orders, start_key): The path column, the
+      FROM and WHERE clauses with the parameters of the latter, the list of
+      (field, order) tuples the results are sorted by and the position the
+      query resumes from.
+    """
+    if query.has_transaction():
+      if not query.has_ancestor():
+        raise apiproxy_errors.ApplicationError(
+            datastore_pb.Error.BAD_REQUEST,
+            'Only ancestor queries are allowed inside transactions.')
+      self.__LockEntityGroup(query.transaction(), [query.ancestor()])
+      self.__FlushTransaction(
+          self.__GetTransactionState(query.transaction()))
+
+    num_components = len(query.filter_list()) + len(query.order_list())
+    if query.has_ancestor():
+      num_components += 1
+    if num_components > _MAX_QUERY_COMPONENTS:
+      raise apiproxy_errors.ApplicationError(
+          datastore_pb.Error.BAD_REQUEST,
+          ('query is too large. may not have more than %s filters'
+           ' + sort orders ancestor total' % _MAX_QUERY_COMPONENTS))
+
+    app_id = query.app()
+    self.__ValidateAppId(app_id)
+
+    filters, orders = datastore_index.Normalize(query.filter_list(),
+                                                query.order_list())
+
+    filter_info = self.__GenerateFilterInfo(filters, query)
+    order_info = self.__GenerateOrderInfo(orders)
+
+    for strategy in DatastoreMySQLStub._QUERY_STRATEGIES:
+      result = strategy(self, query, filter_info, order_info, keys_only)
+      if result:
+        break
+    else:
+      raise apiproxy_errors.ApplicationError(
+          datastore_pb.Error.BAD_REQUEST,
+          'No strategy found to satisfy query.')
+
+    path, tables, filters, orders = result
+    directions = [x[1] for x in orders]
+
+    params = []
+    where = self.__CreateFilterString(filters, params)
+    start_key = ''
+    if query.has_compiled_cursor() and query.compiled_cursor().position_size():
+      start_key = query.compiled_cursor().position(0).start_key()
+    if start_key:
+      try:
+        position = DecodeSortKey(start_key, directions)
+      except ValueError:
+        raise apiproxy_errors.ApplicationError(
+            datastore_pb.Error.BAD_REQUEST,
+            'Cursor does not match query.')
+      seek = self.__CreateSeekString(orders, position, params)
+      if where:
+        where += ' AND ' + seek
+      else:
+        where = 'WHERE ' + seek
+
+    clone = datastore_pb.Query()
+    clone.CopyFrom(query)
+    clone.clear_hint()
+    clone.clear_limit()
+    clone.clear_count()
+    clone.clear_offset()
+    self.__query_history[clone] = self.__query_history.get(clone, 0) + 1
+
+    return path, tables, where, params, orders, start_key
+
+  @staticmethod
+  def __CreateLimitString(query):
+    """Returns a 'LIMIT' clause for the query's offset and limit.
+
+    Args:
+      query: A datastore_pb.Query protocol buffer.
+    Returns:
+      An SQL LIMIT clause.
+    """
+    if query.has_limit() and query.has_offset():
+      return 'LIMIT %i, %i' % (query.offset(), query.limit())
+    elif query.has_limit():
+      return 'LIMIT %i' % query.limit()
+    elif query.has_offset():
+      return 'LIMIT %i, 18446744073709551615' % query.offset()
+    return ''
+
+  def __GetQueryCursor(self, conn, query, release=None):
+    """Returns an MySQL query cursor for the provided query.
+
+    Args:
+      conn: The MySQL connection.
+      query: A datastore_pb.Query protocol buffer.
+      release: If set, the results are streamed through an unbuffered cursor
+        and the connection must not be used until the QueryCursor calls
+        release, see QueryCursor.
+    Returns:
+      A QueryCursor object.
+    """
+    path, tables, where, params, orders, start_key = self.__PlanQuery(
+        query, query.keys_only())
+
+    if query.keys_only():
+      entity = 'NULL'
+    else:
+      entity = 'Entities.entity'
+    sql_stmt = 'SELECT %s, %s, %s FROM %s %s %s %s' % (
+        path, entity, ','.join(x[0] for x in orders), tables, where,
+        self.__CreateOrderString(orders), self.__CreateLimitString(query))
+    query.set_offset(0)
+
+    if release:
+      db_cursor = conn.cursor(MySQLdb.cursors.SSCursor)
+    else:
+      db_cursor = conn.cursor()
+    self._ExecuteSQL(sql_stmt, params, db_cursor)
+
+    return QueryCursor(query, db_cursor, [x[1] for x in orders], start_key,
+                       release)
+
+  def __CountQuery(self, conn, query):
+    """Counts the distinct results of a query on the server.
+
+    The keys only query plan is wrapped in a subquery that selects distinct
+    paths with the query's offset and limit, so no entity is read and the
+    limit bounds the number of rows MySQL has to read.
+
+    Args:
+      conn: The MySQL connection.
+      query: A datastore_pb.Query protocol buffer.
+    Returns:
+      int: Result count.
+    """
+    path, tables, where, params, unused_orders, unused_start_key = (
+        self.__PlanQuery(query, True))
+
+    sql_stmt = ('SELECT COUNT(*) FROM (SELECT DISTINCT %s AS __path__ '
+                'FROM %s %s %s) AS Results' % (
+                    path, tables, where, self.__CreateLimitString(query)))
+
+    db_cursor = conn.cursor()
+    self._ExecuteSQL(sql_stmt, params, db_cursor)
+    return int(db_cursor.fetchone()[0])
+  
+  def _ExecuteSQL(self, sql_stmt, params=None, cursor=None):
+    if not cursor:
+      conn = self.__pool.Acquire()
+      try:
+        cursor = self._ExecuteSQL(sql_stmt, params, conn.cursor())
+        conn.commit()
+      finally:
+        self.__pool.Release(conn)
+      return cursor
+    
+    many = isinstance(params, types.GeneratorType)
+    if many and self.__verbose:
+      # Only the first row and the number of rows go to the slow statement
+      # log, so the rows are not all kept in memory.
+      sample = [None, 0]
+      params = self.__SampleRows(params, sample)
+
+    hooks = self.__sql_hooks
+    if hooks:
+      call = getattr(self.__rpc_state, 'call', None)
+      fingerprint = self.__sql_profiler.Fingerprint(sql_stmt)
+      self.__RunHooks([before for before, _ in hooks], call, fingerprint,
+                      sql_stmt)
+
+    start_time = time.time()
+    try:
+      if many:
+        cursor.executemany(sql_stmt, params)
+      else:
+        cursor.execute(sql_stmt, params)
+    except Exception, e:
+      if hooks:
+        self.__RunHooks([after for _, after in hooks], call, fingerprint,
+                        time.time() - start_time, 0, 0, e)
+      raise
+    elapsed = time.time() - start_time
+
+    if self.__profile_sql or hooks:
+      fingerprint = self.__sql_profiler.Fingerprint(sql_stmt)
+      rows = cursor.rowcount
+      if not 0 <= rows < 1 << 63:
+        # Unbuffered cursors do not know their row count yet.
+        rows = 0
+      if cursor.description is None:
+        rows_returned, rows_affected = 0, rows
+      else:
+        rows_returned, rows_affected = rows, 0
+      if self.__profile_sql:
+        self.__sql_profiler.Record(fingerprint, elapsed, rows_returned,
+                                   rows_affected)
+      if hooks:
+        self.__RunHooks([after for _, after in hooks], call, fingerprint,
+                        elapsed, rows_returned, rows_affected, None)
+
+    if self.__verbose and elapsed > self.__slow_sql_threshold:
+      if many:
+        logging.info('Slow SQL (%.1f ms, %d rows): %s w/ %d argument rows, '
+                     'the first being %r', elapsed * 1000, cursor.rowcount,
+                     sql_stmt, sample[1], sample[0])
+      else:
+        logging.info('Slow SQL (%.1f ms, %d rows): %s w/ arguments %r',
+                     elapsed * 1000, cursor.rowcount, sql_stmt, params)
+
+    return cursor
+
+  @staticmethod
+  def __SampleRows(rows, sample):
+    """Yields rows, recording the first one and their number in sample.
+
+    Args:
+      rows: An iterable of parameter rows.
+      sample: A [first row, row count] list, updated while rows are read.
+    """
+    for row in rows:
+      if not sample[1]:
+        sample[0] = row
+      sample[1] += 1
+      yield row
+  
+  def __FlushTransaction(self, tx):
+    """Applies the buffered mutations of a transaction to its connection.
+
+    The rows stay uncommitted, but are visible to the queries the
+    transaction runs on its connection, so they see its own writes.
+
+    Args:
+      tx: A TransactionState, locked by the caller.
+    """
+    if not tx.writes and not tx.deletes:
+      return
+    self.__PutEntities(tx.conn, tx.writes.values())
+    self.__DeleteEntities(tx.conn, tx.deletes.values())
+    tx.flushed.extend(entity.key() for entity in tx.writes.values())
+    tx.flushed.extend(tx.deletes.values())
+    tx.writes = {}
+    tx.deletes = {}
+
+  def __CompileMutations(self, writes, deletes):
+    """Compiles entity writes and deletes into statements that do not read.
+
+    Like __SyncIndexRows, the index rows of written entities that are still
+    needed are kept. Instead of reading the stored hashes first, the rows of
+    each written path that are not among its new rows are deleted, and all
+    new rows are inserted, ignoring those that already exist.
+
+    Args:
+      writes: A list of entities to store.
+      deletes: A list of keys to delete.
+    Returns:
+      A list of (sql, params) tuples.
+    """
+    memo = self.__EncodingMemo()
+    by_prefix = {}
+    for entity in writes:
+      by_prefix.setdefault(memo.Prefix(entity.key()), ([], []))[0].append(entity)
+    for key in deletes:
+      by_prefix.setdefault(memo.Prefix(key), ([], []))[1].append(key)
+
+    statements = []
+
+    def Delete(table, column, values):
+      values = sorted(values)
+      for i in xrange(0, len(values), _MAX_IN_CLAUSE_SIZE):
+        chunk = values[i:i + _MAX_IN_CLAUSE_SIZE]
+        statements.append(('DELETE FROM %s WHERE %s IN (%s)'
+                           % (table, column, self.__MakeParamList(len(chunk))),
+                           chunk))
+
+    def DeleteStale(table, columns, paths, rows):
+      path_column = columns.index('__path__')
+      paths = sorted(paths)
+      for i in xrange(0, len(paths), _MAX_IN_CLAUSE_SIZE):
+        chunk = paths[i:i + _MAX_IN_CLAUSE_SIZE]
+        chunk_paths = set(chunk)
+        keep = sorted(hashed_index for hashed_index, row in rows.items()
+                      if row[path_column] in chunk_paths)
+        if not keep:
+          Delete(table, '__path__', chunk)
+          continue
+        statements.append(('DELETE FROM %s WHERE __path__ IN (%s) '
+                           'AND hashed_index NOT IN (%s)'
+                           % (table, self.__MakeParamList(len(chunk)),
+                              self.__MakeParamList(len(keep))),
+                           chunk + keep))
+
+    def Insert(verb, table, columns, rows):
+      if not rows:
+        return
+      row_params = '(%s)' % self.__MakeParamList(len(columns))
+      statements.append(('%s INTO %s (%s) VALUES %s'
+                         % (verb, table, ', '.join(columns),
+                            ', '.join([row_params] * len(rows))),
+                         list(itertools.chain(*rows))))
+
+    # (table, columns, written paths, deleted paths, rows by hashed_index)
+    index_tables = []
+    for prefix, (entities, keys) in sorted(by_prefix.items()):
+      rows = {}
+      for entity in entities:
+        for row in self.__GetIndexRows(entity, memo):
+          rows[row[4]] = row
+      index_tables.append((
+          '%s_EntitiesByProperty' % prefix,
+          ('kind', 'name', 'value', '__path__', 'hashed_index'),
+          set(memo.Path(entity.key()) for entity in entities),
+          set(memo.Path(key) for key in keys),
+          rows))
+
+      all_keys = [entity.key() for entity in entities] + keys
+      app_indexes = self.__indexes.get(all_keys[0].app(), {})
+      composite = {}
+      for entity in entities:
+        for index in app_indexes.get(memo.Kind(entity.key()), []):
+          written, deleted, rows = composite.setdefault(
+              self.__CompositeIndexTable(prefix, index), (set(), set(), {}))
+          written.add(memo.Path(entity.key()))
+          rows.update(self.__GetCompositeIndexRows(index, entity, memo))
+      for key in keys:
+        for index in app_indexes.get(memo.Kind(key), []):
+          composite.setdefault(self.__CompositeIndexTable(prefix, index),
+                               (set(), set(), {}))[1].add(memo.Path(key))
+      for table, (written, deleted, rows) in sorted(composite.items()):
+        index_tables.append((table, ('sort_key', '__path__', 'hashed_index'),
+                             written, deleted, rows))
+
+    for table, columns, written, deleted, rows in index_tables:
+      Delete(table, '__path__', deleted)
+      DeleteStale(table, columns, written, rows)
+    for prefix, (entities, keys) in sorted(by_prefix.items()):
+      Insert('REPLACE', '%s_Entities' % prefix,
+             ('__path__', 'kind', 'entity'),
+             [(memo.Path(entity.key()), memo.Kind(entity.key()),
+               buffer(entity.Encode()))
+              for entity in entities])
+    for table, columns, written, deleted, rows in index_tables:
+      Insert('INSERT IGNORE', table, columns, rows.values())
+    for prefix, (entities, keys) in sorted(by_prefix.items()):
+      Delete('%s_Entities' % prefix, '__path__',
+             [memo.Path(key) for key in keys])
+    return statements
+
+  def __ExecuteBatch(self, conn, statements, committed_at=None):
+    """Executes statements in a single round trip.
+
+    Multi statements are turned on for the connection only while the batch
+    runs. Errors of any statement are raised once its result is reached; the
+    server skips the statements that follow it.
+
+    Args:
+      conn: A MySQL connection opened with CLIENT.MULTI_RESULTS.
+      statements: A non-empty list of (sql, params) tuples.
+      committed_at: The position of a COMMIT statement in the batch, if any.
+        Errors of the statements following it are logged instead of raised,
+        since the transaction has been committed.
+    Returns:
+      A list with the rows returned by each statement that was executed.
+    """
+    params = []
+    for unused_sql, statement_params in statements:
+      params.extend(statement_params)
+    cursor = conn.cursor()
+    results = []
+    conn.set_server_option(_MYSQL_OPTION_MULTI_STATEMENTS_ON)
+    try:
+      try:
+        self._ExecuteSQL(
+            ';\n'.join([sql for sql, unused_params in statements]),
+            params, cursor)
+        results.append(cursor.fetchall())
+        while cursor.nextset():
+          results.append(cursor.fetchall())
+      finally:
+        conn.set_server_option(_MYSQL_OPTION_MULTI_STATEMENTS_OFF)
+    except MySQLdb.Error, e:
+      if committed_at is None or len(results) <= committed_at:
+        raise
+      logging.error('Error after committing a transaction: %s', e)
+    return results
+
+  @staticmethod
+  def __EstimateBatchSize(statements):
+    """Returns the size of a batch of statements in bytes, once escaped.
+
+    Args:
+      statements: A list of (sql, params) tuples.
+    """
+    size = 0
+    for sql, params in statements:
+      size += len(sql)
+      for param in params:
+        if param is None:
+          size += 4
+          continue
+        if isinstance(param, unicode):
+          param = param.encode('utf-8')
+        elif isinstance(param, buffer):
+          param = str(param)
+        elif not isinstance(param, str):
+          size += len(str(param))
+          continue
+        size += len(param) + 3
+        for char in _ESCAPED_CHARS:
+          size += param.count(char)
+    return size
+
+  def _Dynamic_RunQuery(self, query, query_result):
+    if self.__stream_queries and not query.has_transaction():
+      conn = self.__pool.Checkout()
+      release = lambda discard: self.__CheckinStreamingConnection(conn,
+                                                                  discard)
+      try:
+        cursor = self.__GetQueryCursor(conn, query, release)
+      except:
+        self.__pool.Checkin(conn, discard=True)
+        raise
+      self.__StartQueryCursor(query, cursor, query_result)
+      return
+
+    conn = self.__GetConnection(query.transaction())
+    try:
+      cursor = self.__GetQueryCursor(conn, query)
+      self.__StartQueryCursor(query, cursor, query_result)
+    finally:
+      self.__ReleaseConnection(conn, query.transaction())
+
+  def __StartQueryCursor(self, query, cursor, query_result):
+    """Registers a new query cursor and fills in its first batch of results.
+
+    Cursors which run out of results are closed but stay registered, so that
+    Next answers them with empty batches until they are evicted.
+
+    Args:
+      query: The datastore_pb.Query the cursor was created for.
+      cursor: A QueryCursor.
+      query_result: out: A datastore_pb.QueryResult PB.
+    """
+    self.__cursor_lock.acquire()
+    cursor_id = self.__next_cursor_id
+    self.__next_cursor_id += 1
+    self.__cursor_lock.release()
+
+    cursor_pb = query_result.mutable_cursor()
+    cursor_pb.set_app(query.app())
+    cursor_pb.set_cursor(cursor_id)
+
+    if query.has_count():
+      count = query.count()
+    elif query.has_limit():
+      count = query.limit()
+    else:
+      count = _BATCH_SIZE
+
+    cursor.PopulateQueryResult(count, query_result)
+    if not query_result.more_results():
+      cursor.Close()
+    self.__cursors.Put((query.app(), cursor_id), cursor, cursor.EstimateSize())
+
+  def __CheckinStreamingConnection(self, conn, discard):
+    """Returns the connection of a closed streaming cursor to the pool.
+
+    Args:
+      conn: The MySQL connection.
+      discard: True if the cursor was not read to the end. Unread rows would
+        have to be drained before the connection could be reused, so it is
+        closed instead.
+    """
+    if not discard:
+      try:
+        conn.rollback()
+      except MySQLdb.Error:
+        discard = True
+    self.__pool.Checkin(conn, discard)
+
+  def _Dynamic_Next(self, next_request, query_result):
+    self.__ValidateAppId(next_request.cursor().app())
+
+    app_id = next_request.cursor().app()
+    cursor_id = next_request.cursor().cursor()
+    cursor = self.__cursors.Pop((app_id, cursor_id))
+    if cursor is None:
+      if 0 < cursor_id < self.__next_cursor_id:
+        raise apiproxy_errors.ApplicationError(
+            datastore_pb.Error.BAD_REQUEST,
+            'Cursor %d expired or was evicted; resume the query from a '
+            'compiled cursor instead' % cursor_id)
+      raise apiproxy_errors.ApplicationError(
+          datastore_pb.Error.BAD_REQUEST,
+          'Cursor %d not found' % cursor_id)
+
+    assert cursor.app == app_id
+
+    count = _BATCH_SIZE
+    if next_request.has_count():
+      count = next_request.count()
+    cursor.PopulateQueryResult(count, query_result)
+    if not query_result.more_results():
+      cursor.Close()
+    self.__cursors.Put((app_id, cursor_id), cursor, cursor.EstimateSize())
+
+  def _Dynamic_Count(self, query, integer64proto):
+    if self.__trusted:
+      max_count = self.__trusted_count_limit
+    else:
+      max_count = _MAXIMUM_RESULTS
+    if max_count is not None:
+      if query.has_limit():
+        query.set_limit(min(query.limit(), max_count))
+      else:
+        query.set_limit(max_count)
+
+    conn = self.__GetConnection(query.transaction())
+    try:
+      integer64proto.set_value(self.__CountQuery(conn, query))
+    finally:
+      self.__ReleaseConnection(conn, query.transaction())
+
+  def _Dynamic_BeginTransaction(self, request, transaction):
+    self.__ValidateAppId(request.app())
+
+    conn = self.__pool.Checkout()
+    self.__tx_lock.acquire()
+    try:
+      handle = self.__next_tx_handle
+      self.__next_tx_handle += 1
+      self.__transactions[handle] = TransactionState(handle, conn)
+    finally:
+      self.__tx_lock.release()
+
+    transaction.set_app(request.app())
+    transaction.set_handle(handle)
+
+  def _Dynamic_AddActions(self, request, _):
+
+    new_actions = {}
+    for add_request in request.add_request_list():
+      clone = taskqueue_service_pb.TaskQueueAddRequest()
+      clone.CopyFrom(add_request)
+      clone.clear_transaction()
+      new_actions.setdefault(add_request.transaction().handle(), []).append(
+          (add_request.transaction(), clone))
+
+    for actions in new_actions.values():
+      tx = self.__LockTransaction(actions[0][0])
+      actions = [clone for _, clone in actions]
+      try:
+        if (len(tx.actions) + len(actions) >
+            self.__max_actions_per_transaction):
+          raise apiproxy_errors.ApplicationError(
+              datastore_pb.Error.BAD_REQUEST,
+              'Too many messages, maximum allowed %s'
+              % self.__max_actions_per_transaction)
+        tx.actions.extend(actions)
+      finally:
+        tx.lock.release()
+
+  def _Dynamic_Commit(self, transaction, _):
+    tx = self.__LockTransaction(transaction)
+    conn = tx.conn
+    mutated_keys = (tx.flushed + [entity.key() for entity in tx.writes.values()]
+                    + tx.deletes.values())
+
+    try:
+      try:
+        bumps = []
+        if self.__optimistic_transactions and mutated_keys:
+          bumps = self.__CheckEntityGroupVersions(conn, tx)
+
+        generation = self.__EnterIndexWrite()
+        try:
+          statements = list(bumps)
+          if tx.writes or tx.deletes:
+            statements.extend(self.__CompileMutations(tx.writes.values(),
+                                                      tx.deletes.values()))
+          if self.__EstimateBatchSize(statements) > _MAX_COMMIT_BATCH_BYTES:
+            if bumps:
+              self.__ExecuteBatch(conn, bumps)
+            self.__FlushTransaction(tx)
+            conn.commit()
+          else:
+            locks = sorted([entity_group for entity_group, version
+                            in tx.entity_groups.items() if version is None])
+            committed_at = len(statements)
+            statements.append(('COMMIT', ()))
+            statements.extend([('SELECT RELEASE_LOCK(%s)', (entity_group,))
+                               for entity_group in locks])
+            results = self.__ExecuteBatch(conn, statements, committed_at)
+            # Locks whose release did not run are released when the
+            # transaction ends.
+            for entity_group, unused_result in zip(
+                locks, results[committed_at + 1:]):
+              del tx.entity_groups[entity_group]
+        finally:
+          self.__ExitIndexWrite(generation)
+      except MySQLdb.OperationalError, e:
+        conn.rollback()
+        if e.args and e.args[0] in _LOCK_CONFLICT_ERRORS:
+          raise apiproxy_errors.ApplicationError(
+              datastore_pb.Error.CONCURRENT_TRANSACTION,
+              'too much contention on these datastore entities. '
+              'please try again.')
+        raise
+      except:
+        conn.rollback()
+        raise
+    finally:
+      self.__EndTransaction(tx)
+    self.__InvalidateCachedEntities(mutated_keys)
+    self.__EnqueueActions(tx.actions)
+
+  def __EnqueueActions(self, actions):
+    """Adds the tasks of a committed transaction to the task queue.
+
+    Tasks are sent with one BulkAdd call per queue and chunk of
+    _MAX_TASKS_PER_BULK_ADD tasks. Tasks that cannot be added are logged and
+    dropped, since the transaction has already been committed.
+
+    Args:
+      actions: A list of taskqueue_service_pb.TaskQueueAddRequest PBs.
+    """
+    by_queue = {}
+    for action in actions:
+      by_queue.setdefault(action.queue_name(), []).append(action)
+    for queue_actions in by_queue.values():
+      for i in xrange(0, len(queue_actions), _MAX_TASKS_PER_BULK_ADD):
+        chunk = queue_actions[i:i + _MAX_TASKS_PER_BULK_ADD]
+        request = taskqueue_service_pb.TaskQueueBulkAddRequest()
+        for action in chunk:
+          request.add_add_request().CopyFrom(action)
+        response = taskqueue_service_pb.TaskQueueBulkAddResponse()
+        try:
+          apiproxy_stub_map.MakeSyncCall(
+              'taskqueue', 'BulkAdd', request, response)
+        except apiproxy_errors.ApplicationError, e:
+          for action in chunk:
+            logging.warning('Transactional task %s has been dropped, %s',
+                            action, e)
+          continue
+        for action, result in zip(chunk, response.taskresult_list()):
+          if result.result() != taskqueue_service_pb.TaskQueueServiceError.OK:
+            logging.warning('Transactional task %s has been dropped, %s',
+                            action, result.result())
+
+  def _Dynamic_Rollback(self, transaction, _):
+    tx = self.__LockTransaction(transaction)
+    try:
+      tx.conn.rollback()
+    finally:
+      self.__EndTransaction(tx)
+
+  def __EndTransaction(self, tx):
+    """Ends a transaction and releases its entity group locks and connection.
+
+    Args:
+      tx: The TransactionState of the committed or rolled back transaction,
+        locked by the caller.
+    """
+    self.__tx_lock.acquire()
+    try:
+      self.__transactions.pop(tx.handle, None)
+    finally:
+      self.__tx_lock.release()
+
+    discard = False
+    try:
+      try:
+        for entity_group, version in tx.entity_groups.items():
+          if version is None:
+            self.__ReleaseLockForEntityGroup(tx.conn, entity_group)
+      except MySQLdb.Error, e:
+        # Closing the connection releases its locks. The transaction has
+        # already been committed or rolled back, so this is not an error
+        # of the caller's request.
+        logging.error('Discarding connection after failed unlock: %s', e)
+        discard = True
+    finally:
+      self.__pool.Checkin(tx.conn, discard)
+      tx.conn = None
+      tx.lock.release()
+
+  def _Dynamic_GetSchema(self, req, schema):
+    conn = self.__GetConnection(None)
+    try:
+      prefix = self.__GetTablePrefix(req)
+
+      filters = []
+      if req.has_start_kind():
+        filters.append(('kind', datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL,
+                        req.start_kind()))
+      if req.has_end_kind():
+        filters.append(('kind', datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL,
+                        req.end_kind()))
+
+      params = []
+      if req.properties():
+        sql_stmt = ('SELECT kind, name, value FROM %s_EntitiesByProperty %s '
+                    'GROUP BY kind, name, substr(value, 1, 1) ORDER BY kind'
+                    % (prefix, self.__CreateFilterString(filters, params)))
+      else:
+        sql_stmt = ('SELECT kind FROM %s_Entities %s GROUP BY kind'
+                    % (prefix, self.__CreateFilterString(filters, params)))
+      cursor = conn.cursor()
+      self._ExecuteSQL(sql_stmt, params, cursor)
+
+      kind = None
+      current_name = None
+      kind_pb = None
+      for row in cursor.fetchall():
+        if row[0] != kind:
+          if kind_pb:
+            schema.kind_list().append(kind_pb)
+          kind = row[0].encode('utf-8')
+          kind_pb = entity_pb.EntityProto()
+          kind_pb.mutable_key().set_app(req.app())
+          kind_pb.mutable_key().mutable_path().add_element().set_type(kind)
+          kind_pb.mutable_entity_group()
+
+        if req.properties():
+          name, value_data = row[1:]
+          if current_name != name:
+            current_name = name
+            prop_pb = kind_pb.add_property()
+            prop_pb.set_name(name.encode('utf-8'))
+            prop_pb.set_multiple(False)
+          value_decoder = sortable_pb_encoder.Decoder(
+              array.array('B', str(value_data)))
+          value_pb = prop_pb.mutable_value()
+          value_pb.Merge(value_decoder)
+
+          if value_pb.has_int64value():
+            value_pb.set_int64value(0)
+          if value_pb.has_booleanvalue():
+            value_pb.set_booleanvalue(False)
+          if value_pb.has_stringvalue():
+            value_pb.set_stringvalue('none')
+          if value_pb.has_doublevalue():
+            value_pb.set_doublevalue(0.0)
+          if value_pb.has_pointvalue():
+            value_pb.mutable_pointvalue().set_x(0.0)
+            value_pb.mutable_pointvalue().set_y(0.0)
+          if value_pb.has_uservalue():
+            value_pb.mutable_uservalue().set_gaiaid(0)
+            value_pb.mutable_uservalue().set_email('none')
+            value_pb.mutable_uservalue().set_auth_domain('none')
+            value_pb.mutable_uservalue().clear_nickname()
+            value_pb.mutable_uservalue().clear_obfuscated_gaiaid()
+          if value_pb.has_referencevalue():
+            value_pb.clear_referencevalue()
+            value_pb.mutable_referencevalue().set_app('none')
+            pathelem = value_pb.mutable_referencevalue().add_pathelement()
+            pathelem.set_type('none')
+            pathelem.set_name('none')
+
+      if kind_pb:
+        schema.kind_list().append(kind_pb)
+    finally:
+      self.__ReleaseConnection(conn, None)
+
+  def _Dynamic_AllocateIds(self, allocate_ids_request, allocate_ids_response):
+    conn = self.__GetConnection(None)
+    try:
+      model_key = allocate_ids_request.model_key()
+      size = allocate_ids_request.size()
+
+      self.__ValidateAppId(model_key.app())
+
+      first_id = self.__AllocateIds(conn, self.__GetTablePrefix(model_key),
+                                    size)
+      allocate_ids_response.set_start(first_id)
+      allocate_ids_response.set_end(first_id + size - 1)
+    finally:
+      self.__ReleaseConnection(conn, None)
+
+  def __FindIndex(self, index):
+    """Finds an existing index by definition.
+
+    Args:
+      index: entity_pb.CompositeIndex
+
+    Returns:
+      entity_pb.CompositeIndex, if it exists; otherwise None
+    """
+    app_indexes = self.__indexes.get(index.app_id(), {})
+    for stored_index in app_indexes.get(index.definition().entity_type(), []):
+      if index.definition() == stored_index.definition():
+        return stored_index
+
+    return None
+
+  def _Dynamic_CreateIndex(self, index, id_response):
+    app_id = index.app_id()
+    kind = index.definition().entity_type()
+
+    self.__ValidateAppId(app_id)
+    if index.id() != 0:
+      raise apiproxy_errors.ApplicationError(datastore_pb.Error.BAD_REQUEST,
+                                             'New index id must be 0.')
+
+    self.__index_lock.acquire()
+    try:
+      if self.__FindIndex(index):
+        raise apiproxy_errors.ApplicationError(datastore_pb.Error.BAD_REQUEST,
+                                               'Index already exists.')
+
+      next_id = max([idx.id() for x in self.__indexes.get(app_id, {}).values()
+                     for idx in x] + [0]) + 1
+      index.set_id(next_id)
+      id_response.set_value(next_id)
+
+      clone = entity_pb.CompositeIndex()
+      clone.CopyFrom(index)
+
+      # The index is maintained by writes before it is backfilled, and only
+      # used by queries once the backfill has finished.
+      conn = self.__GetConnection(None)
+      try:
+        self.__namespace_lock.acquire()
+        try:
+          for index_app_id, name_space in self.__namespaces:
+            if index_app_id == app_id:
+              self.__CreateCompositeIndexTable(
+                  conn, self.__GetTablePrefix((app_id, name_space)), clone)
+          self.__building_indexes.add((app_id, next_id))
+          self.__indexes.setdefault(app_id, {}).setdefault(kind, []).append(
+              clone)
+        finally:
+          self.__namespace_lock.release()
+        try:
+          self.__WaitForIndexWrites()
+          for index_app_id, name_space in list(self.__namespaces):
+            if index_app_id == app_id:
+              self.__MaterializeCompositeIndex(
+                  conn, self.__GetTablePrefix((app_id, name_space)), clone)
+          self.__WriteIndexData(conn, app_id)
+          conn.commit()
+        except:
+          self.__indexes[app_id][kind].remove(clone)
+          raise
+      finally:
+        self.__building_indexes.discard((app_id, next_id))
+        self.__ReleaseConnection(conn, None)
+    finally:
+      self.__index_lock.release()
+
+  def _Dynamic_GetIndices(self, app_str, composite_indices):
+    self.__ValidateAppId(app_str.value())
+
+    index_list = composite_indices.index_list()
+    for indexes in self.__indexes.get(app_str.value(), {}).values():
+      index_list.extend(indexes)
+
+  def _Dynamic_UpdateIndex(self, index, _):
+    self.__ValidateAppId(index.app_id())
+    my_index = self.__FindIndex(index)
+    if not my_index:
+      raise apiproxy_errors.ApplicationError(datastore_pb.Error.BAD_REQUEST,
+                                             "Index doesn't exist.")
+    elif (index.state() != my_index.state() and
+          index.state() not in self._INDEX_STATE_TRANSITIONS[my_index.state()]):
+      raise apiproxy_errors.ApplicationError(
+          datastore_pb.Error.BAD_REQUEST,
+          'Cannot move index state from %s to %s' %
+          (entity_pb.CompositeIndex.State_Name(my_index.state()),
+           (entity_pb.CompositeIndex.State_Name(index.state()))))
+
+    self.__index_lock.acquire()
+    try:
+      my_index.set_state(index.state())
+    finally:
+      self.__index_lock.release()
+
+  def _Dynamic_DeleteIndex(self, index, _):
+    app_id = index.app_id()
+    kind = index.definition().entity_type()
+    self.__ValidateAppId(app_id)
+
+    my_index = self.__FindIndex(index)
+    if not my_index:
+      raise apiproxy_errors.ApplicationError(datastore_pb.Error.BAD_REQUEST,
+                                             "Index doesn't exist.")
+
+    self.__index_lock.acquire()
+    try:
+      self.__indexes[app_id][kind].remove(my_index)
+      conn = self.__GetConnection(None)
+      try:
+        self.__WriteIndexData(conn, app_id)
+        self.__DropCompositeIndex(conn, my_index)
+      finally:
+        self.__ReleaseConnection(conn, None)
+    finally:
+      self.__index_lock.release()
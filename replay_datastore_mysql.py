@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2010 Tobias Rodäbel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Replays RPCs captured with DatastoreMySQLStub.StartRecording.
+
+The calls of a log are re-issued against a fresh stub, at their original
+pace or faster, on a configurable number of threads:
+
+    python replay_datastore_mysql.py --speed 4 --threads 8 traffic.log
+
+Calls that one thread of the recorded process made are replayed in order
+by one thread. Transaction handles and cursors are mapped from the recorded
+to the new ones. Transactional tasks are not replayed. The database given
+with --db is cleared first, and a JSON summary is written at the end.
+"""
+
+from google.appengine.api import api_base_pb
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.datastore import datastore_pb
+from google.appengine.datastore import entity_pb
+
+import optparse
+import os
+import Queue
+import sys
+import threading
+import time
+import typhoonae.mysql.datastore_mysql_stub
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+PB_CLASSES = {
+    'Get': (datastore_pb.GetRequest, datastore_pb.GetResponse),
+    'Put': (datastore_pb.PutRequest, datastore_pb.PutResponse),
+    'Delete': (datastore_pb.DeleteRequest, datastore_pb.DeleteResponse),
+    'RunQuery': (datastore_pb.Query, datastore_pb.QueryResult),
+    'Next': (datastore_pb.NextRequest, datastore_pb.QueryResult),
+    'Count': (datastore_pb.Query, api_base_pb.Integer64Proto),
+    'BeginTransaction': (datastore_pb.BeginTransactionRequest,
+                         datastore_pb.Transaction),
+    'Commit': (datastore_pb.Transaction, api_base_pb.VoidProto),
+    'Rollback': (datastore_pb.Transaction, api_base_pb.VoidProto),
+    'AllocateIds': (datastore_pb.AllocateIdsRequest,
+                    datastore_pb.AllocateIdsResponse),
+    'GetSchema': (datastore_pb.GetSchemaRequest, datastore_pb.Schema),
+    'CreateIndex': (entity_pb.CompositeIndex, api_base_pb.Integer64Proto),
+    'GetIndices': (api_base_pb.StringProto, datastore_pb.CompositeIndices),
+    'UpdateIndex': (entity_pb.CompositeIndex, api_base_pb.VoidProto),
+    'DeleteIndex': (entity_pb.CompositeIndex, api_base_pb.VoidProto),
+}
+
+
+def percentile(sorted_values, fraction):
+    """Returns a percentile of a sorted list by nearest rank."""
+
+    if not sorted_values:
+        return None
+    index = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+class Replayer(object):
+    """Re-issues recorded calls and maps handles between the two runs."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.transactions = {}
+        self.cursors = {}
+        self.latencies = {}
+        self.errors = {}
+        self.mismatches = {}
+        self.lag = []
+
+    def map_transaction(self, transaction):
+        self.lock.acquire()
+        try:
+            handle = self.transactions.get(transaction.handle())
+        finally:
+            self.lock.release()
+        if handle is not None:
+            transaction.set_handle(handle)
+
+    def prepare(self, call, request):
+        """Rewrites recorded handles in a request to the replayed ones."""
+
+        if call in ('Commit', 'Rollback'):
+            self.map_transaction(request)
+        elif call == 'Next':
+            self.lock.acquire()
+            try:
+                cursor = self.cursors.get(request.cursor().cursor())
+            finally:
+                self.lock.release()
+            if cursor is not None:
+                request.mutable_cursor().set_cursor(cursor)
+        elif call in ('Get', 'Put', 'Delete', 'RunQuery', 'Count'):
+            if request.has_transaction():
+                self.map_transaction(request.mutable_transaction())
+
+    def learn(self, call, recorded, response):
+        """Remembers the new handle of a recorded response."""
+
+        if not recorded:
+            return
+        if call == 'BeginTransaction':
+            original = datastore_pb.Transaction(recorded)
+            self.lock.acquire()
+            try:
+                self.transactions[original.handle()] = response.handle()
+            finally:
+                self.lock.release()
+        elif call == 'RunQuery' and response.has_cursor():
+            original = datastore_pb.QueryResult(recorded)
+            self.lock.acquire()
+            try:
+                self.cursors[original.cursor().cursor()] = (
+                    response.cursor().cursor())
+            finally:
+                self.lock.release()
+
+    def replay(self, record, due):
+        """Issues one recorded call once it is due."""
+
+        (service, call, unused_start, unused_seconds, unused_thread, error,
+         request_data, response_data) = record
+        delay = due - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        request_class, response_class = PB_CLASSES[call]
+        request = request_class(request_data)
+        response = response_class()
+        self.prepare(call, request)
+
+        start = time.time()
+        failed = False
+        try:
+            apiproxy_stub_map.MakeSyncCall(service, call, request, response)
+        except Exception:
+            failed = True
+        elapsed = time.time() - start
+
+        if not failed:
+            self.learn(call, response_data, response)
+        self.lock.acquire()
+        try:
+            self.lag.append(max(0.0, start - due))
+            self.latencies.setdefault(call, []).append(elapsed)
+            if failed:
+                self.errors[call] = self.errors.get(call, 0) + 1
+            if failed != error:
+                self.mismatches[call] = self.mismatches.get(call, 0) + 1
+        finally:
+            self.lock.release()
+
+    def summary(self):
+        calls = {}
+        for call, latencies in self.latencies.items():
+            latencies.sort()
+            calls[call] = {
+                'count': len(latencies),
+                'errors': self.errors.get(call, 0),
+                'error_mismatches': self.mismatches.get(call, 0),
+                'p50_ms': percentile(latencies, 0.5) * 1000,
+                'p90_ms': percentile(latencies, 0.9) * 1000,
+                'p99_ms': percentile(latencies, 0.99) * 1000,
+                'max_ms': latencies[-1] * 1000,
+            }
+        self.lag.sort()
+        return {
+            'calls': calls,
+            'lag_p50_ms': (percentile(self.lag, 0.5) or 0) * 1000,
+            'lag_p99_ms': (percentile(self.lag, 0.99) or 0) * 1000,
+        }
+
+
+def worker(replayer, queue):
+    while True:
+        item = queue.get()
+        if item is None:
+            return
+        replayer.replay(*item)
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage='%prog [options] LOG')
+    parser.add_option('--host', default='127.0.0.1')
+    parser.add_option('--user', default='root')
+    parser.add_option('--passwd', default='')
+    parser.add_option('--db', default='replaydb',
+                      help='database to use; it is cleared')
+    parser.add_option('--app-id', default=None,
+                      help='application id of the stub, default: '
+                           '$APPLICATION_ID or test')
+    parser.add_option('--speed', type='float', default=1.0,
+                      help='speed-up factor; 0 replays without pauses')
+    parser.add_option('--threads', type='int', default=4)
+    parser.add_option('--output', help='JSON file, default standard output')
+    options, args = parser.parse_args(argv[1:])
+    if len(args) != 1:
+        parser.error('expected the name of one log file')
+
+    read_log = typhoonae.mysql.datastore_mysql_stub.ReadRpcLog
+    records = [record for record in read_log(args[0])
+               if record[1] in PB_CLASSES]
+    if not records:
+        parser.error('the log holds no calls to replay')
+    # Calls are logged when they finish; replay them in the order they began.
+    records.sort(key=lambda record: record[2])
+
+    app_id = options.app_id
+    if app_id is None:
+        app_id = os.environ.get('APPLICATION_ID', 'test')
+    os.environ['APPLICATION_ID'] = app_id
+    database_info = {
+        'host': options.host,
+        'user': options.user,
+        'passwd': options.passwd,
+        'db': options.db,
+    }
+    apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+    stub = typhoonae.mysql.datastore_mysql_stub.DatastoreMySQLStub(
+        app_id, database_info, verbose=False, trusted=True,
+        pool_size=max(8, options.threads * 2))
+    apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', stub)
+    stub.Clear()
+
+    replayer = Replayer()
+    queues = [Queue.Queue() for i in range(options.threads)]
+    threads = [threading.Thread(target=worker, args=(replayer, queue))
+               for queue in queues]
+    for t in threads:
+        t.setDaemon(True)
+        t.start()
+
+    assigned = {}
+    log_start = records[0][2]
+    replay_start = time.time()
+    for record in records:
+        thread_id = record[4]
+        if thread_id not in assigned:
+            assigned[thread_id] = queues[len(assigned) % len(queues)]
+        if options.speed > 0:
+            due = replay_start + (record[2] - log_start) / options.speed
+        else:
+            due = replay_start
+        assigned[thread_id].put((record, due))
+    for queue in queues:
+        queue.put(None)
+    for t in threads:
+        t.join()
+
+    report = replayer.summary()
+    report['records'] = len(records)
+    report['recorded_sec'] = records[-1][2] + records[-1][3] - log_start
+    report['replayed_sec'] = time.time() - replay_start
+    report['options'] = options.__dict__
+
+    if options.output:
+        output = open(options.output, 'w')
+    else:
+        output = sys.stdout
+    try:
+        json.dump(report, output, indent=2, sort_keys=True)
+        output.write('\n')
+    finally:
+        if options.output:
+            output.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -15,6 +15,7 @@
 # limitations under the License.
 """Unit tests for the Datastore MySQL stub."""
 
+from google.appengine.api import api_base_pb
 from google.appengine.api import apiproxy_stub
 from google.appengine.api import apiproxy_stub_map
 from google.appengine.api import datastore
@@ -24,12 +25,19 @@ from google.appengine.api import datastore_types
 from google.appengine.api import users
 from google.appengine.api.labs import taskqueue
 from google.appengine.datastore import datastore_index
+from google.appengine.datastore import datastore_pb
+from google.appengine.datastore import entity_pb
 from google.appengine.ext import db
 from google.appengine.ext.db import polymodel
 from google.appengine.runtime import apiproxy_errors
 
 import datetime
 import os
+import random
+import shutil
+import struct
+import tempfile
+import threading
 import time
 import typhoonae.mysql.datastore_mysql_stub
 import unittest
@@ -40,12 +48,130 @@ class TaskQueueServiceStubMock(apiproxy_stub.APIProxyStub):
 
     def __init__(self, service_name='taskqueue', root_path=None):
         super(TaskQueueServiceStubMock, self).__init__(service_name)
+        self.bulk_add_requests = []
 
     def _Dynamic_Add(self, request, response):
         pass
 
     def _Dynamic_BulkAdd(self, request, response):
-        response.add_taskresult()
+        self.bulk_add_requests.append(request)
+        for unused_add_request in request.add_request_list():
+            response.add_taskresult()
+
+
+class SortableEncodingTestCase(unittest.TestCase):
+    """Testing the fast sortable encoding against the generic encoder."""
+
+    def randomInteger(self, rng):
+        bits = rng.randint(1, 63)
+        return rng.randint(-(1 << bits) + 1, (1 << bits) - 2)
+
+    def randomString(self, rng):
+        return ''.join(chr(rng.choice([0, 1, 2, rng.randint(0, 255)]))
+                       for i in range(rng.randint(0, 16)))
+
+    def randomValue(self, rng):
+        value = entity_pb.PropertyValue()
+        value_type = rng.choice(
+            ['int64', 'boolean', 'string', 'double', 'reference'])
+        if value_type == 'int64':
+            value.set_int64value(self.randomInteger(rng))
+        elif value_type == 'boolean':
+            value.set_booleanvalue(rng.random() < 0.5)
+        elif value_type == 'string':
+            value.set_stringvalue(self.randomString(rng))
+        elif value_type == 'double':
+            value.set_doublevalue(rng.choice([
+                rng.uniform(-1e6, 1e6),
+                struct.unpack('>d', struct.pack('>Q', rng.getrandbits(64)))[0],
+                0.0,
+                -0.0]))
+        else:
+            ref = value.mutable_referencevalue()
+            ref.set_app(self.randomString(rng) or 'test')
+            for i in range(rng.randint(1, 3)):
+                element = ref.add_pathelement()
+                element.set_type(self.randomString(rng) or 'Kind')
+                if rng.random() < 0.5:
+                    element.set_id(self.randomInteger(rng))
+                else:
+                    element.set_name(self.randomString(rng))
+        return value_type, value
+
+    def boundaryValues(self):
+        """Yields values at the edges of each fast encoding."""
+
+        for number in (0, 1, -1, 119, -119, 120, -120, 255, -255, 374, -374,
+                       375, -375, 1 << 31, -(1 << 31), 1 << 56, -(1 << 56),
+                       (1 << 63) - 2, -(1 << 63) + 1):
+            value = entity_pb.PropertyValue()
+            value.set_int64value(number)
+            yield value
+        for flag in (True, False):
+            value = entity_pb.PropertyValue()
+            value.set_booleanvalue(flag)
+            yield value
+        for string in ('', 'abc', '\x00', '\x01', '\x02', 'a\x00\x01\x01b',
+                       '\xff' * 3, u'\xe4'.encode('utf-8')):
+            value = entity_pb.PropertyValue()
+            value.set_stringvalue(string)
+            yield value
+        for number in (0.0, -0.0, 1.5, -1.5, 1e-300, -1e-300, 1e300, -1e300,
+                       float('inf'), float('-inf')):
+            value = entity_pb.PropertyValue()
+            value.set_doublevalue(number)
+            yield value
+        for path in ((('Parent', 1), ('Child', 'name')),
+                     (('Kind', -375),), (('Kind', 1 << 40),),
+                     (('K\x00ind', 'n\x01ame'),)):
+            value = entity_pb.PropertyValue()
+            ref = value.mutable_referencevalue()
+            ref.set_app('app')
+            for kind, id_or_name in path:
+                element = ref.add_pathelement()
+                element.set_type(kind)
+                if isinstance(id_or_name, basestring):
+                    element.set_name(id_or_name)
+                else:
+                    element.set_id(id_or_name)
+            yield value
+
+    def testBoundaryValues(self):
+        """Fast and generic encodings are identical at the boundaries."""
+
+        stub_module = typhoonae.mysql.datastore_mysql_stub
+        for value in self.boundaryValues():
+            encoded = stub_module.FastEncodeSortable(value)
+            self.assertNotEqual(None, encoded, repr(value))
+            self.assertEqual(stub_module.EncodeSortable(value), encoded,
+                             repr(value))
+
+    def testRandomizedValues(self):
+        """Fast and generic encodings are identical for random values."""
+
+        stub_module = typhoonae.mysql.datastore_mysql_stub
+        rng = random.Random(1234)
+        for i in range(5000):
+            value_type, value = self.randomValue(rng)
+            encoded = stub_module.FastEncodeSortable(value)
+            self.assertNotEqual(None, encoded, value_type)
+            self.assertEqual(stub_module.EncodeSortable(value), encoded,
+                             '%s: %r' % (value_type, value))
+
+    def testGenericFallback(self):
+        """Values without a fast path are left to the generic encoder."""
+
+        stub_module = typhoonae.mysql.datastore_mysql_stub
+        value = entity_pb.PropertyValue()
+        self.assertEqual(None, stub_module.FastEncodeSortable(value))
+        value.mutable_uservalue().set_email('tester@mydomain.local')
+        self.assertEqual(None, stub_module.FastEncodeSortable(value))
+        value = entity_pb.PropertyValue()
+        ref = value.mutable_referencevalue()
+        ref.set_app('test')
+        ref.set_name_space('ns')
+        ref.add_pathelement().set_type('Kind')
+        self.assertEqual(None, stub_module.FastEncodeSortable(value))
 
 
 class DatastoreMySQLTestCaseBase(unittest.TestCase):
@@ -60,6 +186,11 @@ class DatastoreMySQLTestCaseBase(unittest.TestCase):
         os.environ['USER_EMAIL'] = 'tester@mydomain.local'
         os.environ['USER_IS_ADMIN'] = '1'
 
+        self.registerStub()
+
+    def registerStub(self, **kwargs):
+        """Registers a new stub, created with the given keyword arguments."""
+
         # Register API proxy stub.
         apiproxy_stub_map.apiproxy = (apiproxy_stub_map.APIProxyStubMap())
 
@@ -71,7 +202,7 @@ class DatastoreMySQLTestCaseBase(unittest.TestCase):
         }
 
         datastore = typhoonae.mysql.datastore_mysql_stub.DatastoreMySQLStub(
-            'test', database_info)
+            'test', database_info, **kwargs)
 
         try:
             apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', datastore)
@@ -84,6 +215,8 @@ class DatastoreMySQLTestCaseBase(unittest.TestCase):
         apiproxy_stub_map.apiproxy.RegisterStub(
             'taskqueue', TaskQueueServiceStubMock())
 
+        return self.stub
+
     def tearDown(self):
         """Clears all data."""
 
@@ -284,6 +417,74 @@ class DatastoreMySQLTestCase(DatastoreMySQLTestCaseBase):
             datastore_errors.BadRequestError,
             db.run_in_transaction, query_tx)
 
+    def testReadYourOwnWrites(self):
+        """Transactions see their own buffered puts and deletes."""
+
+        class Author(db.Model):
+            name = db.StringProperty()
+
+        class Book(db.Model):
+            title = db.StringProperty()
+
+        marktwain = Author(name='Mark Twain', key_name='marktwain').put()
+        sawyer = Book(parent=marktwain, title='Tom Sawyer').put()
+
+        def tx():
+            author = db.get(marktwain)
+            author.name = 'Samuel Clemens'
+            author.put()
+            self.assertEqual('Samuel Clemens', db.get(marktwain).name)
+
+            db.delete(sawyer)
+            self.assertEqual(None, db.get(sawyer))
+
+            finn = Book(parent=marktwain, title='Huckleberry Finn').put()
+            self.assertEqual('Huckleberry Finn', db.get(finn).title)
+
+            titles = [b.title for b in Book.all().ancestor(marktwain)]
+            self.assertEqual(['Huckleberry Finn'], titles)
+
+            # Reads after a query are served from the database connection
+            # of the transaction, which holds the flushed writes.
+            self.assertEqual('Samuel Clemens', db.get(marktwain).name)
+            raise db.Rollback()
+
+        db.run_in_transaction(tx)
+
+        self.assertEqual('Mark Twain', db.get(marktwain).name)
+        self.assertEqual(
+            ['Tom Sawyer'], [b.title for b in Book.all().ancestor(marktwain)])
+
+    def testTransactionalIndexUpdates(self):
+        """Commits rewrite the index rows of written and deleted entities."""
+
+        class Author(db.Model):
+            name = db.StringProperty()
+
+        class Book(db.Model):
+            title = db.StringProperty()
+            year = db.IntegerProperty()
+
+        marktwain = Author(name='Mark Twain', key_name='marktwain').put()
+        sawyer = Book(parent=marktwain, title='Tom Sawyer', year=1876).put()
+        finn = Book(parent=marktwain, title='Huckleberry Finn',
+                    year=1884).put()
+
+        def tx():
+            book = db.get(sawyer)
+            book.year = 1877
+            book.put()
+            db.delete(finn)
+            Book(parent=marktwain, title='Roughing It', year=1872).put()
+
+        db.run_in_transaction(tx)
+
+        self.assertEqual(0, Book.all().filter('year =', 1876).count())
+        self.assertEqual(0, Book.all().filter('year =', 1884).count())
+        self.assertEqual(
+            ['Roughing It', 'Tom Sawyer'],
+            [b.title for b in Book.all().filter('year >', 1870).order('year')])
+
     def testKindlessAncestorQueries(self):
         """Perform kindless queries for entities with a given ancestor."""
 
@@ -366,6 +567,22 @@ class DatastoreMySQLTestCase(DatastoreMySQLTestCaseBase):
 
         self.assertEqual(2, Balloon.all().count())
 
+    def testCountDistinctAndLimit(self):
+        """Counts distinct entities on the server, up to a limit."""
+
+        self.registerStub(trusted=True, trusted_count_limit=3)
+
+        class Kite(db.Model):
+            tags = db.StringListProperty()
+
+        for i in xrange(5):
+            Kite(tags=['a', 'b']).put()
+
+        self.assertEqual(3, Kite.all().count())
+        self.assertEqual(2, Kite.all().count(2))
+        self.assertEqual(
+            3, Kite.all().filter('tags >=', 'a').count())
+
     def testQueryWithFilter(self):
         """Tries queries with filters."""
 
@@ -453,6 +670,62 @@ class DatastoreMySQLTestCase(DatastoreMySQLTestCaseBase):
                 datastore_types.Key.from_path(u'Asset', 2, _app=app_id)]),
             set(query.run()))
 
+    def testKeysOnlyQueryPlans(self):
+        """Returns the keys of filtered keys only queries."""
+
+        class Shelf(db.Model):
+            pass
+
+        class Book(db.Model):
+            title = db.StringProperty()
+            pages = db.IntegerProperty()
+
+        shelf = Shelf(key_name='top')
+        shelf.put()
+        moby = Book(parent=shelf, key_name='moby', title='Moby Dick',
+                    pages=635)
+        moby.put()
+        emma = Book(parent=shelf, title='Emma', pages=474)
+        emma.put()
+
+        query = Book.all(keys_only=True).filter('pages >', 500)
+        self.assertEqual([moby.key()], list(query.run()))
+
+        query = (Book.all(keys_only=True)
+                    .filter('title >=', 'A')
+                    .order('-pages'))
+        self.assertEqual([moby.key(), emma.key()], list(query.run()))
+
+        query = (Book.all(keys_only=True)
+                    .filter('title =', 'Emma')
+                    .filter('pages =', 474))
+        self.assertEqual([emma.key()], list(query.run()))
+        self.assertEqual(shelf.key(), list(query.run())[0].parent())
+
+    def testKeysOnlyQueryKeyNames(self):
+        """Returns key names which look like paths or ids unchanged."""
+
+        class Tag(db.Model):
+            weight = db.IntegerProperty()
+
+        parent = Tag(key_name='a!b', weight=1)
+        parent.put()
+        keys = [parent.key()]
+        for name in ('1st', '42'):
+            tag = Tag(parent=parent, key_name=name, weight=2)
+            tag.put()
+            keys.append(tag.key())
+        Tag(key_name='x:y', weight=3).put()
+
+        query = Tag.all(keys_only=True).filter('weight <', 3)
+        self.assertEqual(sorted(keys), sorted(query.run()))
+        self.assertEqual(
+            ['a!b', '1st', '42'],
+            [key.name() for key in Tag.all(keys_only=True)
+                                      .ancestor(parent).order('__key__')])
+        self.assertEqual(
+            'x:y', Tag.all(keys_only=True).filter('weight =', 3).get().name())
+
     def testQueryWithOrder(self):
         """Tests queries with sorting."""
 
@@ -901,6 +1174,265 @@ class DatastoreMySQLTestCase(DatastoreMySQLTestCaseBase):
             [1978L, 1976L, 1974L, 1972L, 1970L, 1968L],
             [n.value for n in f])
 
+    def testCursorsWithTies(self):
+        """Pages through equal sort values without skipping results."""
+
+        class Item(db.Model):
+            rank = db.IntegerProperty()
+
+        keys = [Item(key_name='i%02d' % i, rank=i % 3).put()
+                for i in xrange(30)]
+
+        def page_through(query, size):
+            results = []
+            page = query.fetch(size)
+            while page:
+                results.extend(page)
+                query.with_cursor(query.cursor())
+                page = query.fetch(size)
+            return results
+
+        items = page_through(Item.all().order('-rank'), 7)
+        self.assertEqual(30, len(set(item.key() for item in items)))
+        self.assertEqual(sorted([i % 3 for i in xrange(30)], reverse=True),
+                         [item.rank for item in items])
+
+        items = page_through(Item.all().order('-__key__'), 4)
+        self.assertEqual(list(reversed(keys)), [item.key() for item in items])
+
+    def testStreamingQueries(self):
+        """Streams query results and gives connections back to the pool."""
+
+        self.registerStub(stream_queries=True, pool_size=2, pool_timeout=1.0)
+
+        class Drop(db.Model):
+            size = db.IntegerProperty()
+
+        for i in xrange(45):
+            Drop(size=i).put()
+
+        for unused_i in xrange(5):
+            self.assertEqual(
+                range(45), [drop.size for drop in Drop.all().order('size')])
+
+        self.assertEqual([0, 1, 2],
+                         [drop.size for drop in
+                          Drop.all().order('size').fetch(3)])
+        self.assertEqual(45, Drop.all().count())
+
+    def testIdleStreamingCursorsAreReclaimed(self):
+        """Expires idle streaming cursors when the pool runs out."""
+
+        self.registerStub(stream_queries=True, pool_size=2, pool_timeout=5.0,
+                          cursor_ttl=0.5)
+
+        class Drop(db.Model):
+            size = db.IntegerProperty()
+
+        keys = db.put([Drop(size=i) for i in xrange(45)])
+
+        abandoned = [Drop.all().run() for i in range(2)]
+        for results in abandoned:
+            results.next()
+
+        start = time.time()
+        self.assertEqual(45, len(db.get(keys)))
+        self.assertTrue(time.time() - start < 4.0)
+        self.assertEqual(2, self.stub.OpenCursorStats()['expirations'])
+
+    def testCursorEviction(self):
+        """Closes least recently used and idle query cursors."""
+
+        self.registerStub(max_cursors=1, cursor_ttl=0.5)
+
+        class Leaf(db.Model):
+            pass
+
+        for unused_i in xrange(25):
+            Leaf().put()
+
+        first = Leaf.all().run()
+        second = Leaf.all().run()
+
+        stats = self.stub.OpenCursorStats()
+        self.assertEqual(1, stats['entries'])
+        self.assertEqual(1, stats['evictions'])
+        self.assertRaises(datastore_errors.BadRequestError, list, first)
+        self.assertEqual(25, len(list(second)))
+        self.assertEqual(1, self.stub.OpenCursorStats()['entries'])
+
+        query = datastore_pb.Query()
+        query.set_app('test')
+        query.set_kind('Leaf')
+        query.set_count(100)
+        result = datastore_pb.QueryResult()
+        self.stub.MakeSyncCall('datastore_v3', 'RunQuery', query, result)
+        self.assertEqual(25, result.result_size())
+        self.assertFalse(result.more_results())
+        request = datastore_pb.NextRequest()
+        request.mutable_cursor().CopyFrom(result.cursor())
+        result = datastore_pb.QueryResult()
+        self.stub.MakeSyncCall('datastore_v3', 'Next', request, result)
+        self.assertEqual(0, result.result_size())
+        self.assertFalse(result.more_results())
+
+        third = Leaf.all().run()
+        time.sleep(1)
+        self.assertRaises(datastore_errors.BadRequestError, list, third)
+        self.assertEqual(1, self.stub.OpenCursorStats()['expirations'])
+
+    def testAsyncCalls(self):
+        """Runs overlapping asynchronous calls on worker threads."""
+
+        class Seed(db.Model):
+            weight = db.IntegerProperty()
+
+        keys = [Seed(weight=i).put() for i in xrange(5)]
+
+        rpcs = []
+        finished = []
+        for key in keys:
+            request = datastore_pb.GetRequest()
+            request.add_key().CopyFrom(key._ToPb())
+            rpc = self.stub.CreateRPC()
+            rpc.MakeCall('datastore_v3', 'Get', request,
+                         datastore_pb.GetResponse(),
+                         lambda: finished.append(1))
+            rpcs.append(rpc)
+
+        for i, rpc in enumerate(rpcs):
+            rpc.Wait()
+            rpc.CheckSuccess()
+            entity = db.model_from_protobuf(rpc.response.entity(0).entity())
+            self.assertEqual(i, entity.weight)
+        self.assertEqual(5, len(finished))
+
+        request = datastore_pb.NextRequest()
+        request.mutable_cursor().set_app('test')
+        request.mutable_cursor().set_cursor(12345)
+        rpc = self.stub.CreateRPC()
+        rpc.MakeCall('datastore_v3', 'Next', request,
+                     datastore_pb.QueryResult())
+        rpc.Wait()
+        self.assertRaises(apiproxy_errors.ApplicationError, rpc.CheckSuccess)
+
+    def testRpcStats(self):
+        """Counts calls, errors, entities and bytes per RPC."""
+
+        class Item(db.Model):
+            number = db.IntegerProperty()
+
+        keys = db.put([Item(number=i) for i in range(3)])
+        db.get(keys + [db.Key.from_path('Item', 5000)])
+        self.assertRaises(
+            datastore_errors.BadRequestError,
+            db.get, db.Key.from_path('Item', 1, _app='other'))
+
+        stats = self.stub.RpcStats()
+        self.assertEqual(1, stats['Put']['count'])
+        self.assertEqual(3, stats['Put']['entities'])
+        self.assertEqual(2, stats['Get']['count'])
+        self.assertEqual(1, stats['Get']['errors'])
+        self.assertEqual(3, stats['Get']['entities'])
+        self.assertTrue(stats['Get']['request_bytes'] > 0)
+        self.assertEqual(2, stats['Get']['latency_buckets'][-1][1])
+
+        self.assertTrue('datastore_mysql_rpc_latency_seconds_count'
+                        '{call="Put"} 1' in self.stub.PrometheusMetrics())
+
+    def testSqlProfile(self):
+        """Aggregates statements by fingerprint."""
+
+        class Item(db.Model):
+            number = db.IntegerProperty()
+
+        keys = db.put([Item(number=i) for i in range(3)])
+        self.stub.SqlProfile(reset=True)
+        for key in keys:
+            db.get(key)
+        db.get(keys)
+
+        profile = self.stub.SqlProfile(limit=100)
+        fingerprints = dict((entry['fingerprint'], entry) for entry in profile)
+        lookup = fingerprints[
+            'SELECT __path__, entity FROM ?_Entities WHERE __path__ IN (?+)']
+        self.assertEqual(4, lookup['count'])
+        self.assertEqual(6, lookup['rows_returned'])
+        self.assertTrue(lookup['max_seconds'] <= lookup['total_seconds'])
+
+    def testHooks(self):
+        """Calls registered hooks around RPCs and SQL statements."""
+
+        class Item(db.Model):
+            number = db.IntegerProperty()
+
+        key = Item(number=1).put()
+
+        events = []
+        self.stub.AddRpcHook(
+            lambda call, request: events.append(('before rpc', call)),
+            lambda call, request, response, seconds, error: events.append(
+                ('after rpc', call, error)))
+        self.stub.AddSqlHook(
+            after=lambda call, fingerprint, seconds, returned, affected, error:
+                events.append(('sql', call, fingerprint, returned)))
+
+        db.get(key)
+        self.stub.ClearHooks()
+        db.get(key)
+
+        self.assertEqual(
+            [('before rpc', 'Get'),
+             ('sql', 'Get', 'SELECT __path__, entity FROM ?_Entities '
+                            'WHERE __path__ IN (?+)', 1),
+             ('after rpc', 'Get', None)],
+            events)
+
+        statements = []
+        self.stub.AddSqlHook(
+            lambda call, fingerprint, sql: statements.append(call))
+        Item(number=2).put()
+        self.stub.ClearHooks()
+
+        self.assertTrue(statements)
+        self.assertEqual(set(['Put']), set(statements))
+
+    def testRecording(self):
+        """Records RPCs to a log that can be read back."""
+
+        class Item(db.Model):
+            number = db.IntegerProperty()
+
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'rpc.log')
+        try:
+            self.stub.StartRecording(path)
+            try:
+                key = Item(number=1).put()
+                db.get(key)
+                Item.all().fetch(10)
+                Item.all().fetch(10, offset=1)
+            finally:
+                self.stub.StopRecording()
+
+            records = list(
+                typhoonae.mysql.datastore_mysql_stub.ReadRpcLog(path))
+            self.assertEqual(['Put', 'Get', 'RunQuery', 'RunQuery'],
+                             [record[1] for record in records])
+            put = datastore_pb.PutRequest(records[0][6])
+            self.assertEqual(1, put.entity_size())
+            self.assertEqual('', records[0][7])
+            result = datastore_pb.QueryResult(records[2][7])
+            self.assertEqual(1, result.result_size())
+            query = datastore_pb.Query(records[3][6])
+            self.assertEqual(1, query.offset())
+
+            recorder = typhoonae.mysql.datastore_mysql_stub.RpcRecorder(path)
+            recorder.Close()
+            recorder.Record('datastore_v3', 'Get', 0.0, 0.0, 0, False, '', '')
+        finally:
+            shutil.rmtree(directory)
+
     def testGetSchema(self):
         """Infers an app's schema from the entities in the datastore."""
 
@@ -920,3 +1452,469 @@ class DatastoreMySQLTestCase(DatastoreMySQLTestCaseBase):
             taskqueue.add(url='/path/to/my/worker', transactional=True)
 
         db.run_in_transaction(my_transaction)
+
+    def testTransactionalTasksAreAddedInBulk(self):
+        """Adds the tasks of a transaction with one call after commit."""
+
+        self.registerStub(max_actions_per_transaction=10)
+        taskqueue_stub = apiproxy_stub_map.apiproxy.GetStub('taskqueue')
+
+        def add_tasks(count, fail=False):
+            for i in range(count):
+                taskqueue.add(url='/worker/%d' % i, transactional=True)
+            if fail:
+                raise db.Rollback()
+
+        db.run_in_transaction(add_tasks, 3, fail=True)
+        self.assertEqual([], taskqueue_stub.bulk_add_requests)
+
+        # More tasks than the default limit of five.
+        db.run_in_transaction(add_tasks, 10)
+        self.assertEqual(1, len(taskqueue_stub.bulk_add_requests))
+        self.assertEqual(
+            10, taskqueue_stub.bulk_add_requests[0].add_request_size())
+
+    def testConcurrentRequests(self):
+        """Issues datastore calls from several threads at once."""
+
+        class Counter(db.Model):
+            count = db.IntegerProperty()
+
+        keys = db.put(
+            [Counter(key_name='counter%d' % i, count=i) for i in range(10)])
+
+        errors = []
+
+        def worker():
+            try:
+                for i in range(10):
+                    self.assertEqual(
+                        range(10), [c.count for c in db.get(keys)])
+                    self.assertEqual(10, Counter.all().count())
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([], errors)
+
+    def testConcurrentTransactions(self):
+        """Runs transactions on different entity groups in parallel."""
+
+        class Account(db.Model):
+            balance = db.IntegerProperty()
+
+        class Ledger(db.Model):
+            total = db.IntegerProperty()
+
+        account = Account(key_name='alice', balance=10).put()
+        ledger = Ledger(key_name='main', total=0).put()
+
+        started = threading.Event()
+        finish = threading.Event()
+        errors = []
+
+        def slow_tx():
+            entity = db.get(account)
+            started.set()
+            finish.wait(10)
+            entity.balance += 1
+            entity.put()
+
+        def slow_worker():
+            try:
+                db.run_in_transaction(slow_tx)
+            except Exception, e:
+                errors.append(e)
+
+        def fast_tx():
+            entity = db.get(ledger)
+            entity.total += 1
+            entity.put()
+
+        thread = threading.Thread(target=slow_worker)
+        thread.start()
+        started.wait(10)
+        try:
+            # Neither a transaction nor a plain read has to wait for the
+            # open transaction.
+            db.run_in_transaction(fast_tx)
+            self.assertEqual(1, db.get(ledger).total)
+            self.assertEqual(10, db.get(account).balance)
+        finally:
+            finish.set()
+            thread.join()
+
+        self.assertEqual([], errors)
+        self.assertEqual(11, db.get(account).balance)
+
+    def testEntityGroupLocks(self):
+        """Locks entity groups by their root key, not by kind."""
+
+        class Counter(db.Model):
+            count = db.IntegerProperty()
+
+        first = Counter(key_name='first', count=0).put()
+        second = Counter(key_name='second', count=0).put()
+
+        def begin():
+            request = datastore_pb.BeginTransactionRequest()
+            request.set_app('test')
+            transaction = datastore_pb.Transaction()
+            apiproxy_stub_map.MakeSyncCall(
+                'datastore_v3', 'BeginTransaction', request, transaction)
+            return transaction
+
+        def get(transaction, key):
+            request = datastore_pb.GetRequest()
+            request.mutable_transaction().CopyFrom(transaction)
+            request.add_key().CopyFrom(key._ToPb())
+            apiproxy_stub_map.MakeSyncCall(
+                'datastore_v3', 'Get', request, datastore_pb.GetResponse())
+
+        def rollback(transaction):
+            apiproxy_stub_map.MakeSyncCall(
+                'datastore_v3', 'Rollback', transaction,
+                api_base_pb.VoidProto())
+
+        tx1 = begin()
+        tx2 = begin()
+        tx3 = begin()
+        try:
+            get(tx1, first)
+            get(tx2, second)
+            try:
+                get(tx3, first)
+            except apiproxy_errors.ApplicationError, e:
+                self.assertEqual(
+                    datastore_pb.Error.CONCURRENT_TRANSACTION,
+                    e.application_error)
+            else:
+                self.fail('Expected CONCURRENT_TRANSACTION')
+        finally:
+            rollback(tx1)
+            rollback(tx2)
+            rollback(tx3)
+
+    def testCrossGroupTransactions(self):
+        """Transactions may use up to max_entity_groups entity groups."""
+
+        class Account(db.Model):
+            balance = db.IntegerProperty()
+
+        alice = Account(key_name='alice', balance=10).put()
+        bob = Account(key_name='bob', balance=0).put()
+        carol = Account(key_name='carol', balance=0).put()
+
+        def transfer(source, target, amount):
+            source, target = db.get([source, target])
+            source.balance -= amount
+            target.balance += amount
+            db.put([source, target])
+
+        self.assertRaises(
+            datastore_errors.BadRequestError,
+            db.run_in_transaction, transfer, alice, bob, 5)
+
+        self.registerStub(max_entity_groups=2)
+        db.run_in_transaction(transfer, alice, bob, 5)
+        self.assertEqual([5, 5, 0], [a.balance for a in
+                                     db.get([alice, bob, carol])])
+
+        def pay_both():
+            transfer(alice, bob, 1)
+            transfer(alice, carol, 1)
+
+        self.assertRaises(
+            datastore_errors.BadRequestError,
+            db.run_in_transaction, pay_both)
+        self.assertEqual([5, 5, 0], [a.balance for a in
+                                     db.get([alice, bob, carol])])
+
+        # The locks of the failed transaction were released.
+        db.run_in_transaction(transfer, bob, carol, 5)
+        self.assertEqual([5, 0, 5], [a.balance for a in
+                                     db.get([alice, bob, carol])])
+
+    def testOptimisticTransactions(self):
+        """Fails commits whose entity group changed since it was read."""
+
+        self.registerStub(optimistic_transactions=True)
+
+        class Counter(db.Model):
+            count = db.IntegerProperty()
+
+        key = Counter(key_name='counter', count=0).put()
+
+        def begin():
+            request = datastore_pb.BeginTransactionRequest()
+            request.set_app('test')
+            transaction = datastore_pb.Transaction()
+            apiproxy_stub_map.MakeSyncCall(
+                'datastore_v3', 'BeginTransaction', request, transaction)
+            return transaction
+
+        def increment(transaction):
+            request = datastore_pb.GetRequest()
+            request.mutable_transaction().CopyFrom(transaction)
+            request.add_key().CopyFrom(key._ToPb())
+            response = datastore_pb.GetResponse()
+            apiproxy_stub_map.MakeSyncCall(
+                'datastore_v3', 'Get', request, response)
+            counter = db.model_from_protobuf(response.entity(0).entity())
+            counter.count += 1
+            request = datastore_pb.PutRequest()
+            request.mutable_transaction().CopyFrom(transaction)
+            request.add_entity().CopyFrom(db.model_to_protobuf(counter))
+            apiproxy_stub_map.MakeSyncCall(
+                'datastore_v3', 'Put', request, datastore_pb.PutResponse())
+
+        def commit(transaction):
+            apiproxy_stub_map.MakeSyncCall(
+                'datastore_v3', 'Commit', transaction,
+                api_base_pb.VoidProto())
+
+        tx1 = begin()
+        tx2 = begin()
+        increment(tx1)
+        increment(tx2)
+        commit(tx1)
+        try:
+            commit(tx2)
+        except apiproxy_errors.ApplicationError, e:
+            self.assertEqual(
+                datastore_pb.Error.CONCURRENT_TRANSACTION,
+                e.application_error)
+        else:
+            self.fail('Expected CONCURRENT_TRANSACTION')
+        self.assertEqual(1, Counter.get(key).count)
+
+        tx3 = begin()
+        increment(tx3)
+        Counter(key_name='counter', count=10).put()
+        self.assertRaises(
+            apiproxy_errors.ApplicationError, commit, tx3)
+        self.assertEqual(10, Counter.get(key).count)
+
+        tx4 = begin()
+        increment(tx4)
+        commit(tx4)
+        self.assertEqual(11, Counter.get(key).count)
+
+    def testBatchGet(self):
+        """Gets many entities, including missing ones, in one call."""
+
+        class Item(db.Model):
+            number = db.IntegerProperty()
+
+        keys = db.put([Item(number=i) for i in range(600)])
+        missing = db.Key.from_path('Item', 5000)
+
+        requested = list(reversed(keys)) + [missing, keys[0]]
+        items = db.get(requested)
+
+        self.assertEqual(len(requested), len(items))
+        self.assertEqual(range(599, -1, -1), [i.number for i in items[:600]])
+        self.assertEqual(None, items[600])
+        self.assertEqual(0, items[601].number)
+
+    def testEntityCache(self):
+        """Serves repeated gets from the entity cache."""
+
+        stub = self.registerStub(entity_cache_size=10)
+
+        class Setting(db.Model):
+            value = db.StringProperty()
+
+        key = Setting(key_name='motd', value='Hello').put()
+
+        self.assertEqual('Hello', db.get(key).value)
+        self.assertEqual('Hello', db.get(key).value)
+        self.assertEqual(1, stub.EntityCacheStats()['hits'])
+
+        Setting(key_name='motd', value='Goodbye').put()
+        self.assertEqual('Goodbye', db.get(key).value)
+
+        db.delete(key)
+        self.assertEqual(None, db.get(key))
+
+    def testUpdateIndexEntries(self):
+        """Updates indexed properties of existing entities."""
+
+        class Article(db.Model):
+            tags = db.StringListProperty()
+            rating = db.IntegerProperty()
+
+        article = Article(tags=['python', 'mysql', 'appengine'], rating=3)
+        article.put()
+
+        article.tags = ['python', 'datastore']
+        article.rating = 4
+        article.put()
+
+        self.assertEqual(
+            1, Article.all().filter('tags =', 'python').count())
+        self.assertEqual(
+            1, Article.all().filter('tags =', 'datastore').count())
+        self.assertEqual(
+            0, Article.all().filter('tags =', 'mysql').count())
+        self.assertEqual(
+            0, Article.all().filter('rating =', 3).count())
+        self.assertEqual(
+            ['python', 'datastore'],
+            Article.all().filter('rating =', 4).get().tags)
+
+    def testConcurrentPutsOfOneEntity(self):
+        """Updates the index entries of one entity from two threads."""
+
+        class Gauge(db.Model):
+            level = db.IntegerProperty()
+
+        Gauge(key_name='gauge', level=0).put()
+
+        errors = []
+
+        def writer(levels):
+            try:
+                for level in levels:
+                    Gauge(key_name='gauge', level=level).put()
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=writer, args=(range(1, 40, 2),)),
+                   threading.Thread(target=writer, args=(range(2, 40, 2),))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([], errors)
+        level = Gauge.get_by_key_name('gauge').level
+        for i in range(40):
+            self.assertEqual(
+                int(i == level), Gauge.all().filter('level =', i).count())
+
+    def testBatchPutWithRepeatedValues(self):
+        """Indexes a batch of entities sharing property values."""
+
+        class Reading(db.Model):
+            sensor = db.StringProperty()
+            value = db.FloatProperty()
+            ok = db.BooleanProperty()
+
+        db.put([Reading(sensor='s%d' % (i % 3), value=[0.0, -0.0, 1.5][i % 3],
+                        ok=bool(i % 2))
+                for i in range(30)])
+
+        self.assertEqual(10, Reading.all().filter('sensor =', 's1').count())
+        self.assertEqual(15, Reading.all().filter('ok =', True).count())
+        self.assertEqual(
+            10, Reading.all().filter('value =', 1.5).count())
+        self.assertEqual(
+            20, Reading.all().filter('value <', 1.0).count())
+
+    def testCompositeIndex(self):
+        """Queries entities through a materialized composite index."""
+
+        class Planet(db.Model):
+            name = db.StringProperty()
+            moon_count = db.IntegerProperty()
+            distance = db.FloatProperty()
+
+        Planet(name="Earth", distance=93.0, moon_count=1).put()
+        Planet(name="Venus", distance=67.2, moon_count=0).put()
+        mars = Planet(name="Mars", distance=141.6, moon_count=2)
+        mars.put()
+
+        index = datastore_index.Index(
+            kind='Planet',
+            properties=[
+                datastore_index.Property(name='moon_count'),
+                datastore_index.Property(name='distance', direction='desc')])
+        datastore_admin.CreateIndex(
+            datastore_index.IndexDefinitionToProto('test', index))
+
+        Planet(name="Saturn", distance=886.7, moon_count=18).put()
+        Planet(name="Mercury", distance=36.0, moon_count=0).put()
+        self.stub.SqlProfile(reset=True)
+
+        query = (Planet.all()
+            .filter('moon_count =', 0)
+            .order('-distance'))
+        self.assertEqual(
+            ['Venus', 'Mercury'], [planet.name for planet in query.run()])
+
+        query = (Planet.all()
+            .filter('moon_count >', 0)
+            .order('moon_count')
+            .order('-distance'))
+        self.assertEqual(
+            ['Earth', 'Mars', 'Saturn'],
+            [planet.name for planet in query.run()])
+
+        mars.delete()
+
+        query = (Planet.all()
+            .filter('moon_count >=', 1)
+            .filter('moon_count <', 18)
+            .order('moon_count')
+            .order('-distance'))
+        self.assertEqual(['Earth'], [planet.name for planet in query.run()])
+
+        fingerprints = [entry['fingerprint']
+                        for entry in self.stub.SqlProfile(limit=100)]
+        self.assertTrue(
+            [f for f in fingerprints if 'FROM ?_CompositeIndex AS' in f])
+        self.assertEqual(
+            [], [f for f in fingerprints
+                 if 'INNER JOIN ?_EntitiesByProperty' in f])
+
+    def testCreateIndexDuringPuts(self):
+        """Backfills a composite index while entities are being put."""
+
+        class Reading(db.Model):
+            sensor = db.IntegerProperty()
+            value = db.IntegerProperty()
+
+        db.put([Reading(sensor=i % 2, value=i) for i in range(200)])
+
+        errors = []
+        finish = threading.Event()
+
+        def writer():
+            try:
+                i = 200
+                while not finish.isSet():
+                    Reading(sensor=i % 2, value=i).put()
+                    i += 1
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=writer) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        try:
+            index = datastore_index.Index(
+                kind='Reading',
+                properties=[datastore_index.Property(name='sensor'),
+                            datastore_index.Property(name='value')])
+            datastore_admin.CreateIndex(
+                datastore_index.IndexDefinitionToProto('test', index))
+        finally:
+            finish.set()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual([], errors)
+        for sensor in (0, 1):
+            expected = sorted(
+                r.value for r in Reading.all() if r.sensor == sensor)
+            query = (Reading.all()
+                .filter('sensor =', sensor)
+                .filter('value >=', 0)
+                .order('value'))
+            self.assertEqual(expected, [r.value for r in query.run()])